@@ -0,0 +1,37 @@
+"""
+Measure `Tree.to_file` throughput.
+
+Usage: python benchmarks/bench_save.py [NUMPOINTS] [DATASIZE]
+
+"""
+from tempfile import TemporaryDirectory
+import os
+import sys
+import time
+
+from pymvptree import Tree, Point
+
+
+def main(numpoints=200000, datasize=8, repeat=3):
+    tree = Tree()
+    for start in range(0, numpoints, 100):
+        tree.add([Point(i, os.urandom(datasize))
+                  for i in range(start, min(start + 100, numpoints))])
+
+    with TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'tree')
+        for sync in (True, False):
+            best = None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                tree.to_file(filename, sync=sync)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+
+            size = os.path.getsize(filename)
+            print("sync=%-5s %10d bytes %8.3fs %8.1f MB/s" % (
+                sync, size, best, size / best / 1024 ** 2))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
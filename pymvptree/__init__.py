@@ -1,17 +1,38 @@
 from contextlib import contextmanager
 from enum import IntEnum
 import base64
+import bisect
 import collections
 import os
 import pickle
+import struct
+import threading
 
 import _c_mvptree as mvp
 
+from .tuning import TuningResult, tune
+
 
 MVP_BRANCHFACTOR = 2
 MVP_PATHLENGTH   = 5
 MVP_LEAFCAP      = 25
 
+#: Pickle protocol of the stored point ids. Ids are looked up by their
+#: serialized form, so it must not follow the default of the running
+#: Python. 3 is the default of the Python versions that wrote the
+#: existing files. Trees written with another protocol (the default of
+#: Python 3.8+ is 4) still load, but their ids do not match, see `IdSet`.
+ID_PICKLE_PROTOCOL = 3
+
+#: Suffix of the delta log kept next to a tree file.
+JOURNAL_SUFFIX = '.log'
+JOURNAL_MAGIC  = b'MVPLOG\x00\x02'
+JOURNAL_RECORD = struct.Struct('<III')
+
+#: Record layout by delta log version. Version 1 logs have no tags.
+JOURNAL_RECORDS = {b'MVPLOG\x00\x01': struct.Struct('<II'),
+                   JOURNAL_MAGIC: JOURNAL_RECORD}
+
 
 class MVPError(IntEnum):
     MVP_SUCCESS        = 0
@@ -40,6 +61,40 @@ class MVPError(IntEnum):
     MVP_BADDISTVAL     = 23
     MVP_FILENOTFOUND   = 24
     MVP_UNRECOGNIZED   = 25
+    MVP_DISTRANGE      = 26
+    MVP_FILECORRUPT    = 27
+
+
+class MVPDistType(IntEnum):
+    """
+    Storage type of the distances kept in the tree.
+
+    The integer types store the point paths, leaf distances and split
+    values in 1 or 2 bytes instead of a 4 byte float. The distance
+    function of the tree is the bit-level hamming distance, which is
+    always an integer, so they are safe as long as the distances fit
+    (up to 255 bits of difference for `MVP_UINT8DIST`, 65535 for
+    `MVP_UINT16DIST`).
+
+    """
+    MVP_UINT8DIST  = 1
+    MVP_UINT16DIST = 2
+    MVP_FLOATDIST  = 4
+
+
+class MVPFormat(IntEnum):
+    """
+    File format written by `Tree.to_file` and `Tree.to_bytes`.
+
+    `MVP_FORMAT1` is readable by all the versions of this library.
+    `MVP_FORMAT2` is more compact: varint lengths, no offsets, and ids
+    kept apart from the hashes. `MVP_FORMAT2_ZLIB` also compresses it,
+    for cold storage.
+
+    """
+    MVP_FORMAT1      = 1
+    MVP_FORMAT2      = 2
+    MVP_FORMAT2_ZLIB = 3
 
 
 @contextmanager
@@ -74,6 +129,17 @@ def mvp_errors():
                 raise RuntimeError(error, description)
 
 
+def _serialize_id(point_id):
+    """
+    Returns the serialized form of `point_id` stored by the C library.
+
+    """
+    try:
+        return base64.b64encode(pickle.dumps(point_id, ID_PICKLE_PROTOCOL))
+    except pickle.PicklingError as exc:
+        raise TypeError("`point_id` must be picklable.") from exc
+
+
 class Point:
     """
     Represents a data point.
@@ -87,9 +153,12 @@ class Point:
                   object of `_c_mvptree` directly. Can't be used in
                   conjunction with `point_id` and/or `data`.
 
+    :param tag: Unsigned 32 bit integer, e.g. a tenant or shard number,
+                that `Tree.filter` can select on.
+
     """
     def __init__(self, point_id=None, data=None, c_obj=None,
-                 owned_memory=True, tree=None):
+                 owned_memory=True, tree=None, tag=0):
 
         # `point_id` and `data` cache.
         self._point_id = None
@@ -111,10 +180,7 @@ class Point:
                 raise TypeError("`point_id` must be hashable.")
 
             # Serialize `point_id`
-            try:
-                serialized_id = base64.b64encode(pickle.dumps(point_id))
-            except pickle.PicklingError as exc:
-                raise TypeError("`point_id` must be picklable.") from exc
+            serialized_id = _serialize_id(point_id)
 
             # `data` must be bytes
             if not isinstance(data, bytes):
@@ -127,6 +193,7 @@ class Point:
                 mvp.ffi.gc(mvp.ffi.new("char[]", init=data),
                            lambda x: None),
                 len(data))
+            c_obj.tag = tag
 
         elif c_obj is None:
             raise ValueError(
@@ -162,6 +229,10 @@ class Point:
             self._data = mvp.ffi.buffer(data_void_p, datalen)[:]
         return self._data
 
+    @property
+    def tag(self):
+        return self._c_obj[0].tag
+
     def __hash__(self):
         return hash((self.point_id, self.data))
 
@@ -172,19 +243,175 @@ class Point:
         return "Point(%r, %r)" % (self.point_id, self.data)
 
 
+class ResultSet:
+    """
+    Native result array of a `Tree.filter` call.
+
+    Owns the `MVPDP **` array returned by `mvptree_retrieve` and a
+    reference to each point, so the matches stay valid when a later
+    write to the tree drops them. Shared by all the `Match` objects of
+    the call, so only one finalizer is registered per query.
+
+    `distances` is the `float *` array of the distances of the points
+    to the query, or NULL if they were not requested.
+
+    """
+    __slots__ = ('_c_obj', 'tree', 'size', 'distances')
+
+    def __init__(self, c_obj, size, tree, distances=mvp.ffi.NULL):
+        if c_obj != mvp.ffi.NULL:
+            mvp.lib.retain_results(c_obj, size)
+            c_obj = mvp.ffi.gc(c_obj,
+                               lambda c_obj: mvp.lib.rmresults(c_obj, size))
+        if distances != mvp.ffi.NULL:
+            distances = mvp.ffi.gc(distances, mvp.lib.free)
+        self._c_obj = c_obj
+        self.size = size
+        self.tree = tree
+        self.distances = distances
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.size:
+            raise IndexError("result index out of range")
+        return Match(self, index)
+
+    def __iter__(self):
+        return (Match(self, i) for i in range(self.size))
+
+
+class Match:
+    """
+    A point found in a tree.
+
+    Lightweight, read-only counterpart of `Point` yielded by
+    `Tree.filter`. It only holds its index in a `ResultSet`; `point_id`
+    and `data` are decoded on first access. Compares and hashes like a
+    `Point` with the same `point_id` and `data`.
+
+    """
+    __slots__ = ('_results', '_index', '_point_id', '_data')
+
+    def __init__(self, results, index):
+        self._results = results
+        self._index = index
+        self._point_id = None
+        self._data = None
+
+    @property
+    def _c_obj(self):
+        return self._results._c_obj[self._index]
+
+    @property
+    def point_id(self):
+        if self._point_id is None:
+            self._point_id = pickle.loads(self.serialized_id)
+        return self._point_id
+
+    @property
+    def serialized_id(self):
+        """
+        The pickled `point_id`, as stored in the tree.
+
+        """
+        return base64.b64decode(mvp.ffi.string(self._c_obj.id))
+
+    @property
+    def data(self):
+        if self._data is None:
+            c_obj = self._c_obj
+            self._data = mvp.ffi.buffer(c_obj.data, c_obj.datalen)[:]
+        return self._data
+
+    @property
+    def tag(self):
+        return self._c_obj.tag
+
+    @property
+    def distance(self):
+        """
+        Distance to the query computed by the search, `None` if the
+        distances were not requested.
+
+        """
+        distances = self._results.distances
+        if distances == mvp.ffi.NULL:
+            return None
+        return distances[self._index]
+
+    def __hash__(self):
+        return hash((self.point_id, self.data))
+
+    def __eq__(self, other):
+        return self.point_id == other.point_id and self.data == other.data
+
+    def __repr__(self):
+        return "Match(%r, %r)" % (self.point_id, self.data)
+
+
+class IdSet:
+    """
+    Native set of point ids, for the `allowed_ids` of `Tree.filter`.
+
+    Build it once to reuse it across queries. Ids are compared by their
+    pickled form, so `1` and `1.0` are different ids.
+
+    Ids pickled differently in the tree never match: ids written with
+    another `ID_PICKLE_PROTOCOL`, and ids without a canonical pickle,
+    such as frozensets or objects sharing references. Adding the points
+    of such a tree to a new `Tree` pickles their ids again.
+
+    """
+    __slots__ = ('_c_obj', )
+
+    def __init__(self, ids=()):
+        ids = list(ids)
+        c_obj = mvp.lib.mvp_idset_alloc(len(ids))
+        if c_obj == mvp.ffi.NULL:
+            raise MemoryError("Cannot allocate the id set.")
+        self._c_obj = mvp.ffi.gc(c_obj, mvp.lib.mvp_idset_free)
+        for point_id in ids:
+            self.add(point_id)
+
+    def add(self, point_id):
+        with mvp_errors() as error:
+            error[0] = mvp.lib.mvp_idset_add(self._c_obj,
+                                             _serialize_id(point_id))
+
+    def __contains__(self, point_id):
+        return bool(mvp.lib.mvp_idset_contains(self._c_obj,
+                                               _serialize_id(point_id)))
+
+    def __len__(self):
+        return self._c_obj.nbids
+
+
 class Tree:
     """
     Wrapper around MVPTree.
 
+    :param disttype: A `MVPDistType`, how the distances are stored in
+                     the tree. Use `MVP_UINT8DIST` or `MVP_UINT16DIST`
+                     for a compact tree.
+
+    A tree runs one operation at a time: searches wait for the running
+    `add`. To search while points are added, search a `snapshot`.
+
     """
     def __init__(self,
                  branchfactor=MVP_BRANCHFACTOR,
                  pathlength=MVP_PATHLENGTH,
                  leafcap=MVP_LEAFCAP,
+                 disttype=MVPDistType.MVP_FLOATDIST,
                  c_obj=None):
 
         if c_obj is None:
             _c_obj = mvp.lib.mktree(branchfactor, pathlength, leafcap)
+            with mvp_errors() as error:
+                error[0] = mvp.lib.mvptree_set_disttype(
+                    _c_obj, MVPDistType(disttype))
         else:
             try:
                 if mvp.ffi.typeof(c_obj) is not mvp.ffi.typeof('MVPTree *'):
@@ -198,40 +425,297 @@ class Tree:
         self.branchfactor = _c_obj[0].branchfactor
         self.pathlength = _c_obj[0].pathlength
         self.leafcap = _c_obj[0].leafcap
+        self.disttype = MVPDistType(_c_obj[0].disttype)
+
+        #: `True` for the snapshots, which can't be changed.
+        self.read_only = False
+
+        # Serializes the calls on `_c_obj`, whose search state is shared.
+        self._lock = threading.RLock()
+
+        # Tree file whose delta log receives the added points.
+        self._journal = None
+
+        # Number of added points after which `optimize` runs automatically,
+        # `None` to disable.
+        self.auto_optimize = None
+        self._inserted_since_optimize = 0
 
     @classmethod
-    def from_file(cls, filename):
-        """Loads the tree from disk."""
+    def from_file(cls, filename, journal=False):
+        """
+        Loads the tree from disk.
+
+        Points appended to the delta log of `filename` are replayed on
+        top of the stored tree. With `journal=True` the points added
+        afterwards are appended to that log too, see `checkpoint`.
+
+        """
         with mvp_errors() as error:
-            return cls(c_obj=mvp.lib.load(os.fsencode(filename), error))
+            tree = cls(c_obj=mvp.lib.load(os.fsencode(filename), error))
+
+        tree._replay(filename, truncate=journal)
+        if journal:
+            tree._journal = filename
+        return tree
 
-    def to_file(self, filename):
-        """Writes the tree to disk."""
+    @property
+    def file_format(self):
+        """
+        The `MVPFormat` written by `to_file` and `to_bytes`.
+
+        New trees use `MVP_FORMAT1`, loaded trees the format they were
+        read from.
+
+        """
+        return MVPFormat(self._c_obj.format)
+
+    @property
+    def last_search_distances(self):
+        """
+        Number of distances computed by the last search of the tree.
+
+        """
+        return self._c_obj.nbdist
+
+    def _select_format(self, format, compress):
+        if format is None:
+            format = 1 if self.file_format == MVPFormat.MVP_FORMAT1 else 2
+        if compress is None:
+            compress = (format == 2 and
+                        self.file_format == MVPFormat.MVP_FORMAT2_ZLIB)
+
+        if format == 1 and not compress:
+            selected = MVPFormat.MVP_FORMAT1
+        elif format == 2:
+            selected = (MVPFormat.MVP_FORMAT2_ZLIB if compress
+                        else MVPFormat.MVP_FORMAT2)
+        elif format == 1:
+            raise ValueError("Only format 2 can be compressed.")
+        else:
+            raise ValueError("Unknown file format %r." % (format, ))
+        return selected
+
+    def to_file(self, filename, journal=False, sync=True, format=None,
+                compress=None):
+        """
+        Writes the tree to disk.
+
+        The file is replaced atomically. With `sync=False` it is not
+        flushed to stable storage before returning, which is faster but
+        the file may be lost on a system crash.
+
+        `format` is 1 or 2, and format 2 can be compressed with
+        `compress=True`, see `MVPFormat`. By default the tree is written
+        in its `file_format`, which these arguments leave unchanged.
+
+        The delta log of `filename`, if any, is discarded because the
+        written tree already contains its points (the file is always
+        synced in that case). With `journal=True` the points added
+        afterwards are appended to a new log. Writing the journaled file
+        with `journal=False` stops the journaling, writing another file
+        leaves it on.
+
+        """
+        if journal:
+            self._check_writable()
+
+        logname = os.fsencode(filename) + JOURNAL_SUFFIX.encode()
+        has_log = os.path.exists(logname)
+
+        with self._lock:
+            selected = self._select_format(format, compress)
+            with mvp_errors() as error:
+                mvp.lib.save(os.fsencode(filename), self._c_obj,
+                             sync or has_log, selected, error)
+
+        if has_log:
+            os.unlink(logname)
+
+        if journal:
+            self._journal = filename
+        elif (self._journal is not None and
+              os.path.abspath(os.fsencode(self._journal)) ==
+              os.path.abspath(os.fsencode(filename))):
+            self._journal = None
+
+    def checkpoint(self):
+        """
+        Fold the delta log into a fresh tree file.
+
+        Only for trees loaded or written with `journal=True`.
+
+        """
+        if self._journal is None:
+            raise ValueError("The tree has no delta log.")
+        self.to_file(self._journal, journal=True)
+
+    def _replay(self, filename, truncate=False):
+        """
+        Add the points of the delta log of `filename`.
+
+        A partially written last record, or magic, is ignored, and cut
+        from the log if `truncate` is `True`.
+
+        """
+        logname = os.fsencode(filename) + JOURNAL_SUFFIX.encode()
+        try:
+            with open(logname, 'rb') as log:
+                content = log.read()
+        except FileNotFoundError:
+            return
+
+        if len(content) < len(JOURNAL_MAGIC):
+            # Cut short while writing the magic: there are no records
+            # yet. Rewrite the magic so records can be appended.
+            if truncate:
+                with open(logname, 'wb') as log:
+                    log.write(JOURNAL_MAGIC)
+                    log.flush()
+                    os.fsync(log.fileno())
+            return
+
+        magic = content[:len(JOURNAL_MAGIC)]
+        record = JOURNAL_RECORDS.get(magic)
+        if record is None:
+            raise ValueError("%r is not a delta log." % logname)
+
+        points = []
+        pos = len(JOURNAL_MAGIC)
+        while pos + record.size <= len(content):
+            idlen, datalen, *tag = record.unpack_from(content, pos)
+            end = pos + record.size + idlen + datalen
+            if end > len(content):
+                break
+            start = pos + record.size
+            points.append(Point(pickle.loads(content[start:start + idlen]),
+                                content[start + idlen:end],
+                                tag=tag[0] if tag else 0))
+            pos = end
+
+        if points:
+            self.add(points)
+
+        if truncate and magic != JOURNAL_MAGIC:
+            # Rewrite an older log so new records can be appended to it.
+            tmpname = logname + b'.tmp'
+            with open(tmpname, 'wb') as log:
+                log.write(JOURNAL_MAGIC + self._journal_records(points))
+                log.flush()
+                os.fsync(log.fileno())
+            os.replace(tmpname, logname)
+        elif truncate and pos < len(content):
+            with open(logname, 'r+b') as log:
+                log.truncate(pos)
+
+    @staticmethod
+    def _journal_records(points):
+        records = []
+        for p in points:
+            serialized_id = pickle.dumps(p.point_id, ID_PICKLE_PROTOCOL)
+            records.append(JOURNAL_RECORD.pack(len(serialized_id),
+                                               len(p.data), p.tag))
+            records.append(serialized_id)
+            records.append(p.data)
+        return b''.join(records)
+
+    def _append_journal(self, points):
+        logname = os.fsencode(self._journal) + JOURNAL_SUFFIX.encode()
+        records = self._journal_records(points)
+
+        with open(logname, 'ab') as log:
+            if log.tell() == 0:
+                log.write(JOURNAL_MAGIC)
+            log.write(records)
+            log.flush()
+            os.fsync(log.fileno())
+
+    @classmethod
+    def from_bytes(cls, buffer):
+        """
+        Loads the tree from a bytes-like object.
+
+        The buffer is parsed in place, so `bytes`, `memoryview`, `mmap`
+        or a `multiprocessing.shared_memory` buffer are read without an
+        intermediate copy.
+
+        """
+        c_buffer = mvp.ffi.from_buffer(buffer)
         with mvp_errors() as error:
-            mvp.lib.save(os.fsencode(filename), self._c_obj, error)
+            return cls(c_obj=mvp.lib.loads(c_buffer, len(c_buffer), error))
+
+    def to_bytes(self, format=None, compress=None):
+        """Returns the tree serialized in the same format as `to_file`."""
+        size = mvp.ffi.new("size_t *")
+        with self._lock:
+            selected = self._select_format(format, compress)
+            with mvp_errors() as error:
+                c_buffer = mvp.lib.dumps(self._c_obj, size, selected, error)
+        try:
+            return mvp.ffi.buffer(c_buffer, size[0])[:]
+        finally:
+            mvp.lib.free(c_buffer)
+
+    def __reduce__(self):
+        return (self.__class__.from_bytes, (self.to_bytes(), ))
+
+    def _check_writable(self):
+        if self.read_only:
+            raise ValueError("Snapshots are read-only.")
+
+    def snapshot(self):
+        """
+        Returns a read-only `Tree` of the current points.
+
+        Taking a snapshot is O(1): it shares the nodes and points of the
+        tree. Later `add` and `optimize` calls copy the nodes they change
+        (and the points they move) along the path from the root instead
+        of changing them in place, so the snapshot returns the same
+        results while the tree keeps accepting points. Its old nodes and
+        points are freed along with the last snapshot using them.
+
+        Searching a snapshot never waits for a write to the tree. A
+        snapshot runs one search at a time, so give each reader thread
+        its own snapshot.
+
+        """
+        with self._lock:
+            c_obj = mvp.lib.mvptree_snapshot(self._c_obj)
+        if c_obj == mvp.ffi.NULL:
+            raise MemoryError("Can't allocate the snapshot.")
+        snapshot = self.__class__(c_obj=c_obj)
+        snapshot.read_only = True
+        return snapshot
 
     def add(self, point):
         """
         Add a point or a list of points to the tree.
 
-        Only new points will be added to the tree.
+        Only new points will be added to the tree. If the tree has a
+        delta log the new points are appended to it.
 
         """
-        if isinstance(point, Point):
+        self._check_writable()
+
+        if isinstance(point, (Point, Match)):
             pointlist = [point]
         elif isinstance(point, collections.Iterable) and \
-                all(isinstance(p, Point) for p in point):
+                all(isinstance(p, (Point, Match)) for p in point):
             pointlist = point
         else:
             raise TypeError("Must be a point or a list of points.")
         
-        tree_points = set()
+        with self._lock:
+            tree_points = set()
+
+            for p in pointlist:
+                if not self.exists(p):
+                    tree_points.add(Point(p.point_id, p.data, tag=p.tag,
+                                          owned_memory=False))
 
-        for p in pointlist:
-            if not self.exists(p):
-                tree_points.add(Point(p.point_id, p.data, owned_memory=False))
+            if not tree_points:
+                return False
 
-        if tree_points:
             c_points = mvp.ffi.new('MVPDP *[%d]' % len(tree_points))
 
             for idx, p in enumerate(tree_points):
@@ -241,9 +725,111 @@ class Tree:
                 error[0] = mvp.lib.mvptree_add(self._c_obj,
                                                c_points,
                                                len(tree_points))
+
+            if self._journal is not None:
+                self._append_journal(tree_points)
+
+            self._inserted_since_optimize += len(tree_points)
+            if self.auto_optimize is not None and \
+                    self._inserted_since_optimize >= self.auto_optimize:
+                self.optimize()
             return True
-        else:
-            return False
+
+    def _stats(self):
+        c_stats = mvp.ffi.new("MVPStats *")
+        with self._lock, mvp_errors() as error:
+            error[0] = mvp.lib.mvptree_stats(self._c_obj, c_stats)
+        return c_stats
+
+    @staticmethod
+    def _summary(c_stats, leafcap):
+        nbleaf = c_stats.nbleaf
+        return {'depth': c_stats.depth,
+                'internal_nodes': c_stats.nbinternal,
+                'leaf_nodes': nbleaf,
+                'points': c_stats.nbpoints,
+                'empty_slots': c_stats.nbempty,
+                'leaf_fill': (c_stats.nbleafpoints / (nbleaf * leafcap)
+                              if nbleaf else 0.0)}
+
+    def stats(self):
+        """
+        Returns the shape of the tree as a dict.
+
+        """
+        return self._summary(self._stats(), self.leafcap)
+
+    def describe(self):
+        """
+        Returns the `stats` of the tree along with:
+
+        * `leaf_fill_histogram`: number of leaves by fill factor, in
+          tenths of `leafcap` (full leaves are in the last bin).
+        * `levels`: for each depth holding internal nodes, root first,
+          their number and the `min`, `max` and `mean` of their `m1`
+          and `m2` split values.
+        * `bytes`: memory used by the `internal` nodes, the `leaf`
+          nodes, the `points` and the `total`.
+
+        Everything is computed in a single pass over the tree.
+
+        """
+        c_stats = self._stats()
+        description = self._summary(c_stats, self.leafcap)
+        description['leaf_fill_histogram'] = list(c_stats.leaffill)
+
+        nbm1 = self.branchfactor - 1
+        nbm2 = nbm1 * self.branchfactor
+        levels = []
+        for depth in range(min(c_stats.depth, mvp.lib.MVP_STATLEVELS)):
+            level = c_stats.levels[depth]
+            if level.nbinternal:
+                levels.append({
+                    'depth': depth + 1,
+                    'internal_nodes': level.nbinternal,
+                    'm1': {'min': level.m1min,
+                           'max': level.m1max,
+                           'mean': level.m1sum / (level.nbinternal * nbm1)},
+                    'm2': {'min': level.m2min,
+                           'max': level.m2max,
+                           'mean': level.m2sum / (level.nbinternal * nbm2)}})
+        description['levels'] = levels
+
+        description['bytes'] = {
+            'internal': c_stats.internalbytes,
+            'leaf': c_stats.leafbytes,
+            'points': c_stats.pointbytes,
+            'total': (c_stats.internalbytes + c_stats.leafbytes +
+                      c_stats.pointbytes)}
+        return description
+
+    def optimize(self, skew=2.0):
+        """
+        Rebalance the tree after many incremental inserts.
+
+        Every subtree where a child holds more than `skew` times its
+        share of the points is rebuilt with fresh vantage points and
+        splits, which takes O(n**2) distances for n points like the
+        initial build. Query results are unchanged. The internal nodes
+        shared with a `snapshot` are copied.
+
+        Returns a dict with the number of `rebuilt` subtrees and the
+        `before` and `after` stats.
+
+        """
+        self._check_writable()
+
+        with self._lock:
+            before = self.stats()
+            nbrebuilt = mvp.ffi.new("unsigned int *")
+            with mvp_errors() as error:
+                error[0] = mvp.lib.mvptree_optimize(self._c_obj, skew,
+                                                    nbrebuilt)
+
+            self._inserted_since_optimize = 0
+            return {'rebuilt': nbrebuilt[0],
+                    'before': before,
+                    'after': self.stats()}
 
     def get(self, point):
         """
@@ -267,34 +853,152 @@ class Tree:
         else:
             return True
 
-    def filter(self, data, radius, limit=65535):
+    def filter(self, data, radius, limit=65535, allowed_ids=None, tags=None,
+               return_distances=False):
         """
         Retrieve `limit` points from the tree at distance less or equal
         to `threshold` from `data`.
 
-        This is a generator.
+        With `allowed_ids` (an iterable of ids or an `IdSet`) only the
+        points with one of these ids are retrieved, and with `tags` only
+        the points with one of these tags. Both are checked in the C
+        search, rejected points never reach Python nor count against
+        `limit`.
+
+        This is a generator of `Match` objects, or of `(distance, Match)`
+        with `return_distances=True`. The distances are the ones
+        computed by the search.
+
+        """
+        matches = self.results(data, radius, limit, allowed_ids, tags,
+                               return_distances)
+        if return_distances:
+            for match in matches:
+                yield match.distance, match
+        else:
+            yield from matches
+
+    def filter_tiers(self, data, radii, limit=65535, allowed_ids=None,
+                     tags=None):
+        """
+        Classify the points around `data` by distance in a single search.
+
+        Returns a list with, for each radius of `radii`, the list of
+        `Match` whose distance is at most that radius and more than the
+        next smaller radius, e.g. `radii=[0, 4, 10]` gives the exact,
+        near and similar matches. The matches have their `distance`.
+        `limit`, `allowed_ids` and `tags` apply to the search with the
+        largest radius, as in `filter`.
+
+        """
+        radii = list(radii)
+        if not radii:
+            return []
+
+        ordered = sorted(range(len(radii)), key=lambda i: radii[i])
+        bounds = [radii[i] for i in ordered]
+        tiers = [[] for _ in radii]
+        for match in self.results(data, bounds[-1], limit, allowed_ids,
+                                  tags, return_distances=True):
+            tier = bisect.bisect_left(bounds, match.distance)
+            tiers[ordered[tier]].append(match)
+        return tiers
+
+    def nearest(self, data, k=1, max_radius=None, allowed_ids=None,
+                tags=None):
+        """
+        Returns the `k` points closest to `data` as a list of
+        `(distance, Match)`, closest first.
+
+        The tree is searched with a growing radius (0, 1, 2, 4...) until
+        `k` points are found or the radius reaches `max_radius`, by
+        default the largest distance between data of the length of
+        `data`. When a radius holds more points than a search returns,
+        the radii between it and the previous one are bisected. Fewer
+        than `k` points are returned if there are not enough within
+        `max_radius`. `allowed_ids` and `tags` are applied like in
+        `filter`.
+
+        """
+        if k < 1:
+            raise ValueError("k must be at least 1.")
+        if max_radius is None:
+            max_radius = 8 * len(data)
+        if allowed_ids is not None and not isinstance(allowed_ids, IdSet):
+            allowed_ids = IdSet(allowed_ids)
+
+        # lower has fewer than k points, upper more than limit
+        radius, lower, upper, limit = 0, 0, None, max(65535, k + 1)
+        while True:
+            try:
+                matches = self.results(data, radius, limit,
+                                       allowed_ids=allowed_ids, tags=tags,
+                                       return_distances=True)
+            except RuntimeError as exc:
+                if exc.args[0] != MVPError.MVP_KNEARESTCAP:
+                    raise
+                upper = radius
+            else:
+                if len(matches) >= k or radius >= max_radius:
+                    break
+                lower = radius
+            if upper is None:
+                radius = min(radius * 2 or 1, max_radius)
+            elif upper - lower > 1:
+                radius = (lower + upper) // 2
+            else:
+                radius, limit = upper, limit * 2
+
+        found = sorted(((m.distance, m) for m in matches),
+                       key=lambda found: found[0])
+        return found[:k]
+
+    def results(self, data, radius, limit=65535, allowed_ids=None,
+                tags=None, return_distances=False):
+        """
+        Like `filter` but returns all the matches at once as a
+        `ResultSet`. With `return_distances=True` the matches have
+        their `distance`.
 
         """
+        c_filter = mvp.ffi.NULL
+        if allowed_ids is not None or tags is not None:
+            c_filter = mvp.ffi.new("MVPFilter *")
+            if allowed_ids is not None:
+                if not isinstance(allowed_ids, IdSet):
+                    allowed_ids = IdSet(allowed_ids)
+                c_filter.ids = allowed_ids._c_obj
+            if tags is not None:
+                c_tags = mvp.ffi.new("unsigned int[]", sorted(set(tags)))
+                if not len(c_tags):
+                    return ResultSet(mvp.ffi.NULL, 0, self)
+                c_filter.tags = c_tags
+                c_filter.nbtags = len(c_tags)
+
         p = Point(b'', data)
         nbresults = mvp.ffi.new("unsigned int *")
+        distances = (mvp.ffi.new("float **") if return_distances
+                     else mvp.ffi.NULL)
 
         try:
-            with mvp_errors() as error:
-                res = mvp.lib.mvptree_retrieve(self._c_obj,
-                                               p._c_obj,
-                                               limit,
-                                               radius,
-                                               nbresults,
-                                               error)
-
+            with self._lock, mvp_errors() as error:
+                res = mvp.lib.mvptree_retrieve_distances(self._c_obj,
+                                                         p._c_obj,
+                                                         limit,
+                                                         radius,
+                                                         c_filter,
+                                                         distances,
+                                                         nbresults,
+                                                         error)
+                if res != mvp.ffi.NULL:
+                    res = ResultSet(res, nbresults[0], self,
+                                    distances[0] if return_distances
+                                    else mvp.ffi.NULL)
         except ValueError:  # EmptyTree
-            pass
+            return ResultSet(mvp.ffi.NULL, 0, self)
         else:
-            for i in range(nbresults[0]):
-                yield Point(c_obj=res[i], owned_memory=False, tree=self)
-        finally:
-            if res is not mvp.ffi.NULL:  # pragma: no branch
-                mvp.lib.free(res)
+            return res
 
 
-__all__ = ['Point', 'Tree']
+__all__ = ['IdSet', 'MVPDistType', 'MVPFormat', 'Match', 'Point',
+           'ResultSet', 'Tree', 'TuningResult', 'tune']
@@ -0,0 +1,322 @@
+"""
+Command line interface.
+
+    python -m pymvptree build TREE INPUT... [--format csv|hex|raw]
+                                            [--file-format 1|2] [--compress]
+    python -m pymvptree query TREE INPUT... --radius R [--output tsv|binary]
+    python -m pymvptree stats TREE
+    python -m pymvptree bench TREE INPUT... --radius R
+    python -m pymvptree serve TREE (--socket PATH | --port PORT)
+
+Input formats (`-` reads from standard input):
+
+* `csv`: `id,hash[,tag]` rows, the hash in hexadecimal.
+* `hex`: one hexadecimal hash per line, optionally preceded by an id
+  and a tab. Blank lines are skipped. Without id the position of the
+  hash among those of all the inputs (from 0) is used.
+* `raw`: consecutive binary hashes of `--hash-size` bytes, identified
+  by their position among those of all the inputs (from 0).
+
+Inputs are read in chunks of `--chunk-size` points, so memory use does
+not depend on the input size.
+
+The `tsv` query output has a line per match with the query id, the
+match id and hash, and with `--distances` their distance. The `binary`
+query output is, for every query, the little endian unsigned 32 bit
+query number and number of matches, followed by each match as a 32 bit
+length and the UTF-8 id, then a 32 bit length and the hash, and with
+`--distances` the distance as a 32 bit float. Like in the `tsv` output
+the id is written with `str`, so the ids `1` and `'1'` look the same.
+
+A query with more than `--limit` matches stops the command with an
+error.
+
+`serve` answers the queries of `pymvptree.server.Client` until it is
+interrupted.
+
+"""
+from itertools import islice
+import argparse
+import csv
+import json
+import os
+import struct
+import sys
+import time
+
+from pymvptree import (MVP_BRANCHFACTOR, MVP_LEAFCAP, MVP_PATHLENGTH,
+                       MVPDistType, MVPError, Point, Tree)
+
+
+FORMATS = ('csv', 'hex', 'raw')
+OUTPUTS = ('tsv', 'binary')
+
+QUERY_HEADER = struct.Struct('<II')
+FIELD_LENGTH = struct.Struct('<I')
+DISTANCE = struct.Struct('<f')
+
+
+def _open(path, binary=False):
+    if path == '-':
+        return sys.stdin.buffer if binary else sys.stdin
+    return open(path, 'rb') if binary else open(path, newline='')
+
+
+def read_points(paths, fmt='hex', hash_size=8, int_ids=False):
+    """
+    Generates the `Point` of the input files, see the module docs.
+
+    """
+    def make_id(value):
+        return int(value) if int_ids else value
+
+    position = 0
+    for path in paths:
+        if fmt == 'raw':
+            stream = _open(path, binary=True)
+            try:
+                while True:
+                    data = stream.read(hash_size)
+                    if len(data) < hash_size:
+                        if data:
+                            raise ValueError(
+                                "%s: truncated hash at the end." % path)
+                        break
+                    yield Point(position, data)
+                    position += 1
+            finally:
+                if stream is not sys.stdin.buffer:
+                    stream.close()
+            continue
+
+        stream = _open(path)
+        try:
+            if fmt == 'csv':
+                for row in csv.reader(stream):
+                    if not row:
+                        continue
+                    tag = int(row[2]) if len(row) > 2 and row[2] else 0
+                    yield Point(make_id(row[0]), bytes.fromhex(row[1]),
+                                tag=tag)
+            else:
+                for line in stream:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    point_id, sep, hexhash = line.rpartition('\t')
+                    yield Point(make_id(point_id) if sep else position,
+                                bytes.fromhex(hexhash))
+                    position += 1
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+
+
+def chunks(iterable, size):
+    """
+    Generates lists of up to `size` items of `iterable`.
+
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _points(args):
+    return read_points(args.input, args.format, args.hash_size, args.int_ids)
+
+
+def _results(tree, point, args, **kwargs):
+    try:
+        return tree.results(point.data, args.radius, args.limit, **kwargs)
+    except RuntimeError as exc:
+        if exc.args[0] != MVPError.MVP_KNEARESTCAP:
+            raise
+        raise SystemExit("Query %s has more than --limit %d matches."
+                         % (point.point_id, args.limit))
+
+
+def build(args):
+    tree = Tree(branchfactor=args.branchfactor,
+                pathlength=args.pathlength,
+                leafcap=args.leafcap,
+                disttype=MVPDistType[args.disttype])
+
+    total = 0
+    for chunk in chunks(_points(args), args.chunk_size):
+        tree.add(chunk)
+        total += len(chunk)
+
+    if args.optimize:
+        tree.optimize()
+
+    file_format = args.file_format or (2 if args.compress else 1)
+    tree.to_file(args.tree, sync=not args.no_sync,
+                 format=file_format, compress=args.compress)
+    print("%d points written to %s" % (total, args.tree), file=sys.stderr)
+
+
+def query(args):
+    tree = Tree.from_file(args.tree)
+
+    if args.output == 'binary':
+        out = sys.stdout.buffer
+    else:
+        out = sys.stdout
+
+    for chunk in chunks(enumerate(_points(args)), args.chunk_size):
+        records = []
+        for number, point in chunk:
+            matches = _results(tree, point, args,
+                               return_distances=args.distances)
+            if args.output == 'binary':
+                records.append(QUERY_HEADER.pack(number, len(matches)))
+                for match in matches:
+                    match_id = str(match.point_id).encode('utf-8')
+                    records.append(FIELD_LENGTH.pack(len(match_id)))
+                    records.append(match_id)
+                    records.append(FIELD_LENGTH.pack(len(match.data)))
+                    records.append(match.data)
+                    if args.distances:
+                        records.append(DISTANCE.pack(match.distance))
+            else:
+                for match in matches:
+                    fields = [point.point_id, match.point_id,
+                              match.data.hex()]
+                    if args.distances:
+                        fields.append('%g' % match.distance)
+                    records.append('\t'.join(map(str, fields)) + '\n')
+        out.write((b'' if args.output == 'binary' else '').join(records))
+    out.flush()
+
+
+def stats(args):
+    tree = Tree.from_file(args.tree)
+    description = tree.describe()
+    description['file_size'] = os.path.getsize(args.tree)
+    json.dump(description, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+
+def bench(args):
+    tree = Tree.from_file(args.tree)
+
+    latencies = []
+    distances = matches = 0
+    for chunk in chunks(_points(args), args.chunk_size):
+        for point in chunk:
+            start = time.perf_counter()
+            found = _results(tree, point, args)
+            latencies.append(time.perf_counter() - start)
+            distances += tree.last_search_distances
+            matches += len(found)
+
+    if not latencies:
+        raise SystemExit("No queries in the input.")
+
+    latencies.sort()
+    total = sum(latencies)
+    nbqueries = len(latencies)
+    print("queries          %d" % nbqueries)
+    print("queries/s        %.1f" % (nbqueries / total if total else 0))
+    print("latency p50 (ms) %.3f" % (latencies[nbqueries // 2] * 1000))
+    print("latency p99 (ms) %.3f" %
+          (latencies[min(nbqueries - 1, nbqueries * 99 // 100)] * 1000))
+    print("distances/query  %.1f" % (distances / nbqueries))
+    print("matches/query    %.1f" % (matches / nbqueries))
+
+
+def serve(args):
+    from pymvptree.server import Server
+
+    if (args.socket is None) == (args.port is None):
+        raise SystemExit("Give either --socket or --port.")
+    address = args.socket if args.socket else (args.host, args.port)
+
+    server = Server(Tree.from_file(args.tree), address,
+                    batch_size=args.batch_size, workers=args.workers)
+    print("serving %s on %s" % (args.tree, server.address), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+def parser():
+    main_parser = argparse.ArgumentParser(
+        prog='python -m pymvptree',
+        description="Build and query MVP tree files.")
+    commands = main_parser.add_subparsers(dest='command')
+    commands.required = True
+
+    def command(name, func, help, inputs=True):
+        cmd = commands.add_parser(name, help=help)
+        cmd.set_defaults(func=func)
+        cmd.add_argument('tree', help="tree file")
+        if inputs:
+            cmd.add_argument('input', nargs='+', help="input files, - for stdin")
+            cmd.add_argument('--format', choices=FORMATS, default='hex')
+            cmd.add_argument('--hash-size', type=int, default=8,
+                             help="bytes per hash of the raw format")
+            cmd.add_argument('--int-ids', action='store_true',
+                             help="parse the ids as integers")
+            cmd.add_argument('--chunk-size', type=int, default=10000,
+                             help="points read at once")
+        return cmd
+
+    cmd = command('build', build, "build a tree file from hashes")
+    cmd.add_argument('--branchfactor', type=int, default=MVP_BRANCHFACTOR)
+    cmd.add_argument('--pathlength', type=int, default=MVP_PATHLENGTH)
+    cmd.add_argument('--leafcap', type=int, default=MVP_LEAFCAP)
+    cmd.add_argument('--disttype', choices=[t.name for t in MVPDistType],
+                     default=MVPDistType.MVP_FLOATDIST.name)
+    cmd.add_argument('--optimize', action='store_true',
+                     help="rebalance the tree before writing it")
+    cmd.add_argument('--no-sync', action='store_true',
+                     help="do not flush the file to stable storage")
+    cmd.add_argument('--file-format', type=int, choices=(1, 2),
+                     help="format of the tree file, 1 unless compressed")
+    cmd.add_argument('--compress', action='store_true',
+                     help="compress the tree file (format 2 only)")
+
+    for name, func, help in (('query', query, "look up hashes in a tree"),
+                             ('bench', bench, "measure query performance")):
+        cmd = command(name, func, help)
+        cmd.add_argument('--radius', type=float, required=True)
+        cmd.add_argument('--limit', type=int, default=65535)
+        if name == 'query':
+            cmd.add_argument('--output', choices=OUTPUTS, default='tsv')
+            cmd.add_argument('--distances', action='store_true',
+                             help="output the distance of each match")
+
+    command('stats', stats, "print the shape and size of a tree",
+            inputs=False)
+
+    cmd = command('serve', serve, "serve a tree over a socket", inputs=False)
+    cmd.add_argument('--socket', help="path of the Unix domain socket")
+    cmd.add_argument('--host', default='127.0.0.1',
+                     help="TCP address to listen on")
+    cmd.add_argument('--port', type=int, help="TCP port to listen on")
+    cmd.add_argument('--batch-size', type=int, default=64,
+                     help="largest number of requests run together")
+    cmd.add_argument('--workers', type=int, default=1,
+                     help="threads running the requests")
+
+    return main_parser
+
+
+def main(argv=None):
+    main_parser = parser()
+    args = main_parser.parse_args(argv)
+    if getattr(args, 'compress', False) and args.file_format == 1:
+        main_parser.error("--compress needs --file-format 2")
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -12,7 +12,7 @@ ffi.set_source("_c_mvptree",
     #include "mvptree.h"
     #include "mvpwrapper.h"
     """,
-    libraries=["m"],
+    libraries=["m", "z"],
     include_dirs=[HERE],
     sources=SOURCES,
     ## Enable debug, disable optimizations.
@@ -29,12 +29,31 @@ typedef enum mvp_datatype_t {
     MVP_UINT64ARRAY = 8 
 } MVPDataType;
 
+typedef enum mvp_disttype_t {
+    MVP_UINT8DIST = 1,
+    MVP_UINT16DIST = 2,
+    MVP_FLOATDIST = 4
+} MVPDistType;
+
+typedef enum mvp_format_t {
+    MVP_FORMAT1 = 1,
+    MVP_FORMAT2 = 2,
+    MVP_FORMAT2_ZLIB = 3
+} MVPFormat;
+
+typedef enum mvp_metric_t {
+    MVP_METRIC_UNKNOWN = 0,
+    MVP_METRIC_HAMMING = 1
+} MVPMetric;
+
 typedef struct mvp_datapoint_t {
     char *id;               /* null-terminated id string */
     void *data;             /* data for this data point */
-    float *path;            /* path of distances of data point from all vantage points down tree*/
+    void *path;             /* path of distances of data point from all vantage points down tree*/
     unsigned int datalen;   /* length of data in the type designated */    
     MVPDataType type;       /* type of data (the bitwidth of each data element) */
+    unsigned int tag;       /* user tag, checked by MVPFilter */
+    unsigned int refs;      /* number of references */
 } MVPDP;
 
 typedef enum nodetype_t { 
@@ -44,16 +63,18 @@ typedef enum nodetype_t {
 
 typedef struct node_internal_t {
     NodeType type;
+    unsigned int refs;
     MVPDP *sv1, *sv2;
-    float *M1, *M2;
+    void *M1, *M2;
     void **child_nodes;
 } InternalNode;
 
 typedef struct node_leaf_t {
     NodeType type;
+    unsigned int refs;
     MVPDP *sv1, *sv2;
     MVPDP **points;
-    float *d1, *d2;
+    void *d1, *d2;
     unsigned int nbpoints;
 } LeafNode;
    
@@ -63,22 +84,68 @@ typedef union node_t {
 } Node;
 
 typedef float (*CmpFunc)(MVPDP *pointA, MVPDP *pointB);
+typedef void (*MVPFreeFunc)(void *ptr);
 
 typedef long off_t;
 
+typedef struct mvp_idset_t {
+    char **slots;
+    unsigned int size;
+    unsigned int nbids;
+} MVPIdSet;
+
+typedef struct mvp_filter_t {
+    MVPIdSet *ids;
+    unsigned int *tags;
+    unsigned int nbtags;
+} MVPFilter;
+
+#define MVP_FILLBINS 10
+#define MVP_STATLEVELS 32
+
+typedef struct mvp_levelstats_t {
+    unsigned int nbinternal;
+    float m1min, m1max;
+    double m1sum;
+    float m2min, m2max;
+    double m2sum;
+} MVPLevelStats;
+
+typedef struct mvp_stats_t {
+    unsigned int depth;
+    unsigned int nbinternal;
+    unsigned int nbleaf;
+    unsigned int nbpoints;
+    unsigned int nbleafpoints;
+    unsigned int nbempty;
+    unsigned int leaffill[10];
+    MVPLevelStats levels[32];
+    size_t internalbytes;
+    size_t leafbytes;
+    size_t pointbytes;
+} MVPStats;
+
 typedef struct mvptree_t {
     int branchfactor;
     int pathlength;
     int leafcap;
     int fd;
     int k;
+    unsigned long nbdist;
+    const MVPFilter *filter;
+    float *distances;
+    int version;
+    MVPFormat format;
+    MVPMetric metric;
     MVPDataType datatype;
+    MVPDistType disttype;
     off_t pos;
     off_t size;
     off_t pgsize;
     char *buf;
     Node *node;
     CmpFunc dist;
+    MVPFreeFunc free_func;
 } MVPTree;
 
 /* error codes */
@@ -110,6 +177,8 @@ typedef enum mvp_error_t {
     MVP_BADDISTVAL,         /* val from distance function either NaN or less than 0 */
     MVP_FILENOTFOUND,       /* file not found */
     MVP_UNRECOGNIZED,       /* unrecognized node */
+    MVP_DISTRANGE,          /* distance not representable in the tree's distance type */
+    MVP_FILECORRUPT,        /* serialized tree is truncated or damaged */
 } MVPError;
 
 const char* mvp_errstr(MVPError err);
@@ -123,14 +192,32 @@ void rmpoint(MVPDP *point);
 MVPTree *mktree(unsigned int bf, unsigned int p, unsigned int k);
 void rmtree(MVPTree *tree);
 
+void retain_results(MVPDP **results, unsigned int nbresults);
+void rmresults(MVPDP **results, unsigned int nbresults);
+
 void printpoint(MVPDP* point);
 void printtree(MVPTree *tree);
 
 MVPTree *load(char *filename, MVPError *err);
-void save(char *filename, MVPTree *tree, MVPError *err);
+void save(char *filename, MVPTree *tree, int sync, MVPFormat format, MVPError *err);
+
+MVPTree *loads(char *buffer, size_t size, MVPError *err);
+char *dumps(MVPTree *tree, size_t *size, MVPFormat format, MVPError *err);
 
 MVPError mvptree_add(MVPTree *tree, MVPDP **points, unsigned int nbpoints);
+MVPError mvptree_set_disttype(MVPTree *tree, MVPDistType disttype);
+MVPError mvptree_set_format(MVPTree *tree, MVPFormat format);
+MVPError mvptree_stats(MVPTree *tree, MVPStats *stats);
+MVPError mvptree_optimize(MVPTree *tree, float skew, unsigned int *nbrebuilt);
+MVPTree* mvptree_snapshot(MVPTree *tree);
 MVPDP** mvptree_retrieve(MVPTree *tree, MVPDP *target, unsigned int knearest, float radius,unsigned int *nbresults, MVPError *error);
+MVPDP** mvptree_retrieve_filtered(MVPTree *tree, MVPDP *target, unsigned int knearest, float radius, const MVPFilter *filter, unsigned int *nbresults, MVPError *error);
+MVPDP** mvptree_retrieve_distances(MVPTree *tree, MVPDP *target, unsigned int knearest, float radius, const MVPFilter *filter, float **distances, unsigned int *nbresults, MVPError *error);
+
+MVPIdSet* mvp_idset_alloc(unsigned int nbids);
+MVPError mvp_idset_add(MVPIdSet *set, const char *id);
+int mvp_idset_contains(const MVPIdSet *set, const char *id);
+void mvp_idset_free(MVPIdSet *set);
 
 void free(void *ptr);
 
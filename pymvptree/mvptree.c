@@ -25,21 +25,36 @@
 #include <stdio.h>
 #include <string.h>
 #include <stdint.h>
+#include <limits.h>
 #include <math.h>
 #include <sys/types.h>
 #include <sys/stat.h>
 #include <sys/mman.h>
 #include <fcntl.h>
 #include <unistd.h>
+#include <errno.h>
+#include <zlib.h>
 #include "mvptree.h"
 
 #define HEADER_SIZE 32
 
+/* largest pathlength accepted from a file header, far above any tree depth */
+#define MAX_PATHLENGTH 0xffff
+
 #define _FILE_OFFSET_BITS 64
 #define _LARGEFILE64_SOURCE
 
 const char *tag = "pymvptree";
-const int version = 0x02000000;
+const int version = 0x03000000;
+
+/* MVP_FORMAT1 files: float distance trees without datapoint tags keep       */
+/* UNTAGGED_VERSION so that readers older than the tags can open them. Trees  */
+/* with integer distances always get COMPACT_VERSION, which the readers that  */
+/* check the version and predate it reject instead of reading floats.        */
+#define UNTAGGED_VERSION 0x02000000
+#define FORMAT1_VERSION  0x02010000
+#define COMPACT_VERSION  0x02020000
+#define FORMAT2_VERSION  0x03000000
 
 const char *error_msgs[] = {
     "no error",
@@ -67,7 +82,9 @@ const char *error_msgs[] = {
     "unable to calculate split points",
     "distance value either NaN or less than zero",
     "could not open file",
-    "unrecognized node" 
+    "unrecognized node",
+    "distance out of range for distance type",
+    "corrupt or truncated data"
 };
 
 const char* mvp_errstr(MVPError err){
@@ -81,6 +98,8 @@ MVPDP* dp_alloc(MVPDataType type){
     newdp->datalen = 0;
     newdp->type = type;
     newdp->path = NULL;
+    newdp->tag = 0;
+    newdp->refs = 1;
     return newdp;
 }
 
@@ -99,6 +118,48 @@ void dp_free(MVPDP *dp, MVPFreeFunc free_func){
     }
 }
 
+/* Reference counts are changed atomically: snapshots read from other threads */
+/* release their references while the live tree is written to.              */
+static void ref_inc(unsigned int *refs){
+    __atomic_add_fetch(refs, 1, __ATOMIC_RELAXED);
+}
+
+/* 1 if the last reference was dropped */
+static int ref_dec(unsigned int *refs){
+    return __atomic_sub_fetch(refs, 1, __ATOMIC_ACQ_REL) == 0;
+}
+
+static int is_shared(unsigned int *refs){
+    return __atomic_load_n(refs, __ATOMIC_ACQUIRE) > 1;
+}
+
+void dp_retain(MVPDP *dp){
+    if (dp) ref_inc(&dp->refs);
+}
+
+void dp_release(MVPDP *dp, MVPFreeFunc free_func){
+    if (dp && ref_dec(&dp->refs)) dp_free(dp, free_func);
+}
+
+/* private copy of a datapoint, to rewrite its path */
+static MVPDP* dp_copy(MVPTree *tree, const MVPDP *dp){
+    size_t pathsize = tree->pathlength*tree->disttype;
+    MVPDP *copy = dp_alloc(dp->type);
+    if (copy == NULL) return NULL;
+    copy->datalen = dp->datalen;
+    copy->tag = dp->tag;
+    copy->id = (dp->id) ? strdup(dp->id) : NULL;
+    copy->data = malloc(dp->datalen*dp->type);
+    copy->path = (dp->path) ? malloc(pathsize) : NULL;
+    if ((dp->id && !copy->id) || (dp->datalen && !copy->data) || (dp->path && !copy->path)){
+        dp_free(copy, free);
+        return NULL;
+    }
+    memcpy(copy->data, dp->data, dp->datalen*dp->type);
+    if (dp->path) memcpy(copy->path, dp->path, pathsize);
+    return copy;
+}
+
 MVPTree* mvptree_alloc(MVPTree *tree, CmpFunc distance,unsigned int bf,unsigned int p,unsigned int k){
     if (distance == NULL) {
         return NULL;
@@ -117,10 +178,18 @@ MVPTree* mvptree_alloc(MVPTree *tree, CmpFunc distance,unsigned int bf,unsigned
     retTree->leafcap      = k;
     retTree->dist         = distance;
     retTree->datatype     = 0;
+    retTree->disttype     = MVP_FLOATDIST;
     retTree->node         = NULL;
     retTree->fd           = 0;
     retTree->k            = 0;
+    retTree->nbdist       = 0;
+    retTree->filter       = NULL;
+    retTree->distances    = NULL;
+    retTree->version      = version;
+    retTree->format       = MVP_FORMAT1;
+    retTree->metric       = MVP_METRIC_UNKNOWN;
     retTree->size         = 0;
+    retTree->free_func    = NULL;
     retTree->pos          = 0;
     retTree->buf          = NULL;
     retTree->pgsize       = sysconf(_SC_PAGESIZE);
@@ -128,33 +197,106 @@ MVPTree* mvptree_alloc(MVPTree *tree, CmpFunc distance,unsigned int bf,unsigned
     return retTree;
 }
 
+MVPError mvptree_set_disttype(MVPTree *tree, MVPDistType disttype){
+    if (!tree || tree->node) return MVP_ARGERR;
+    if (disttype != MVP_UINT8DIST && disttype != MVP_UINT16DIST && disttype != MVP_FLOATDIST){
+        return MVP_ARGERR;
+    }
+    tree->disttype = disttype;
+    return MVP_SUCCESS;
+}
+
+static int valid_format(MVPFormat format){
+    return format == MVP_FORMAT1 || format == MVP_FORMAT2 || format == MVP_FORMAT2_ZLIB;
+}
+
+MVPError mvptree_set_format(MVPTree *tree, MVPFormat format){
+    if (!tree) return MVP_ARGERR;
+    if (!valid_format(format)) return MVP_ARGERR;
+    tree->format = format;
+    return MVP_SUCCESS;
+}
+
 /* custom isnan function */
 static int is_nan(float x){
     float var = x;
     return (var != var) ? 1 : 0;
 }
 
-static Node* create_leaf(unsigned int leafcap){
+/* Distance arrays (paths, d1/d2, M1/M2) hold elements of the tree's MVPDistType, */
+/* whose value is the element width in bytes.                                     */
+
+#define DIST_PTR(arr, i, t) ((void*)((char*)(arr) + (size_t)(i)*(t)))
+
+static inline float dist_get(const void *arr, unsigned int i, MVPDistType t){
+    switch (t){
+        case MVP_UINT8DIST:  return (float)((const uint8_t*)arr)[i];
+        case MVP_UINT16DIST: return (float)((const uint16_t*)arr)[i];
+        default:             return ((const float*)arr)[i];
+    }
+}
+
+/* store d into arr[i], return -1 if d is not representable in the distance type */
+static inline int dist_set(void *arr, unsigned int i, float d, MVPDistType t){
+    switch (t){
+        case MVP_UINT8DIST:
+            if (!(d >= 0.0f) || d > UINT8_MAX || d != (float)(uint8_t)d) return -1;
+            ((uint8_t*)arr)[i] = (uint8_t)d;
+            break;
+        case MVP_UINT16DIST:
+            if (!(d >= 0.0f) || d > UINT16_MAX || d != (float)(uint16_t)d) return -1;
+            ((uint16_t*)arr)[i] = (uint16_t)d;
+            break;
+        default:
+            ((float*)arr)[i] = d;
+    }
+    return 0;
+}
+
+/* return non-zero if d is representable in the distance type */
+static inline int dist_fits(float d, MVPDistType t){
+    float scratch;
+    return dist_set(&scratch, 0, d, t) == 0;
+}
+
+/* test center - radius <= arr[i] <= center + radius. Integer distance types */
+/* compare as integers, center being integral and radius truncated.          */
+static inline int dist_within(const void *arr, unsigned int i, float center, float radius, MVPDistType t){
+    switch (t){
+        case MVP_UINT8DIST:
+            return abs((int)center - (int)((const uint8_t*)arr)[i]) <= (int)radius;
+        case MVP_UINT16DIST:
+            return abs((int)center - (int)((const uint16_t*)arr)[i]) <= (int)radius;
+        default: {
+            float v = ((const float*)arr)[i];
+            return center - radius <= v && center + radius >= v;
+        }
+    }
+}
+
+static Node* create_leaf(unsigned int leafcap, MVPDistType disttype){
     Node *node = (Node*)malloc(sizeof(Node));
     node->leaf.sv1 = NULL;
     node->leaf.sv2 = NULL;
     node->leaf.points = (MVPDP**)calloc(leafcap,sizeof(MVPDP*));
-    node->leaf.d1 = (float*)calloc(leafcap,sizeof(float));
-    node->leaf.d2 = (float*)calloc(leafcap,sizeof(float));
+    node->leaf.d1 = calloc(leafcap,disttype);
+    node->leaf.d2 = calloc(leafcap,disttype);
     node->leaf.nbpoints = 0;
     node->leaf.type = LEAF_NODE;
+    node->leaf.refs = 1;
 
     return node;
 }
 
-static Node* create_internal(unsigned int bf){
+static Node* create_internal(unsigned int bf, MVPDistType disttype){
     Node *node = (Node*)malloc(sizeof(Node));
     node->internal.sv1 = NULL;
     node->internal.sv2 = NULL;
-    node->internal.M1 = (float*)calloc((bf-1),sizeof(float));
-    node->internal.M2 = (float*)calloc(bf,sizeof(float));
+    node->internal.M1 = calloc((bf-1),disttype);
+    node->internal.M2 = calloc((bf-1)*bf,disttype);
     node->internal.child_nodes = calloc(bf*bf,sizeof(Node*));
     node->internal.type = INTERNAL_NODE;
+    node->internal.refs = 1;
 
     return node;
 }
@@ -174,21 +316,23 @@ static void free_node(Node *node){
     }
 }
 
-static void _mvptree_clear(MVPTree *tree, Node *node, MVPFreeFunc free_func, int lvl){
-    if (!node) return;
+/* drop a reference to a node, freeing it along with the references it holds */
+/* to its children and datapoints when it was the last one                  */
+static void node_release(MVPTree *tree, Node *node, MVPFreeFunc free_func){
+    if (!node || !ref_dec(&node->leaf.refs)) return;
     if (node->internal.type == INTERNAL_NODE){
         int i, fanout = (tree->branchfactor)*(tree->branchfactor);
         for (i = 0;i < fanout;i++){
-            _mvptree_clear(tree, node->internal.child_nodes[i], free_func, lvl+1);
+            node_release(tree, node->internal.child_nodes[i], free_func);
         }
-        dp_free(node->internal.sv1, free_func);
-        dp_free(node->internal.sv2, free_func);
+        dp_release(node->internal.sv1, free_func);
+        dp_release(node->internal.sv2, free_func);
     } else {
-        dp_free(node->leaf.sv1, free_func);
-        dp_free(node->leaf.sv2, free_func);
+        dp_release(node->leaf.sv1, free_func);
+        dp_release(node->leaf.sv2, free_func);
         int i;
         for (i=0;i<node->leaf.nbpoints;i++){
-            dp_free(node->leaf.points[i], free_func);
+            dp_release(node->leaf.points[i], free_func);
         }
     }
     free_node(node);
@@ -196,7 +340,112 @@ static void _mvptree_clear(MVPTree *tree, Node *node, MVPFreeFunc free_func, int
 
 void mvptree_clear(MVPTree *tree, MVPFreeFunc free_func){
     if (!tree || !tree->node) return;
-    _mvptree_clear(tree, tree->node, free_func, 0);
+    node_release(tree, tree->node, free_func);
+    tree->node = NULL;
+}
+
+/* copy of a node sharing its children and datapoints */
+static Node* node_copy(MVPTree *tree, Node *node){
+    MVPDistType disttype = tree->disttype;
+    int i, bf = tree->branchfactor;
+    Node *copy;
+    if (node->leaf.type == LEAF_NODE){
+        if ((copy = create_leaf(tree->leafcap, disttype)) == NULL) return NULL;
+        memcpy(copy->leaf.points, node->leaf.points, tree->leafcap*sizeof(MVPDP*));
+        memcpy(copy->leaf.d1, node->leaf.d1, tree->leafcap*disttype);
+        memcpy(copy->leaf.d2, node->leaf.d2, tree->leafcap*disttype);
+        copy->leaf.nbpoints = node->leaf.nbpoints;
+        for (i=0;i<node->leaf.nbpoints;i++){
+            dp_retain(node->leaf.points[i]);
+        }
+    } else {
+        if ((copy = create_internal(bf, disttype)) == NULL) return NULL;
+        memcpy(copy->internal.M1, node->internal.M1, (bf-1)*disttype);
+        memcpy(copy->internal.M2, node->internal.M2, (bf-1)*bf*disttype);
+        memcpy(copy->internal.child_nodes, node->internal.child_nodes, bf*bf*sizeof(Node*));
+        for (i=0;i<bf*bf;i++){
+            Node *child = node->internal.child_nodes[i];
+            if (child) ref_inc(&child->leaf.refs);
+        }
+    }
+    /* sv1 and sv2 are at the same place in both node types */
+    copy->leaf.sv1 = node->leaf.sv1;
+    copy->leaf.sv2 = node->leaf.sv2;
+    dp_retain(copy->leaf.sv1);
+    dp_retain(copy->leaf.sv2);
+    return copy;
+}
+
+/* Node to change in place of node: node itself when the tree holds the only */
+/* reference to it, else a copy taking over that reference. The caller must  */
+/* own the parent of node, and store the result in its slot. NULL for error. */
+static Node* node_own(MVPTree *tree, Node *node){
+    if (node == NULL || !is_shared(&node->leaf.refs)) return node;
+    Node *copy = node_copy(tree, node);
+    if (copy == NULL) return NULL;
+    node_release(tree, node, tree->free_func);
+    return copy;
+}
+
+/* Prepare datapoints whose paths are about to be rewritten: those shared   */
+/* (or all with shared set) are replaced by copies in points, the originals */
+/* being kept in orig, NULL for the others. -1 if a copy fails.             */
+static int own_points(MVPTree *tree, MVPDP **points, MVPDP **orig, unsigned int nbpoints, const char *shared){
+    unsigned int i, j;
+    for (i=0;i<nbpoints;i++){
+        orig[i] = NULL;
+        if ((shared && shared[i]) || is_shared(&points[i]->refs)){
+            MVPDP *copy = dp_copy(tree, points[i]);
+            if (copy == NULL){
+                for (j=0;j<i;j++){
+                    if (orig[j]){
+                        dp_free(points[j], free);
+                        points[j] = orig[j];
+                    }
+                }
+                return -1;
+            }
+            orig[i] = points[i];
+            points[i] = copy;
+        }
+    }
+    return 0;
+}
+
+/* undo own_points() after a failed write */
+static void disown_points(MVPDP **points, MVPDP **orig, unsigned int nbpoints){
+    unsigned int i;
+    for (i=0;i<nbpoints;i++){
+        if (orig[i]){
+            dp_free(points[i], free);
+            points[i] = orig[i];
+        }
+    }
+}
+
+/* drop the references of the replaced nodes to the originals after a successful write */
+static void release_originals(MVPTree *tree, MVPDP **orig, unsigned int nbpoints){
+    unsigned int i;
+    for (i=0;i<nbpoints;i++){
+        dp_release(orig[i], tree->free_func);
+    }
+}
+
+MVPTree* mvptree_snapshot(MVPTree *tree){
+    if (!tree) return NULL;
+    MVPTree *snapshot = (MVPTree*)malloc(sizeof(MVPTree));
+    if (snapshot == NULL) return NULL;
+    memcpy(snapshot, tree, sizeof(MVPTree));
+    snapshot->fd = 0;
+    snapshot->k = 0;
+    snapshot->nbdist = 0;
+    snapshot->filter = NULL;
+    snapshot->distances = NULL;
+    snapshot->pos = 0;
+    snapshot->size = 0;
+    snapshot->buf = NULL;
+    if (snapshot->node) ref_inc(&snapshot->node->leaf.refs);
+    return snapshot;
 }
 
 /* Select the two points at maximum distance from each other using the dist metric.
@@ -227,7 +476,7 @@ static int select_vantage_points(MVPDP **points, unsigned int nb,int *sv1_pos, i
     return 0;
 }
 
-static int find_splits(MVPDP **points,unsigned int nb,MVPDP *vp,MVPTree *tree,float *M,unsigned int lengthM){
+static int find_splits(MVPDP **points,unsigned int nb,MVPDP *vp,MVPTree *tree,void *M,unsigned int lengthM){
     if (!points || nb == 0 || !M || lengthM == 0) return -1;
 
     CmpFunc distfunc = tree->dist;
@@ -261,7 +510,10 @@ static int find_splits(MVPDP **points,unsigned int nb,MVPDP *vp,MVPTree *tree,fl
         int index = (i+1)*nb/(lengthM+1);
         if (index <= 0) index = 0;
         if (index >= nb) index = nb-1;
-        M[i] = dist[index];
+        if (dist_set(M, i, dist[index], tree->disttype) < 0){
+            free(dist);
+            return -3;
+        }
     }
 
     free(dist);
@@ -272,13 +524,14 @@ static int find_splits(MVPDP **points,unsigned int nb,MVPDP *vp,MVPTree *tree,fl
    points[sv1_pos] and points[sv2_pos]. Use pivot[LengthM1] array as pivot points 
    to determine which bins.  */
 
-static MVPDP*** sort_points(MVPDP **points, unsigned int nbpoints, int sv1_pos, int sv2_pos, MVPDP *vp, MVPTree *tree, int **counts, float *pivots){
+static MVPDP*** sort_points(MVPDP **points, unsigned int nbpoints, int sv1_pos, int sv2_pos, MVPDP *vp, MVPTree *tree, int **counts, void *pivots){
 
     if (!points || !vp || !tree || !counts || !pivots || nbpoints == 0) return NULL;
 
     CmpFunc distfunc = tree->dist;
     int bf = tree->branchfactor;
     int lengthM1 = bf-1;
+    MVPDistType disttype = tree->disttype;
 
     MVPDP*** bins = (MVPDP***)malloc(bf*sizeof(MVPDP**));
     if (!bins) return NULL;
@@ -304,13 +557,13 @@ static MVPDP*** sort_points(MVPDP **points, unsigned int nbpoints, int sv1_pos,
             return NULL;
         }
         for (k = 0;k < lengthM1;k++){
-            if (d <= pivots[k]){
+            if (d <= dist_get(pivots, k, disttype)){
                 bins[k][(*counts)[k]] = points[i];
                 (*counts)[k]++;
                 break;
             }
         }
-        if (d > pivots[lengthM1-1]){
+        if (d > dist_get(pivots, lengthM1-1, disttype)){
             bins[lengthM1][(*counts)[lengthM1]] = points[i];
             (*counts)[lengthM1]++;
         }
@@ -334,13 +587,20 @@ static int find_distance_range_for_vp(MVPDP **points, unsigned int nbpoints, MVP
             return -2;
         }
         if (lvl < tree->pathlength){
-            points[i]->path[lvl] = d;
+            if (dist_set(points[i]->path, lvl, d, tree->disttype) < 0){
+                return -3;
+            }
         }
     }
 
     return error;
 }
 
+/* map the -3 return of the helpers above (distance not representable) to MVP_DISTRANGE */
+static MVPError range_error(int rc, MVPError err){
+    return (rc == -3) ? MVP_DISTRANGE : err;
+}
+
 static Node* _mvptree_add(MVPTree *tree, Node *node, MVPDP **points, unsigned int nbpoints,MVPError *error, int lvl){
     Node *new_node = node;
     if (nbpoints == 0) return new_node;
@@ -350,13 +610,14 @@ static Node* _mvptree_add(MVPTree *tree, Node *node, MVPDP **points, unsigned in
     }
     CmpFunc dist_fnc = tree->dist;
     int bf = tree->branchfactor, lengthM1 = bf-1;
-    float max_distance, min_distance;
+    MVPDistType disttype = tree->disttype;
+    int rc;
 
     if (new_node == NULL){ /* create new node */
         int sv1_pos, sv2_pos;
         if (nbpoints <= tree->leafcap + 2){
             /* create leaf node */
-            new_node = create_leaf(tree->leafcap);
+            new_node = create_leaf(tree->leafcap, disttype);
             if (!new_node) {
                 *error = MVP_NOLEAF;
                 return NULL;
@@ -371,15 +632,15 @@ static Node* _mvptree_add(MVPTree *tree, Node *node, MVPDP **points, unsigned in
             new_node->leaf.sv1 = (sv1_pos >= 0) ? points[sv1_pos] : NULL;
             new_node->leaf.sv2 = (sv2_pos >= 0) ? points[sv2_pos] : NULL;
 
-            if (find_distance_range_for_vp(points, nbpoints, new_node->leaf.sv1,tree,lvl)<0){
-                *error = MVP_NOSV1RANGE;
+            if ((rc = find_distance_range_for_vp(points, nbpoints, new_node->leaf.sv1,tree,lvl)) < 0){
+                *error = range_error(rc, MVP_NOSV1RANGE);
                 free_node(new_node);
                 return NULL;
             }
 
             if (new_node->leaf.sv2){
-                if (find_distance_range_for_vp(points,nbpoints,new_node->leaf.sv2,tree,lvl+1)<0){
-                    *error = MVP_NOSV2RANGE;
+                if ((rc = find_distance_range_for_vp(points,nbpoints,new_node->leaf.sv2,tree,lvl+1)) < 0){
+                    *error = range_error(rc, MVP_NOSV2RANGE);
                     free_node(new_node);
                     return NULL;
                 }
@@ -389,13 +650,19 @@ static Node* _mvptree_add(MVPTree *tree, Node *node, MVPDP **points, unsigned in
             int i, count = 0;
             for (i=0;i<nbpoints;i++){
                 if (i == sv1_pos || i == sv2_pos) continue;
-                new_node->leaf.d1[count] = dist_fnc(points[i], new_node->leaf.sv1);
-                new_node->leaf.d2[count] = dist_fnc(points[i], new_node->leaf.sv2);
+                float d1 = dist_fnc(points[i], new_node->leaf.sv1);
+                float d2 = (new_node->leaf.sv2) ? dist_fnc(points[i], new_node->leaf.sv2) : 0.0f;
+                if (dist_set(new_node->leaf.d1, count, d1, disttype) < 0 ||
+                    dist_set(new_node->leaf.d2, count, d2, disttype) < 0){
+                    *error = MVP_DISTRANGE;
+                    free_node(new_node);
+                    return NULL;
+                }
                 new_node->leaf.points[count++] = points[i];
             }
             new_node->leaf.nbpoints = count;
         } else { /* create internal node */
-            new_node = create_internal(tree->branchfactor);
+            new_node = create_internal(tree->branchfactor, disttype);
             if (!new_node){
                 *error = MVP_NOINTERNAL;
                 return NULL;
@@ -409,15 +676,15 @@ static Node* _mvptree_add(MVPTree *tree, Node *node, MVPDP **points, unsigned in
             new_node->internal.sv1 = (sv1_pos >= 0) ? points[sv1_pos] : NULL;
             new_node->internal.sv2 = (sv2_pos >= 0) ? points[sv2_pos] : NULL;
 
-            if (find_distance_range_for_vp(points,nbpoints,new_node->internal.sv1,tree,lvl)<0){
-                *error = MVP_NOSV1RANGE;
+            if ((rc = find_distance_range_for_vp(points,nbpoints,new_node->internal.sv1,tree,lvl)) < 0){
+                *error = range_error(rc, MVP_NOSV1RANGE);
                 free_node(new_node);
                 return NULL;
             }
 
-            if (find_splits(points, nbpoints, new_node->internal.sv1, tree,\
-                new_node->internal.M1,lengthM1) < 0){
-                *error = MVP_NOSPLITS;
+            if ((rc = find_splits(points, nbpoints, new_node->internal.sv1, tree,\
+                new_node->internal.M1,lengthM1)) < 0){
+                *error = range_error(rc, MVP_NOSPLITS);
             free_node(new_node);
             return NULL;
             }
@@ -433,8 +700,12 @@ static Node* _mvptree_add(MVPTree *tree, Node *node, MVPDP **points, unsigned in
 
             for (i=0 ;i < tree->branchfactor; i++){
                 /* for each bin */
-                if (find_distance_range_for_vp(bins[i], binlengths[i], new_node->internal.sv2,tree, lvl+1) < 0){
-                    *error = MVP_NOSV2RANGE;
+                if (binlengths[i] <= 0){
+                    /* no points: child nodes stay NULL, the M2 splits stay 0 */
+                    continue;
+                }
+                if ((rc = find_distance_range_for_vp(bins[i], binlengths[i], new_node->internal.sv2,tree, lvl+1)) < 0){
+                    *error = range_error(rc, MVP_NOSV2RANGE);
                     free_node(new_node);
                     for (j=0;j<tree->branchfactor;j++){free(bins[j]);}
                         free(bins);
@@ -442,8 +713,8 @@ static Node* _mvptree_add(MVPTree *tree, Node *node, MVPDP **points, unsigned in
                     return NULL;
                 }
 
-                if (find_splits(bins[i], binlengths[i], new_node->internal.sv2, tree,new_node->internal.M2 + i*lengthM1,lengthM1) < 0){
-                    *error = MVP_NOSPLITS;
+                if ((rc = find_splits(bins[i], binlengths[i], new_node->internal.sv2, tree,DIST_PTR(new_node->internal.M2, i*lengthM1, disttype),lengthM1)) < 0){
+                    *error = range_error(rc, MVP_NOSPLITS);
                     free_node(new_node);
                     for (j=0;j<tree->branchfactor;j++){free(bins[j]);}
                         free(bins);
@@ -453,7 +724,7 @@ static Node* _mvptree_add(MVPTree *tree, Node *node, MVPDP **points, unsigned in
 
                 int *bin2lengths = NULL;
                 MVPDP ***bins2 = sort_points(bins[i],binlengths[i],-1,-1,new_node->internal.sv2,\
-                    tree, &bin2lengths, new_node->internal.M2 + i*lengthM1);
+                    tree, &bin2lengths, DIST_PTR(new_node->internal.M2, i*lengthM1, disttype));
 
                 if (!bins2){
                     *error = MVP_NOSORT;
@@ -481,31 +752,65 @@ static Node* _mvptree_add(MVPTree *tree, Node *node, MVPDP **points, unsigned in
         }
     } else { /* node already exists */
 
+        /* path copying: a node shared with a snapshot is copied before it changes */
+        if ((new_node = node_own(tree, node)) == NULL){
+            *error = MVP_MEMALLOC;
+            return node;
+        }
+
         if (new_node->leaf.type == LEAF_NODE){
 
             if (new_node->leaf.nbpoints + nbpoints <= tree->leafcap){
 
                 /* add points into leaf - plenty of room */
-                if (find_distance_range_for_vp(points,nbpoints,new_node->leaf.sv1,tree,lvl)<0){
-                    *error = MVP_NOSV1RANGE;
+                MVPDP *sv2 = new_node->leaf.sv2 ? new_node->leaf.sv2 : points[0];
+                int first = (new_node->leaf.sv2 == NULL) ? 1 : 0;
+                if ((rc = find_distance_range_for_vp(points,nbpoints,new_node->leaf.sv1,tree,lvl)) < 0){
+                    *error = range_error(rc, MVP_NOSV1RANGE);
+                    return new_node;
+                }
+                if ((rc = find_distance_range_for_vp(points,nbpoints,sv2,tree,lvl+1)) < 0){
+                    *error = range_error(rc, MVP_NOSV2RANGE);
+                    return new_node;
+                }
+
+                /* compute all the distances first, so the leaf is unchanged on MVP_DISTRANGE;
+                   points already in the leaf have no distance to a new sv2 yet */
+                int nbold = new_node->leaf.nbpoints, nbnew = nbpoints - first, i;
+                int nbredo = first ? nbold : 0;
+                float *redo = (float*)malloc((nbredo + 2*nbnew + 1)*sizeof(float));
+                if (!redo){
+                    *error = MVP_MEMALLOC;
                     return new_node;
                 }
-                int pos = 0;
-                if (new_node->leaf.sv2 == NULL){
-                    new_node->leaf.sv2 = points[0];
-                    pos = 1;
+                float *d1 = redo + nbredo, *d2 = d1 + nbnew;
+                int fits = 1;
+                for (i=0;i<nbredo && fits;i++){
+                    redo[i] = tree->dist(new_node->leaf.points[i], sv2);
+                    fits = dist_fits(redo[i], disttype);
                 }
-                if (find_distance_range_for_vp(points,nbpoints,new_node->leaf.sv2,tree,lvl+1)<0){
-                    *error = MVP_NOSV2RANGE;
+                for (i=0;i<nbnew && fits;i++){
+                    d1[i] = tree->dist(points[first+i], new_node->leaf.sv1);
+                    d2[i] = tree->dist(points[first+i], sv2);
+                    fits = dist_fits(d1[i], disttype) && dist_fits(d2[i], disttype);
+                }
+                if (!fits){
+                    free(redo);
+                    *error = MVP_DISTRANGE;
                     return new_node;
-                }    
-                int count = new_node->leaf.nbpoints;
-                for (; pos < nbpoints;pos++){
-                    new_node->leaf.d1[count] = tree->dist(points[pos], new_node->leaf.sv1);
-                    new_node->leaf.d2[count] = tree->dist(points[pos], new_node->leaf.sv2);
-                    new_node->leaf.points[count++] = points[pos];
                 }
-                new_node->leaf.nbpoints = count;
+
+                new_node->leaf.sv2 = sv2;
+                for (i=0;i<nbredo;i++){
+                    dist_set(new_node->leaf.d2, i, redo[i], disttype);
+                }
+                for (i=0;i<nbnew;i++){
+                    dist_set(new_node->leaf.d1, nbold+i, d1[i], disttype);
+                    dist_set(new_node->leaf.d2, nbold+i, d2[i], disttype);
+                    new_node->leaf.points[nbold+i] = points[first+i];
+                }
+                new_node->leaf.nbpoints = nbold + nbnew;
+                free(redo);
             } else {
 
                 /* not enough room in current leaf - create new node */
@@ -514,7 +819,10 @@ static Node* _mvptree_add(MVPTree *tree, Node *node, MVPDP **points, unsigned in
                 if (new_node->leaf.sv2) new_nb++;
 
                 MVPDP **tmp_pts = (MVPDP**)malloc(new_nb*sizeof(MVPDP*));
-                if (!tmp_pts){
+                MVPDP **orig = (MVPDP**)malloc(new_nb*sizeof(MVPDP*));
+                if (!tmp_pts || !orig){
+                    free(tmp_pts);
+                    free(orig);
                     *error = MVP_MEMALLOC;
                     return new_node;
                 }
@@ -524,6 +832,14 @@ static Node* _mvptree_add(MVPTree *tree, Node *node, MVPDP **points, unsigned in
                 for (i=0;i<new_node->leaf.nbpoints;i++){
                     tmp_pts[index++] = new_node->leaf.points[i];
                 }
+                /* the leaf points get new paths, a snapshot keeps the old ones */
+                unsigned int nbold = index;
+                if (own_points(tree, tmp_pts, orig, nbold, NULL) < 0){
+                    free(tmp_pts);
+                    free(orig);
+                    *error = MVP_MEMALLOC;
+                    return new_node;
+                }
                 for (i=0;i<nbpoints;i++){
                     tmp_pts[index++] = points[i];
                 }
@@ -531,16 +847,19 @@ static Node* _mvptree_add(MVPTree *tree, Node *node, MVPDP **points, unsigned in
                 new_node = _mvptree_add(tree, NULL, tmp_pts, new_nb, error, lvl);
                 if (*error != MVP_SUCCESS) {
                     free_node(new_node);
+                    disown_points(tmp_pts, orig, nbold);
                     new_node = old_node;
                 } else {
                     free_node(old_node);
+                    release_originals(tree, orig, nbold);
                 }
 
                 free(tmp_pts);
+                free(orig);
             }
         } else { /* node is internal - must recurse on subnodes */
-            if (find_distance_range_for_vp(points, nbpoints, new_node->internal.sv1,tree,lvl)<0){
-                *error = MVP_NOSV1RANGE;
+            if ((rc = find_distance_range_for_vp(points, nbpoints, new_node->internal.sv1,tree,lvl)) < 0){
+                *error = range_error(rc, MVP_NOSV1RANGE);
                 return new_node;
             }
 
@@ -558,8 +877,8 @@ static Node* _mvptree_add(MVPTree *tree, Node *node, MVPDP **points, unsigned in
                     continue;
                 }
                 int j;
-                if (find_distance_range_for_vp(bins[i], binlengths[i], new_node->internal.sv2, tree, lvl+1) < 0){
-                    *error = MVP_NOSV2RANGE;
+                if ((rc = find_distance_range_for_vp(bins[i], binlengths[i], new_node->internal.sv2, tree, lvl+1)) < 0){
+                    *error = range_error(rc, MVP_NOSV2RANGE);
                     for (j=0;j<tree->branchfactor;j++){free(bins[j]);}
                     free(bins);
                     free(binlengths);
@@ -567,7 +886,7 @@ static Node* _mvptree_add(MVPTree *tree, Node *node, MVPDP **points, unsigned in
                 }
 
                 int *bin2lengths = NULL;
-                MVPDP ***bins2 = sort_points(bins[i], binlengths[i], -1, -1,new_node->internal.sv2, tree, &bin2lengths, new_node->internal.M2 + i*lengthM1);
+                MVPDP ***bins2 = sort_points(bins[i], binlengths[i], -1, -1,new_node->internal.sv2, tree, &bin2lengths, DIST_PTR(new_node->internal.M2, i*lengthM1, disttype));
 
                 if (!bins2){
                     *error = MVP_NOSORT;
@@ -609,57 +928,384 @@ MVPError mvptree_add(MVPTree *tree, MVPDP **points, unsigned int nbpoints) {
 
         unsigned int i;
         for (i=0;i<nbpoints;i++){
-            points[i]->path = (float*)malloc(tree->pathlength*sizeof(float));
+            points[i]->path = calloc(tree->pathlength, tree->disttype);
             if (points[i]->path == NULL){
                 return MVP_PATHALLOC;
             }
-            memset(points[i]->path, 0, tree->pathlength*sizeof(float));
         }
         Node *new_node;
         new_node = _mvptree_add(tree, tree->node, points, nbpoints, &err, 0);
-        if (err == MVP_SUCCESS) tree->node = new_node;
+        /* an existing root may have been copied, even if the add failed */
+        if (err == MVP_SUCCESS || tree->node) tree->node = new_node;
     }else {
         err = MVP_ARGERR;
     }
     return err;
 }
 
+/* count a datapoint and its memory */
+static void point_stats(MVPTree *tree, MVPDP *dp, MVPStats *stats){
+    if (dp == NULL) return;
+    stats->nbpoints++;
+    stats->pointbytes += sizeof(MVPDP) + dp->datalen*dp->type;
+    if (dp->id) stats->pointbytes += strlen(dp->id) + 1;
+    if (dp->path) stats->pointbytes += tree->pathlength*tree->disttype;
+}
+
+/* fold n split values into min, max and sum */
+static void split_stats(void *M, unsigned int n, MVPDistType disttype, int first,
+                        float *min, float *max, double *sum){
+    unsigned int i;
+    for (i=0;i<n;i++){
+        float m = dist_get(M, i, disttype);
+        if ((first && i == 0) || m < *min) *min = m;
+        if ((first && i == 0) || m > *max) *max = m;
+        *sum += m;
+    }
+}
+
+static void _mvptree_stats(MVPTree *tree, Node *node, MVPStats *stats, unsigned int depth){
+    if (node == NULL) return;
+    if (depth > stats->depth) stats->depth = depth;
+
+    if (node->leaf.type == LEAF_NODE){
+        unsigned int i, bin = node->leaf.nbpoints*MVP_FILLBINS/tree->leafcap;
+        stats->nbleaf++;
+        stats->nbleafpoints += node->leaf.nbpoints;
+        stats->leaffill[(bin < MVP_FILLBINS) ? bin : MVP_FILLBINS-1]++;
+        stats->leafbytes += sizeof(Node) + tree->leafcap*(sizeof(MVPDP*) + 2*tree->disttype);
+        point_stats(tree, node->leaf.sv1, stats);
+        point_stats(tree, node->leaf.sv2, stats);
+        for (i=0;i<node->leaf.nbpoints;i++){
+            point_stats(tree, node->leaf.points[i], stats);
+        }
+    } else {
+        int i, bf = tree->branchfactor, fanout = bf*bf;
+        stats->nbinternal++;
+        stats->internalbytes += sizeof(Node) + fanout*sizeof(Node*) + \
+            ((bf-1) + (bf-1)*bf)*tree->disttype;
+        point_stats(tree, node->internal.sv1, stats);
+        point_stats(tree, node->internal.sv2, stats);
+        if (depth <= MVP_STATLEVELS){
+            MVPLevelStats *level = &stats->levels[depth-1];
+            int first = (level->nbinternal++ == 0);
+            split_stats(node->internal.M1, bf-1, tree->disttype, first,
+                        &level->m1min, &level->m1max, &level->m1sum);
+            split_stats(node->internal.M2, (bf-1)*bf, tree->disttype, first,
+                        &level->m2min, &level->m2max, &level->m2sum);
+        }
+        for (i=0;i<fanout;i++){
+            if (node->internal.child_nodes[i] == NULL){
+                stats->nbempty++;
+            } else {
+                _mvptree_stats(tree, node->internal.child_nodes[i], stats, depth+1);
+            }
+        }
+    }
+}
+
+MVPError mvptree_stats(MVPTree *tree, MVPStats *stats){
+    if (!tree || !stats) return MVP_ARGERR;
+    memset(stats, 0, sizeof(MVPStats));
+    _mvptree_stats(tree, tree->node, stats, 1);
+    return MVP_SUCCESS;
+}
+
+/* number of datapoints in the subtree, vantage points included */
+static unsigned int count_points(MVPTree *tree, Node *node){
+    MVPStats stats;
+    memset(&stats, 0, sizeof(MVPStats));
+    _mvptree_stats(tree, node, &stats, 1);
+    return stats.nbpoints;
+}
+
+/* Append the datapoints of the subtree to points. shared[i] is set for the */
+/* datapoints reached through a node shared with a snapshot.               */
+static void collect_points(MVPTree *tree, Node *node, MVPDP **points, char *shared, unsigned int *nbpoints, int node_shared){
+    if (node == NULL) return;
+    node_shared = node_shared || is_shared(&node->leaf.refs);
+    if (node->leaf.sv1){ shared[*nbpoints] = node_shared; points[(*nbpoints)++] = node->leaf.sv1; }
+    if (node->leaf.sv2){ shared[*nbpoints] = node_shared; points[(*nbpoints)++] = node->leaf.sv2; }
+    if (node->leaf.type == LEAF_NODE){
+        unsigned int i;
+        for (i=0;i<node->leaf.nbpoints;i++){
+            shared[*nbpoints] = node_shared;
+            points[(*nbpoints)++] = node->leaf.points[i];
+        }
+    } else {
+        int i, fanout = (tree->branchfactor)*(tree->branchfactor);
+        for (i=0;i<fanout;i++){
+            collect_points(tree, node->internal.child_nodes[i], points, shared, nbpoints, node_shared);
+        }
+    }
+}
+
+/* free the nodes of a subtree, leaving its datapoints alone */
+static void free_nodes(MVPTree *tree, Node *node){
+    if (node == NULL) return;
+    if (node->internal.type == INTERNAL_NODE){
+        int i, fanout = (tree->branchfactor)*(tree->branchfactor);
+        for (i=0;i<fanout;i++){
+            free_nodes(tree, node->internal.child_nodes[i]);
+        }
+    }
+    free_node(node);
+}
+
+/* most points under one child of an internal node */
+static unsigned int largest_child(MVPTree *tree, Node *node){
+    int i, fanout = (tree->branchfactor)*(tree->branchfactor);
+    unsigned int count, largest = 0;
+    for (i=0;i<fanout;i++){
+        count = count_points(tree, node->internal.child_nodes[i]);
+        if (count > largest) largest = count;
+    }
+    return largest;
+}
+
+static unsigned int subtree_depth(MVPTree *tree, Node *node){
+    MVPStats stats;
+    memset(&stats, 0, sizeof(MVPStats));
+    _mvptree_stats(tree, node, &stats, 1);
+    return stats.depth;
+}
+
+/* Rebuild the subtree at *slot from its points, whose root has largest     */
+/* points under one child. The new subtree is kept, and *kept set, only if  */
+/* it has fewer points under its largest child or fewer levels: rebuilding */
+/* the same points again is then a no-op. Otherwise, or on failure, the     */
+/* subtree and the paths of its points are left untouched. The new subtree  */
+/* gets copies of the datapoints shared with a snapshot, which keeps the    */
+/* old subtree.                                                             */
+static MVPError rebuild_subtree(MVPTree *tree, Node **slot, unsigned int nbpoints, unsigned int largest,\
+                                int *kept, int lvl){
+    MVPError err = MVP_SUCCESS;
+    size_t pathsize = tree->pathlength*tree->disttype;
+    unsigned int i, count = 0;
+
+    MVPDP **points = (MVPDP**)malloc(nbpoints*sizeof(MVPDP*));
+    MVPDP **orig = (MVPDP**)malloc(nbpoints*sizeof(MVPDP*));
+    char *shared = (char*)malloc(nbpoints);
+    char *paths = (char*)malloc(nbpoints*pathsize);
+    if (!points || !orig || !shared || !paths){
+        err = MVP_MEMALLOC;
+        goto done;
+    }
+
+    collect_points(tree, *slot, points, shared, &count, 0);
+    if (own_points(tree, points, orig, count, shared) < 0){
+        err = MVP_MEMALLOC;
+        goto done;
+    }
+    for (i=0;i<count;i++){
+        /* both the old and the new subtree hold the points that are not copied */
+        if (!orig[i]) dp_retain(points[i]);
+        memcpy(&paths[i*pathsize], points[i]->path, pathsize);
+    }
+
+    Node *new_node = _mvptree_add(tree, NULL, points, count, &err, lvl);
+    *kept = err == MVP_SUCCESS && (new_node->internal.type == LEAF_NODE || largest_child(tree, new_node) < largest ||\
+                                   subtree_depth(tree, new_node) < subtree_depth(tree, *slot));
+    if (*kept){
+        node_release(tree, *slot, tree->free_func);
+        *slot = new_node;
+    } else {
+        free_nodes(tree, new_node);
+        for (i=0;i<count;i++){
+            if (orig[i]) continue;
+            memcpy(points[i]->path, &paths[i*pathsize], pathsize);
+            ref_dec(&points[i]->refs);
+        }
+        disown_points(points, orig, count);
+    }
+
+done:
+    free(points);
+    free(orig);
+    free(shared);
+    free(paths);
+    return err;
+}
+
+static MVPError _mvptree_optimize(MVPTree *tree, Node **slot, float skew, unsigned int *nbrebuilt, int lvl){
+    Node *node = *slot;
+    if (node == NULL || node->leaf.type == LEAF_NODE) return MVP_SUCCESS;
+
+    int i, fanout = (tree->branchfactor)*(tree->branchfactor);
+    unsigned int counts[fanout], total = 2, largest = 0;
+    for (i=0;i<fanout;i++){
+        counts[i] = count_points(tree, node->internal.child_nodes[i]);
+        total += counts[i];
+        if (counts[i] > largest) largest = counts[i];
+    }
+
+    /* a child holding more than skew times its share of the points */
+    if (total > tree->leafcap + 2 && largest > skew*(float)(total - 2)/fanout){
+        int kept = 0;
+        if (rebuild_subtree(tree, slot, total, largest, &kept, lvl) == MVP_SUCCESS && kept){
+            (*nbrebuilt)++;
+            return MVP_SUCCESS;
+        }
+        /* could not rebuild it (e.g. too many equal points) or no better, try deeper */
+    }
+
+    /* the child slots may change: copy the node if a snapshot shares it */
+    if ((node = node_own(tree, node)) == NULL) return MVP_MEMALLOC;
+    *slot = node;
+
+    for (i=0;i<fanout;i++){
+        MVPError err = _mvptree_optimize(tree, (Node**)&node->internal.child_nodes[i], skew, nbrebuilt, lvl+2);
+        if (err != MVP_SUCCESS) return err;
+    }
+    return MVP_SUCCESS;
+}
+
+MVPError mvptree_optimize(MVPTree *tree, float skew, unsigned int *nbrebuilt){
+    if (!tree || !nbrebuilt || skew < 1.0f) return MVP_ARGERR;
+    *nbrebuilt = 0;
+    return _mvptree_optimize(tree, &tree->node, skew, nbrebuilt, 0);
+}
+
+/* FNV-1a hash of a null-terminated id */
+static unsigned int hash_id(const char *id){
+    unsigned int h = 2166136261u;
+    while (*id){
+        h ^= (unsigned char)*id++;
+        h *= 16777619u;
+    }
+    return h;
+}
+
+/* slot holding id, or the free slot where it belongs */
+static char **idset_slot(const MVPIdSet *set, const char *id){
+    unsigned int mask = set->size - 1;
+    unsigned int i = hash_id(id) & mask;
+    while (set->slots[i] && strcmp(set->slots[i], id) != 0){
+        i = (i + 1) & mask;
+    }
+    return &set->slots[i];
+}
+
+MVPIdSet* mvp_idset_alloc(unsigned int nbids){
+    MVPIdSet *set = (MVPIdSet*)malloc(sizeof(MVPIdSet));
+    if (!set) return NULL;
+    set->size = 8;
+    while (set->size < 2*nbids) set->size *= 2;
+    set->nbids = 0;
+    set->slots = (char**)calloc(set->size, sizeof(char*));
+    if (!set->slots){
+        free(set);
+        return NULL;
+    }
+    return set;
+}
+
+MVPError mvp_idset_add(MVPIdSet *set, const char *id){
+    if (!set || !id) return MVP_ARGERR;
+
+    if (2*(set->nbids+1) > set->size){
+        /* keep the table at most half full */
+        unsigned int i, size = set->size;
+        char **slots = set->slots;
+        set->slots = (char**)calloc(2*size, sizeof(char*));
+        if (!set->slots){
+            set->slots = slots;
+            return MVP_MEMALLOC;
+        }
+        set->size = 2*size;
+        for (i=0;i<size;i++){
+            if (slots[i]) *idset_slot(set, slots[i]) = slots[i];
+        }
+        free(slots);
+    }
+
+    char **slot = idset_slot(set, id);
+    if (*slot == NULL){
+        *slot = strdup(id);
+        if (*slot == NULL) return MVP_MEMALLOC;
+        set->nbids++;
+    }
+    return MVP_SUCCESS;
+}
+
+int mvp_idset_contains(const MVPIdSet *set, const char *id){
+    if (!set || !id) return 0;
+    return *idset_slot(set, id) != NULL;
+}
+
+void mvp_idset_free(MVPIdSet *set){
+    if (!set) return;
+    unsigned int i;
+    for (i=0;i<set->size;i++){
+        free(set->slots[i]);
+    }
+    free(set->slots);
+    free(set);
+}
+
+static int cmp_tag(const void *a, const void *b){
+    unsigned int ta = *(const unsigned int*)a, tb = *(const unsigned int*)b;
+    return (ta > tb) - (ta < tb);
+}
+
+/* Append point to the results unless the filter of the query rejects it. */
+/* Returns MVP_KNEARESTCAP once knearest results are collected.           */
+static MVPError emit_result(MVPTree *tree, MVPDP *point, float d, MVPDP **results, unsigned int *nbresults){
+    const MVPFilter *filter = tree->filter;
+    if (filter){
+        if (filter->ids && !mvp_idset_contains(filter->ids, point->id)){
+            return MVP_SUCCESS;
+        }
+        if (filter->nbtags > 0 && \
+            !bsearch(&point->tag, filter->tags, filter->nbtags, sizeof(unsigned int), cmp_tag)){
+            return MVP_SUCCESS;
+        }
+    }
+    if (tree->distances) tree->distances[*nbresults] = d;
+    results[(*nbresults)++] = point;
+    return (*nbresults >= tree->k) ? MVP_KNEARESTCAP : MVP_SUCCESS;
+}
+
+/* distance from the query target, counted in tree->nbdist */
+static float query_distance(MVPTree *tree, MVPDP *target, MVPDP *point){
+    tree->nbdist++;
+    return tree->dist(target, point);
+}
+
 static MVPError _mvptree_retrieve(MVPTree *tree,Node *node,MVPDP *target, float radius, MVPDP** results,unsigned int *nbresults, int lvl){
     MVPError err = MVP_SUCCESS;
     int bf = tree->branchfactor;
     int lengthM1 = bf - 1;
+    MVPDistType disttype = tree->disttype;
     float d1, d2;
     if (node == NULL) return err;
 
-    CmpFunc distance = tree->dist;
     unsigned int i, j;
 
     if (node->leaf.type == LEAF_NODE){
-        d1 = distance(target, node->leaf.sv1);
+        d1 = query_distance(tree, target, node->leaf.sv1);
         if (is_nan(d1) || d1 < 0.0f){
             return MVP_BADDISTVAL;
         }
 
-        if (lvl < tree->pathlength) target->path[lvl] = d1;
+        if (lvl < tree->pathlength) ((float*)target->path)[lvl] = d1;
         if (d1 <= radius){
-            results[(*nbresults)++] = node->leaf.sv1;
-            if (*nbresults >= tree->k) return MVP_KNEARESTCAP;
+            if ((err = emit_result(tree, node->leaf.sv1, d1, results, nbresults)) != MVP_SUCCESS) return err;
         }
         if (node->leaf.sv2){
-            d2 = distance(target, node->leaf.sv2);
+            d2 = query_distance(tree, target, node->leaf.sv2);
 
             if (is_nan(d2) || d2 < 0.0f){
                 return MVP_BADDISTVAL;
             }
             if (d2 <= radius){
-                results[(*nbresults)++] = node->leaf.sv2;
-                if (*nbresults >= tree->k) return MVP_KNEARESTCAP;
+                if ((err = emit_result(tree, node->leaf.sv2, d2, results, nbresults)) != MVP_SUCCESS) return err;
             }
-            if (lvl+1 < tree->pathlength) target->path[lvl+1] = d2;
+            if (lvl+1 < tree->pathlength) ((float*)target->path)[lvl+1] = d2;
             for (i=0;i<node->leaf.nbpoints;i++){
 
                 /* check all points 
-                float d = distance(target,node->leaf.points[i]);
+                float d = query_distance(tree, target,node->leaf.points[i]);
                 fprintf(stdout,"pnt%d distance(Q,%s)=%f\n",i,node->leaf.points[i]->id,d);
                 if (d <= radius){
                     results[(*nbresults)++] = node->leaf.points[i];
@@ -670,12 +1316,12 @@ static MVPError _mvptree_retrieve(MVPTree *tree,Node *node,MVPDP *target, float
                 */
 
                 /* filter points before checking */
-                if (d1 - radius <= node->leaf.d1[i] && d1 + radius >= node->leaf.d1[i]){
-                    if (d2 - radius <= node->leaf.d2[i] && d2 + radius >= node->leaf.d2[i]){
+                if (dist_within(node->leaf.d1, i, d1, radius, disttype)){
+                    if (dist_within(node->leaf.d2, i, d2, radius, disttype)){
                         int endpath = (lvl+1 < tree->pathlength) ? lvl+1 : tree->pathlength;
                         int skip = 0;
                         for (j=0;j < endpath;j++){
-                            if (target->path[j] - radius <= node->leaf.points[i]->path[j] && target->path[j] + radius >= node->leaf.points[i]->path[j]){
+                            if (dist_within(node->leaf.points[i]->path, j, ((float*)target->path)[j], radius, disttype)){
                                 continue;
                             } else {
                                 skip = 1;
@@ -684,15 +1330,12 @@ static MVPError _mvptree_retrieve(MVPTree *tree,Node *node,MVPDP *target, float
                         }
                         if (!skip){
 
-                            float d = distance(target, node->leaf.points[i]);
+                            float d = query_distance(tree, target, node->leaf.points[i]);
                             if (is_nan(d) || d < 0.0){
                                 return MVP_BADDISTVAL;
                             }
                             if (d <= radius){
-                                results[(*nbresults)++] = node->leaf.points[i];
-                                if (*nbresults >= tree->k){
-                                    return MVP_KNEARESTCAP;
-                                }
+                                if ((err = emit_result(tree, node->leaf.points[i], d, results, nbresults)) != MVP_SUCCESS) return err;
                             }
                         }
                     }
@@ -703,43 +1346,38 @@ static MVPError _mvptree_retrieve(MVPTree *tree,Node *node,MVPDP *target, float
             for (i=0;i<node->leaf.nbpoints;i++) {
                 /* check all points */
                 // This code filter point correctly
-                float d = distance(target,node->leaf.points[i]);
+                float d = query_distance(tree, target,node->leaf.points[i]);
                 // fprintf(stdout,"pnt%d distance(Q,%s)=%f\n",i,node->leaf.points[i]->id,d);
                 if (d <= radius){
-                    results[(*nbresults)++] = node->leaf.points[i];
-                    if (*nbresults >= tree->k){
-                        return MVP_KNEARESTCAP;
-                    }
+                    if ((err = emit_result(tree, node->leaf.points[i], d, results, nbresults)) != MVP_SUCCESS) return err;
                 }
             }
         }
     } else if (node->internal.type == INTERNAL_NODE){
-        d1 = distance(target, node->internal.sv1);
+        d1 = query_distance(tree, target, node->internal.sv1);
         if (is_nan(d1) || d1 < 0.0f){
             return MVP_BADDISTVAL;
         }
         if (d1 <= radius){
-            results[(*nbresults)++] = node->internal.sv1;
-            if (*nbresults >= tree->k) return MVP_KNEARESTCAP;
+            if ((err = emit_result(tree, node->internal.sv1, d1, results, nbresults)) != MVP_SUCCESS) return err;
         }
-        if (lvl < tree->pathlength) target->path[lvl] = d1;
-        d2 = distance(target, node->internal.sv2);
+        if (lvl < tree->pathlength) ((float*)target->path)[lvl] = d1;
+        d2 = query_distance(tree, target, node->internal.sv2);
         if (is_nan(d2) || d2 < 0.0f){
             return MVP_BADDISTVAL;
         }
         if (d2 <= radius){
-            results[(*nbresults)++] = node->internal.sv2;
-            if (*nbresults >= tree->k) return MVP_KNEARESTCAP;
+            if ((err = emit_result(tree, node->internal.sv2, d2, results, nbresults)) != MVP_SUCCESS) return err;
         }
-        if (lvl+1 < tree->pathlength) target->path[lvl+1] = d2;
+        if (lvl+1 < tree->pathlength) ((float*)target->path)[lvl+1] = d2;
         /* check <= each 1st level bins */
         for (i=0;i<lengthM1;i++){
 
-            if (d1 - radius <= node->internal.M1[i]){
+            if (d1 - radius <= dist_get(node->internal.M1, i, disttype)){
 
             /* check <= each 2nd level bins */
                 for (j=0;j<lengthM1;j++){
-                    if (d2 - radius <= node->internal.M2[i*lengthM1+j]){
+                    if (d2 - radius <= dist_get(node->internal.M2, i*lengthM1+j, disttype)){
 
                         err = _mvptree_retrieve(tree,node->internal.child_nodes[i*bf+j],target,\
                             radius, results, nbresults, lvl+2);
@@ -748,7 +1386,7 @@ static MVPError _mvptree_retrieve(MVPTree *tree,Node *node,MVPDP *target, float
                     }
                 }
             /* check >= last 2nd level bin  */
-                if (d2 + radius >= node->internal.M2[i*lengthM1+lengthM1-1]){
+                if (d2 + radius >= dist_get(node->internal.M2, i*lengthM1+lengthM1-1, disttype)){
 
                     err = _mvptree_retrieve(tree,node->internal.child_nodes[i*bf+lengthM1],\
                         target, radius, results, nbresults, lvl+2);
@@ -758,11 +1396,11 @@ static MVPError _mvptree_retrieve(MVPTree *tree,Node *node,MVPDP *target, float
         }
 
         /* check >= last 1st level bin */
-        if (d1 + radius >= node->internal.M1[lengthM1-1]){
+        if (d1 + radius >= dist_get(node->internal.M1, lengthM1-1, disttype)){
 
             /* check <= each 2nd level bins */
             for (j=0;j<lengthM1;j++){
-                if (d2 - radius <= node->internal.M2[lengthM1*lengthM1+j]){
+                if (d2 - radius <= dist_get(node->internal.M2, lengthM1*lengthM1+j, disttype)){
 
                     err = _mvptree_retrieve(tree,node->internal.child_nodes[bf*lengthM1+j],\
                         target, radius, results, nbresults, lvl+2);
@@ -771,7 +1409,7 @@ static MVPError _mvptree_retrieve(MVPTree *tree,Node *node,MVPDP *target, float
             }
             /* check >= last 2nd level bin  */
 
-            if (d2 + radius >= node->internal.M2[lengthM1*lengthM1+lengthM1-1]){
+            if (d2 + radius >= dist_get(node->internal.M2, lengthM1*lengthM1+lengthM1-1, disttype)){
 
                 err = _mvptree_retrieve(tree,node->internal.child_nodes[bf*lengthM1+lengthM1],\
                     target, radius, results, nbresults, lvl+2);
@@ -785,6 +1423,18 @@ static MVPError _mvptree_retrieve(MVPTree *tree,Node *node,MVPDP *target, float
 }
 
 MVPDP** mvptree_retrieve(MVPTree *tree, MVPDP *target, unsigned int knearest, float radius,unsigned int *nbresults,MVPError *error){
+    return mvptree_retrieve_distances(tree, target, knearest, radius, NULL, NULL, nbresults, error);
+}
+
+MVPDP** mvptree_retrieve_filtered(MVPTree *tree, MVPDP *target, unsigned int knearest, float radius,\
+                                  const MVPFilter *filter, unsigned int *nbresults, MVPError *error){
+    return mvptree_retrieve_distances(tree, target, knearest, radius, filter, NULL, nbresults, error);
+}
+
+MVPDP** mvptree_retrieve_distances(MVPTree *tree, MVPDP *target, unsigned int knearest, float radius,\
+                                   const MVPFilter *filter, float **distances, unsigned int *nbresults,\
+                                   MVPError *error){
+    if (distances) *distances = NULL;
     if (!tree || !target || !nbresults || knearest == 0 || radius < 0) {
         *error = MVP_ARGERR;
         return NULL;
@@ -808,16 +1458,36 @@ MVPDP** mvptree_retrieve(MVPTree *tree, MVPDP *target, unsigned int knearest, fl
         *error = MVP_MEMALLOC;
         return NULL;
     }
+    if (distances && (*distances = (float*)malloc(knearest*sizeof(float))) == NULL){
+        *error = MVP_MEMALLOC;
+        free(results);
+        return NULL;
+    }
 
-    target->path = (float*)malloc(tree->pathlength*sizeof(float));
+    /* the target keeps its path as floats whatever the tree's distance type */
+    target->path = malloc(tree->pathlength*sizeof(float));
     if (target->path == NULL){
         *error = MVP_MEMALLOC;
         free(results);
+        if (distances){
+            free(*distances);
+            *distances = NULL;
+        }
         return NULL;
     }
     tree->k = knearest;
+    tree->nbdist = 0;
+    tree->filter = filter;
+    tree->distances = (distances) ? *distances : NULL;
+
+    /* integer distance types truncate the radius to an int */
+    if (tree->disttype != MVP_FLOATDIST && radius > (float)(INT_MAX/2)){
+        radius = (float)(INT_MAX/2);
+    }
 
     *error = _mvptree_retrieve(tree, tree->node, target, radius, results, nbresults, 0);
+    tree->filter = NULL;
+    tree->distances = NULL;
 
     free(target->path);
     target->path = NULL;
@@ -825,16 +1495,22 @@ MVPDP** mvptree_retrieve(MVPTree *tree, MVPDP *target, unsigned int knearest, fl
     return results;
 }
 
+/* Copy n bytes to tree->buf at pos. The writers below run twice: first with */
+/* a NULL buffer to measure the exact serialized size, then to fill a buffer  */
+/* of that size.                                                              */
+static void put_bytes(MVPTree *tree, off_t pos, const void *src, size_t n){
+    if (tree->buf) memcpy(&tree->buf[pos], src, n);
+}
+
 static off_t write_datapoint(MVPDP *dp, MVPTree *tree){
     off_t start = tree->pos;
     off_t pos = tree->pos;
     uint8_t active = 0;
     uint32_t bytelength = 0;
-    char *buf = tree->buf;
 
     if (dp == NULL){
-        memcpy(&buf[pos++], &active, 1);
-        memcpy(&buf[pos], &bytelength, sizeof(uint32_t));
+        put_bytes(tree, pos++, &active, 1);
+        put_bytes(tree, pos, &bytelength, sizeof(uint32_t));
         pos += sizeof(uint32_t);
         tree->pos = pos;
         return start;
@@ -844,51 +1520,35 @@ static off_t write_datapoint(MVPDP *dp, MVPTree *tree){
     uint32_t datalength = dp->datalen;
     uint8_t type = dp->type;
     bytelength = sizeof(uint8_t) + idlen + sizeof(uint32_t) +\
-    datalength*type + (tree->pathlength)*sizeof(float);
+    datalength*type + (tree->pathlength)*(tree->disttype);
+    if (tree->version > UNTAGGED_VERSION) bytelength += sizeof(uint32_t);
 
-    memcpy(&buf[pos++], &active    , 1);
-    memcpy(&buf[pos]  , &bytelength, sizeof(uint32_t));
+    put_bytes(tree, pos++, &active    , 1);
+    put_bytes(tree, pos  , &bytelength, sizeof(uint32_t));
     pos += sizeof(uint32_t);
 
     // XXX: This is not the proper way to serialize this data
-    memcpy(&buf[pos], &idlen     , sizeof(unsigned int));
+    put_bytes(tree, pos, &idlen     , sizeof(unsigned int));
     pos += sizeof(unsigned int);
 
-    memcpy(&buf[pos]  , dp->id     , idlen);
+    put_bytes(tree, pos  , dp->id     , idlen);
     pos += idlen;
-    memcpy(&buf[pos]  , &datalength, sizeof(uint32_t));
+    put_bytes(tree, pos  , &datalength, sizeof(uint32_t));
     pos += sizeof(uint32_t);
-    memcpy(&buf[pos]  , dp->data   , datalength*type);
+    put_bytes(tree, pos  , dp->data   , datalength*type);
     pos += datalength*type;
-    memcpy(&buf[pos]  , dp->path   , (tree->pathlength)*sizeof(float));
-    pos += (tree->pathlength)*sizeof(float);
+    put_bytes(tree, pos  , dp->path   , (tree->pathlength)*(tree->disttype));
+    pos += (tree->pathlength)*(tree->disttype);
+    if (tree->version > UNTAGGED_VERSION){
+        uint32_t dptag = dp->tag;
+        put_bytes(tree, pos, &dptag, sizeof(uint32_t));
+        pos += sizeof(uint32_t);
+    }
 
     tree->pos = pos;
     return start;
 }
 
-static int extend_mvpfile(MVPTree *tree){
-    if (munmap(tree->buf, tree->size) < 0){
-        return -1;
-    }
-
-    // extend needed pages plus one
-    while (tree->size <= tree->pos) tree->size += tree->pgsize;
-    tree->size += tree->pgsize;
-
-    if (ftruncate(tree->fd, tree->size) < 0){
-        return -2;
-    }
-
-    char *buf = (char*)mmap(NULL, tree->size, PROT_READ|PROT_WRITE, MAP_SHARED, tree->fd, 0);
-    if (buf == NULL){
-        return -3;
-    }
-    tree->buf = buf;
-
-    return 0;
-}
-
 static off_t _mvptree_write(MVPTree *tree,Node *node,MVPError *error,int lvl){
     off_t start_pos = tree->pos;
     if (node == NULL) return 0;
@@ -896,39 +1556,26 @@ static off_t _mvptree_write(MVPTree *tree,Node *node,MVPError *error,int lvl){
     uint8_t node_type = (uint8_t)node->leaf.type;
     if (node->leaf.type == LEAF_NODE){
         uint32_t nbpoints = node->leaf.nbpoints;
-        if (tree->pos >= tree->size - tree->pgsize/2){
-            if (extend_mvpfile(tree) < 0){
-                *error = MVP_FILETRUNCATE;
-                return start_pos;
-            }
-        }
 
         /* save node */
-        memcpy(&tree->buf[tree->pos++], &node_type, 1);
+        put_bytes(tree, tree->pos++, &node_type, 1);
         write_datapoint(node->leaf.sv1, tree);
         write_datapoint(node->leaf.sv2, tree);
-        memcpy(&tree->buf[tree->pos], &nbpoints, sizeof(uint32_t));
+        put_bytes(tree, tree->pos, &nbpoints, sizeof(uint32_t));
         tree->pos += sizeof(uint32_t);
 
         /* write points */
         int i;
         off_t saved_pos = tree->pos;
-        tree->pos += (tree->leafcap)*(2*sizeof(float)+sizeof(off_t));
+        tree->pos += (tree->leafcap)*(2*tree->disttype+sizeof(off_t));
         for (i=0;i<nbpoints;i++){
-            if (tree->pos >= tree->size - tree->pgsize/2){
-                if (extend_mvpfile(tree) < 0){
-                    *error = MVP_FILETRUNCATE;
-                    break;
-                }
-            }
-
-            memcpy(&tree->buf[saved_pos], &(node->leaf.d1[i]), sizeof(float));
-            saved_pos += sizeof(float);
-            memcpy(&tree->buf[saved_pos], &(node->leaf.d2[i]), sizeof(float));
-            saved_pos += sizeof(float);
+            put_bytes(tree, saved_pos, DIST_PTR(node->leaf.d1, i, tree->disttype), tree->disttype);
+            saved_pos += tree->disttype;
+            put_bytes(tree, saved_pos, DIST_PTR(node->leaf.d2, i, tree->disttype), tree->disttype);
+            saved_pos += tree->disttype;
 
             off_t offset = write_datapoint(node->leaf.points[i], tree);
-            memcpy(&tree->buf[saved_pos], &offset, sizeof(off_t));
+            put_bytes(tree, saved_pos, &offset, sizeof(off_t));
             saved_pos += sizeof(off_t);
         }
     } else if (node->internal.type == INTERNAL_NODE){
@@ -938,71 +1585,44 @@ static off_t _mvptree_write(MVPTree *tree,Node *node,MVPError *error,int lvl){
         int lengthM2 = (bf - 1)*bf;
         int fanout   = bf*bf;
 
-        memcpy(&tree->buf[tree->pos++], &node_type, 1);
+        put_bytes(tree, tree->pos++, &node_type, 1);
         write_datapoint(node->internal.sv1, tree);
         write_datapoint(node->internal.sv2, tree);
-        memcpy(&tree->buf[tree->pos], node->internal.M1, lengthM1*sizeof(float));
-        tree->pos += lengthM1*sizeof(float);
-        memcpy(&tree->buf[tree->pos], node->internal.M2, lengthM2*sizeof(float));
-        tree->pos += lengthM2*sizeof(float);
+        put_bytes(tree, tree->pos, node->internal.M1, lengthM1*tree->disttype);
+        tree->pos += lengthM1*tree->disttype;
+        put_bytes(tree, tree->pos, node->internal.M2, lengthM2*tree->disttype);
+        tree->pos += lengthM2*tree->disttype;
 
         off_t saved_pos = tree->pos;
         tree->pos += fanout*(sizeof(uint8_t) + sizeof(off_t));
         int i;
         for (i=0;i<fanout;i++){
-            if (tree->pos >= tree->size - tree->pgsize/2){
-                if (extend_mvpfile(tree) < 0){
-                    *error = MVP_FILETRUNCATE;
-                    break;
-                }
-            }
             off_t offset = _mvptree_write(tree, node->internal.child_nodes[i], error, lvl+2);
-            memcpy(&tree->buf[saved_pos++], &fileno, 1);
-            memcpy(&tree->buf[saved_pos]  , &offset, sizeof(off_t));
+            put_bytes(tree, saved_pos++, &fileno, 1);
+            put_bytes(tree, saved_pos  , &offset, sizeof(off_t));
             saved_pos += sizeof(off_t);
         }
     } else {
         *error = MVP_UNRECOGNIZED;
     }
 
-    /*    msync(tree->buf, tree->size, MS_ASYNC);   */
-
     return start_pos;
 }
 
-MVPError mvptree_write(MVPTree *tree, const char *filename, int mode){
-    if (!tree || !tree->dist || !tree->node || !filename){
-        return MVP_ARGERR;
-    }
-
-    tree->fd = open(filename, O_CREAT|O_RDWR|O_TRUNC, mode);
-    if (tree->fd < 0){
-        return MVP_FILEOPEN;
-    }
-    tree->pgsize = sysconf(_SC_PAGESIZE);
-    if (ftruncate(tree->fd, tree->pgsize) < 0){
-        close(tree->fd);
-        return MVP_FILETRUNCATE;
-    }
-    tree->size = tree->pgsize;
-    char *buf  = (char*)mmap(NULL, tree->size, PROT_READ|PROT_WRITE, MAP_SHARED, tree->fd, 0);
-    if (buf == NULL){
-        close(tree->fd);
-        return MVP_MEMMAP;
-    }
+static void write_header(MVPTree *tree, char *buf){
     off_t pos = 0;
 
     unsigned int bf = tree->branchfactor;
     unsigned int pl = tree->pathlength;
     unsigned int lc = tree->leafcap;
-    uint8_t ht = (uint8_t)tree->node->internal.sv1->type;
+    uint8_t ht = (tree->node) ? (uint8_t)tree->node->internal.sv1->type : (uint8_t)tree->datatype;
+    uint8_t dt = (uint8_t)tree->disttype;
 
-    /* write header */
     memcpy(&buf[pos], tag, strlen(tag)+1);
     pos += strlen(tag)+1;
 
-    memcpy(&buf[pos], &version, sizeof(version));
-    pos += sizeof(version);
+    memcpy(&buf[pos], &tree->version, sizeof(tree->version));
+    pos += sizeof(tree->version);
 
     memcpy(&buf[pos], &bf, sizeof(unsigned int));
     pos += sizeof(unsigned int);
@@ -1015,147 +1635,751 @@ MVPError mvptree_write(MVPTree *tree, const char *filename, int mode){
 
     memcpy(&buf[pos++], &ht, 1);
 
-    tree->buf = buf;
-    pos = HEADER_SIZE;
-    tree->pos = pos;
-
-    /* write nodes */
-    MVPError error = MVP_SUCCESS;
-    _mvptree_write(tree, tree->node, &error, 0);
+    memcpy(&buf[pos++], &dt, 1);
+}
 
-    /* cleanup */
-    if (msync(tree->buf, tree->size, MS_SYNC) < 0){
-        error = MVP_MEMMAP;
+/* whether any datapoint of the subtree has a tag */
+static int has_tags(MVPTree *tree, Node *node){
+    if (node == NULL) return 0;
+    if ((node->leaf.sv1 && node->leaf.sv1->tag) || (node->leaf.sv2 && node->leaf.sv2->tag)){
+        return 1;
     }
-
-    if (munmap(tree->buf, tree->size) < 0){
-        error = MVP_MUNMAP;
+    int i;
+    if (node->leaf.type == LEAF_NODE){
+        for (i=0;i<node->leaf.nbpoints;i++){
+            if (node->leaf.points[i]->tag) return 1;
+        }
+    } else {
+        for (i=0;i<(tree->branchfactor)*(tree->branchfactor);i++){
+            if (has_tags(tree, node->internal.child_nodes[i])) return 1;
+        }
+    }
+    return 0;
+}
+
+/* exact number of bytes written by _mvptree_serialize, which must follow */
+static off_t _mvptree_serialized_size(MVPTree *tree, MVPError *error){
+    /* untagged float trees keep the format readers of UNTAGGED_VERSION understand */
+    if (tree->disttype != MVP_FLOATDIST){
+        tree->version = COMPACT_VERSION;
+    } else {
+        tree->version = has_tags(tree, tree->node) ? FORMAT1_VERSION : UNTAGGED_VERSION;
+    }
+    tree->buf = NULL;
+    tree->pos = HEADER_SIZE;
+    if (tree->node){
+        _mvptree_write(tree, tree->node, error, 0);
+    }
+    off_t size = tree->pos;
+    tree->pos = 0;
+    return size;
+}
+
+/* serialize the tree into buf, which must hold _mvptree_serialized_size bytes */
+static MVPError _mvptree_serialize(MVPTree *tree, char *buf){
+    MVPError error = MVP_SUCCESS;
+
+    write_header(tree, buf);
+
+    tree->buf = buf;
+    tree->pos = HEADER_SIZE;
+    if (tree->node){
+        _mvptree_write(tree, tree->node, &error, 0);
     }
     tree->buf = NULL;
+    tree->pos = 0;
+
+    return error;
+}
+
+/* MVP_FORMAT2 files share the 32 byte header of MVP_FORMAT1, version        */
+/* FORMAT2_VERSION, with the metric at byte 28 and FORMAT2_* flags at byte   */
+/* 29. The body that follows is, zlib compressed with FORMAT2_ZLIB (after    */
+/* its uint64 uncompressed length):                                          */
+/*                                                                           */
+/*   varint number of datapoints, varint length of each section, then       */
+/*   nodes  - preorder: a byte with the node type (0 for a NULL child) and   */
+/*            SV1_PRESENT/SV2_PRESENT, then for leaves a varint number of    */
+/*            points and their d1, d2; for internal nodes M1 and M2 followed */
+/*            by the children. Datapoints are numbered in the order the      */
+/*            nodes reference them: sv1, sv2, then the leaf points.          */
+/*   points - per datapoint: varint datalen, data, path, varint tag if      */
+/*            FORMAT2_TAGS                                                   */
+/*   ids    - per datapoint: varint length and id, base64 decoded if         */
+/*            FORMAT2_RAWIDS                                                 */
+
+#define FORMAT2_ZLIB    0x01    /* body compressed with zlib */
+#define FORMAT2_TAGS    0x02    /* datapoints have a tag */
+#define FORMAT2_RAWIDS  0x04    /* ids are stored base64 decoded */
+
+#define SV1_PRESENT     0x10
+#define SV2_PRESENT     0x20
+
+static const char b64chars[] = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/";
+
+static int b64_value(char c){
+    const char *p = (c != '\0') ? strchr(b64chars, c) : NULL;
+    return p ? (int)(p - b64chars) : -1;
+}
 
-    if (close(tree->fd) < 0){
+/* length of the decoded id, -1 if id is not canonical base64 (so that */
+/* encoding the decoded bytes gives back id)                           */
+static long b64_decoded_len(const char *id, size_t len){
+    size_t i, pad = 0;
+    if (len % 4 != 0) return -1;
+    if (len > 0 && id[len-1] == '=') pad++;
+    if (len > 1 && id[len-2] == '=') pad++;
+    for (i=0;i<len-pad;i++){
+        if (b64_value(id[i]) < 0) return -1;
+    }
+    /* the bits past the end of the data must be zero */
+    if (pad == 1 && (b64_value(id[len-2]) & 0x03)) return -1;
+    if (pad == 2 && (b64_value(id[len-3]) & 0x0f)) return -1;
+    return (long)(len/4*3 - pad);
+}
+
+/* decode len chars of id into out, returns the number of bytes */
+static size_t b64_decode(const char *id, size_t len, unsigned char *out){
+    size_t i, n = 0;
+    for (i=0;i<len;i+=4){
+        uint32_t v = 0;
+        int j;
+        for (j=0;j<4;j++){
+            v = (v << 6) | ((id[i+j] == '=') ? 0 : b64_value(id[i+j]));
+        }
+        out[n++] = (v >> 16) & 0xff;
+        if (id[i+2] != '=') out[n++] = (v >> 8) & 0xff;
+        if (id[i+3] != '=') out[n++] = v & 0xff;
+    }
+    return n;
+}
+
+/* encode n bytes into out, which must hold 4*((n+2)/3)+1 chars */
+static void b64_encode(const unsigned char *src, size_t n, char *out){
+    size_t i;
+    for (i=0;i<n;i+=3){
+        uint32_t v = src[i] << 16;
+        if (i+1 < n) v |= src[i+1] << 8;
+        if (i+2 < n) v |= src[i+2];
+        *out++ = b64chars[(v >> 18) & 0x3f];
+        *out++ = b64chars[(v >> 12) & 0x3f];
+        *out++ = (i+1 < n) ? b64chars[(v >> 6) & 0x3f] : '=';
+        *out++ = (i+2 < n) ? b64chars[v & 0x3f] : '=';
+    }
+    *out = '\0';
+}
+
+/* whether all the ids of the subtree are canonical base64 */
+static int ids_are_base64(MVPTree *tree, Node *node){
+    if (node == NULL) return 1;
+    MVPDP *sv[2] = {node->leaf.sv1, node->leaf.sv2};
+    int i;
+    for (i=0;i<2;i++){
+        if (sv[i] && b64_decoded_len(sv[i]->id, strlen(sv[i]->id)) < 0) return 0;
+    }
+    if (node->leaf.type == LEAF_NODE){
+        for (i=0;i<node->leaf.nbpoints;i++){
+            MVPDP *dp = node->leaf.points[i];
+            if (b64_decoded_len(dp->id, strlen(dp->id)) < 0) return 0;
+        }
+    } else {
+        for (i=0;i<(tree->branchfactor)*(tree->branchfactor);i++){
+            if (!ids_are_base64(tree, node->internal.child_nodes[i])) return 0;
+        }
+    }
+    return 1;
+}
+
+#define STREAM_CHUNK 65536
+
+/* Output of a MVP_FORMAT2 tree: written to fd, or with fd < 0 to buf, which */
+/* grows as needed. The bytes are gathered in chunk and, once deflating is  */
+/* set, compressed through zs, so the tree is never held whole in memory.   */
+typedef struct stream_t {
+    int fd;
+    char *buf;
+    size_t size, cap;
+    unsigned char *chunk, *zchunk;
+    size_t len;
+    z_stream zs;
+    int deflating;
+    MVPError error;
+} Stream;
+
+static MVPError stream_init(Stream *out, int fd){
+    memset(out, 0, sizeof(Stream));
+    out->fd = fd;
+    out->chunk = (unsigned char*)malloc(STREAM_CHUNK);
+    out->zchunk = (unsigned char*)malloc(STREAM_CHUNK);
+    return (out->chunk && out->zchunk) ? MVP_SUCCESS : MVP_MEMALLOC;
+}
+
+static void stream_free(Stream *out){
+    if (out->deflating) deflateEnd(&out->zs);
+    free(out->chunk);
+    free(out->zchunk);
+    free(out->buf);
+}
+
+/* make room for size bytes in the buffer of out */
+static void stream_reserve(Stream *out, size_t size){
+    if (out->fd >= 0 || size <= out->cap || out->error != MVP_SUCCESS) return;
+    char *buf = (char*)realloc(out->buf, size);
+    if (buf == NULL){
+        out->error = MVP_MEMALLOC;
+        return;
+    }
+    out->buf = buf;
+    out->cap = size;
+}
+
+static void stream_write(Stream *out, const unsigned char *src, size_t n){
+    if (out->error != MVP_SUCCESS) return;
+    if (out->fd < 0){
+        if (out->size + n > out->cap){
+            stream_reserve(out, (out->size + n > 2*out->cap) ? out->size + n : 2*out->cap);
+            if (out->error != MVP_SUCCESS) return;
+        }
+        memcpy(out->buf + out->size, src, n);
+        out->size += n;
+        return;
+    }
+    while (n > 0){
+        ssize_t done = write(out->fd, src, n);
+        if (done < 0 && errno != EINTR){
+            out->error = MVP_NOWRITE;
+            return;
+        } else if (done > 0){
+            src += done;
+            n -= done;
+        }
+    }
+}
+
+/* pass the gathered bytes on; finish ends the zlib stream */
+static void stream_flush(Stream *out, int finish){
+    if (!out->deflating){
+        stream_write(out, out->chunk, out->len);
+        out->len = 0;
+        return;
+    }
+    int ret;
+    out->zs.next_in = out->chunk;
+    out->zs.avail_in = out->len;
+    do {
+        out->zs.next_out = out->zchunk;
+        out->zs.avail_out = STREAM_CHUNK;
+        ret = deflate(&out->zs, finish ? Z_FINISH : Z_NO_FLUSH);
+        if (ret == Z_STREAM_ERROR){
+            out->error = MVP_NOWRITE;
+            break;
+        }
+        stream_write(out, out->zchunk, STREAM_CHUNK - out->zs.avail_out);
+    } while (out->zs.avail_out == 0 || (finish && ret != Z_STREAM_END));
+    out->len = 0;
+}
+
+static void stream_put(Stream *out, const void *src, size_t n){
+    const unsigned char *bytes = (const unsigned char*)src;
+    while (n > 0){
+        size_t k = (n < STREAM_CHUNK - out->len) ? n : STREAM_CHUNK - out->len;
+        memcpy(out->chunk + out->len, bytes, k);
+        out->len += k;
+        bytes += k;
+        n -= k;
+        if (out->len == STREAM_CHUNK) stream_flush(out, 0);
+    }
+}
+
+/* output cursor of a section; with a NULL out only the length is counted */
+typedef struct section_t {
+    Stream *out;
+    size_t pos;
+} Section;
+
+static void sec_put(Section *sec, const void *src, size_t n){
+    if (sec->out) stream_put(sec->out, src, n);
+    sec->pos += n;
+}
+
+static void sec_varint(Section *sec, uint64_t value){
+    do {
+        uint8_t byte = value & 0x7f;
+        value >>= 7;
+        if (value) byte |= 0x80;
+        sec_put(sec, &byte, 1);
+    } while (value);
+}
+
+typedef struct format2_t {
+    MVPTree *tree;
+    int flags;
+    uint64_t nbpoints;
+    Section nodes, points, ids;
+} Format2;
+
+static void write_point2(Format2 *w, MVPDP *dp){
+    MVPTree *tree = w->tree;
+    size_t idlen = strlen(dp->id);
+
+    sec_varint(&w->points, dp->datalen);
+    sec_put(&w->points, dp->data, dp->datalen*dp->type);
+    sec_put(&w->points, dp->path, tree->pathlength*tree->disttype);
+    if (w->flags & FORMAT2_TAGS) sec_varint(&w->points, dp->tag);
+
+    if (w->flags & FORMAT2_RAWIDS){
+        size_t i, rawlen = b64_decoded_len(dp->id, idlen);
+        unsigned char raw[3];
+        sec_varint(&w->ids, rawlen);
+        for (i=0;i<idlen;i+=4){
+            sec_put(&w->ids, raw, b64_decode(dp->id + i, 4, raw));
+        }
+    } else {
+        sec_varint(&w->ids, idlen);
+        sec_put(&w->ids, dp->id, idlen);
+    }
+    w->nbpoints++;
+}
+
+static MVPError write_node2(Format2 *w, Node *node){
+    MVPTree *tree = w->tree;
+    size_t dt = tree->disttype;
+    uint8_t head = 0;
+
+    if (node == NULL){
+        sec_put(&w->nodes, &head, 1);
+        return MVP_SUCCESS;
+    }
+    if (node->leaf.type != LEAF_NODE && node->internal.type != INTERNAL_NODE){
+        return MVP_UNRECOGNIZED;
+    }
+
+    head = (uint8_t)node->leaf.type;
+    if (node->leaf.sv1) head |= SV1_PRESENT;
+    if (node->leaf.sv2) head |= SV2_PRESENT;
+    sec_put(&w->nodes, &head, 1);
+    if (node->leaf.sv1) write_point2(w, node->leaf.sv1);
+    if (node->leaf.sv2) write_point2(w, node->leaf.sv2);
+
+    if (node->leaf.type == LEAF_NODE){
+        unsigned int i;
+        sec_varint(&w->nodes, node->leaf.nbpoints);
+        for (i=0;i<node->leaf.nbpoints;i++){
+            sec_put(&w->nodes, DIST_PTR(node->leaf.d1, i, dt), dt);
+            sec_put(&w->nodes, DIST_PTR(node->leaf.d2, i, dt), dt);
+            write_point2(w, node->leaf.points[i]);
+        }
+    } else {
+        int i, bf = tree->branchfactor;
+        sec_put(&w->nodes, node->internal.M1, (bf-1)*dt);
+        sec_put(&w->nodes, node->internal.M2, (bf-1)*bf*dt);
+        for (i=0;i<bf*bf;i++){
+            MVPError error = write_node2(w, node->internal.child_nodes[i]);
+            if (error != MVP_SUCCESS) return error;
+        }
+    }
+    return MVP_SUCCESS;
+}
+
+/* write the tree in MVP_FORMAT2 to out */
+static MVPError _mvptree_write_v2(MVPTree *tree, Stream *out, MVPFormat format){
+    Format2 w;
+    memset(&w, 0, sizeof(Format2));
+    w.tree = tree;
+    if (format == MVP_FORMAT2_ZLIB) w.flags |= FORMAT2_ZLIB;
+    if (has_tags(tree, tree->node)) w.flags |= FORMAT2_TAGS;
+    if (ids_are_base64(tree, tree->node)) w.flags |= FORMAT2_RAWIDS;
+
+    /* measure the sections */
+    MVPError error = write_node2(&w, tree->node);
+    if (error != MVP_SUCCESS) return error;
+
+    Section preamble = {NULL, 0};
+    sec_varint(&preamble, w.nbpoints);
+    sec_varint(&preamble, w.nodes.pos);
+    sec_varint(&preamble, w.points.pos);
+    sec_varint(&preamble, w.ids.pos);
+    uint64_t bodylen = preamble.pos + w.nodes.pos + w.points.pos + w.ids.pos;
+    if (!(w.flags & FORMAT2_ZLIB)) stream_reserve(out, HEADER_SIZE + bodylen);
+
+    char header[HEADER_SIZE];
+    memset(header, 0, HEADER_SIZE);
+    tree->version = FORMAT2_VERSION;
+    write_header(tree, header);
+    header[28] = (char)tree->metric;
+    header[29] = (char)w.flags;
+    stream_put(out, header, HEADER_SIZE);
+
+    if (w.flags & FORMAT2_ZLIB){
+        stream_put(out, &bodylen, sizeof(uint64_t));
+        stream_flush(out, 0);
+        if (deflateInit(&out->zs, Z_BEST_COMPRESSION) != Z_OK) return MVP_MEMALLOC;
+        out->deflating = 1;
+    }
+
+    preamble.out = out;
+    sec_varint(&preamble, w.nbpoints);
+    sec_varint(&preamble, w.nodes.pos);
+    sec_varint(&preamble, w.points.pos);
+    sec_varint(&preamble, w.ids.pos);
+
+    /* then stream the sections one after the other, a traversal each */
+    Section *sections[3] = {&w.nodes, &w.points, &w.ids};
+    int i;
+    for (i=0;i<3;i++){
+        w.nodes.pos = w.points.pos = w.ids.pos = 0;
+        w.nbpoints = 0;
+        sections[i]->out = out;
+        write_node2(&w, tree->node);
+        sections[i]->out = NULL;
+    }
+    stream_flush(out, 1);
+
+    return out->error;
+}
+
+/* create a unique temporary file next to filename */
+static int open_tempfile(const char *filename, char *tmpname, size_t len, int mode){
+    static unsigned int counter = 0;
+    int i, fd = -1;
+    for (i = 0;i < 100 && fd < 0;i++){
+        snprintf(tmpname, len, "%s.%d.%u.tmp", filename, (int)getpid(), counter++);
+        fd = open(tmpname, O_CREAT|O_EXCL|O_RDWR, mode);
+        if (fd < 0 && errno != EEXIST) break;
+    }
+    return fd;
+}
+
+/* fsync the directory containing filename, to make a rename durable */
+static int sync_parent_dir(const char *filename){
+    size_t len = strlen(filename);
+    char dirname[len + 2];
+    strcpy(dirname, filename);
+
+    char *slash = strrchr(dirname, '/');
+    if (slash == NULL){
+        strcpy(dirname, ".");
+    } else if (slash == dirname){
+        dirname[1] = '\0';
+    } else {
+        *slash = '\0';
+    }
+
+    int fd = open(dirname, O_RDONLY);
+    if (fd < 0) return -1;
+    int ret = fsync(fd);
+    close(fd);
+    return ret;
+}
+
+/* write the tree in MVP_FORMAT1 to fd, sized and mapped to the exact length */
+static MVPError write_format1(MVPTree *tree, int fd){
+    MVPError error = MVP_SUCCESS;
+    off_t size = _mvptree_serialized_size(tree, &error);
+    if (error != MVP_SUCCESS){
+        return error;
+    }
+
+    if (ftruncate(fd, size) < 0){
+        return MVP_FILETRUNCATE;
+    }
+
+    char *buf = (char*)mmap(NULL, size, PROT_READ|PROT_WRITE, MAP_SHARED, fd, 0);
+    if (buf == MAP_FAILED){
+        return MVP_MEMMAP;
+    }
+
+    error = _mvptree_serialize(tree, buf);
+
+    if (munmap(buf, size) < 0 && error == MVP_SUCCESS){
+        error = MVP_MUNMAP;
+    }
+    return error;
+}
+
+/* write the tree in MVP_FORMAT2 to fd, or to a new buffer with fd < 0 */
+static MVPError write_format2(MVPTree *tree, MVPFormat format, int fd, char **buffer, size_t *size){
+    Stream out;
+    MVPError error = stream_init(&out, fd);
+    if (error == MVP_SUCCESS){
+        error = _mvptree_write_v2(tree, &out, format);
+    }
+    if (error == MVP_SUCCESS && buffer){
+        *buffer = out.buf;
+        *size = out.size;
+        out.buf = NULL;
+    }
+    stream_free(&out);
+    return error;
+}
+
+MVPError mvptree_write(MVPTree *tree, const char *filename, int mode, int sync){
+    if (!tree) return MVP_ARGERR;
+    return mvptree_write_format(tree, filename, mode, sync, tree->format);
+}
+
+MVPError mvptree_write_format(MVPTree *tree, const char *filename, int mode, int sync,
+                              MVPFormat format){
+    if (!tree || !tree->dist || !filename || !valid_format(format)){
+        return MVP_ARGERR;
+    }
+
+    /* write a temporary file, then rename it over filename */
+    char tmpname[strlen(filename) + 64];
+    int fd = open_tempfile(filename, tmpname, sizeof(tmpname), mode);
+    if (fd < 0){
+        return MVP_FILEOPEN;
+    }
+
+    MVPError error = (format == MVP_FORMAT1) ? write_format1(tree, fd) : write_format2(tree, format, fd, NULL, NULL);
+
+    if (sync && error == MVP_SUCCESS && fsync(fd) < 0){
+        error = MVP_NOWRITE;
+    }
+
+    if (close(fd) < 0 && error == MVP_SUCCESS){
         error = MVP_FILECLOSE;
     }
 
+    if (error == MVP_SUCCESS && rename(tmpname, filename) < 0){
+        error = MVP_FILEOPEN;
+    }
+
+    if (error != MVP_SUCCESS){
+        unlink(tmpname);
+    } else if (sync && sync_parent_dir(filename) < 0){
+        error = MVP_NOWRITE;
+    }
+
     return error;
 }
 
-static MVPDP* read_datapoint(MVPTree *tree){
+MVPError mvptree_write_buffer(MVPTree *tree, char **buffer, size_t *size){
+    if (!tree) return MVP_ARGERR;
+    return mvptree_write_buffer_format(tree, buffer, size, tree->format);
+}
+
+MVPError mvptree_write_buffer_format(MVPTree *tree, char **buffer, size_t *size, MVPFormat format){
+    if (!tree || !tree->dist || !buffer || !size || !valid_format(format)){
+        return MVP_ARGERR;
+    }
+    *buffer = NULL;
+    *size = 0;
+
+    if (format != MVP_FORMAT1){
+        return write_format2(tree, format, -1, buffer, size);
+    }
+
+    MVPError error = MVP_SUCCESS;
+    off_t length = _mvptree_serialized_size(tree, &error);
+    if (error != MVP_SUCCESS){
+        return error;
+    }
+
+    char *buf = (char*)calloc(length, 1);
+    if (buf == NULL){
+        return MVP_MEMALLOC;
+    }
+
+    error = _mvptree_serialize(tree, buf);
+    if (error == MVP_SUCCESS){
+        *buffer = buf;
+        *size = length;
+    } else {
+        free(buf);
+    }
+
+    return error;
+}
+
+/* input cursor over a serialized tree, or a section of a MVP_FORMAT2 body */
+typedef struct reader_t {
+    const unsigned char *pos, *end;
+} Reader;
+
+static const unsigned char* rd_bytes(Reader *rd, size_t n){
+    if ((size_t)(rd->end - rd->pos) < n) return NULL;
+    const unsigned char *start = rd->pos;
+    rd->pos += n;
+    return start;
+}
+
+static int rd_varint(Reader *rd, uint64_t *value){
+    int shift;
+    *value = 0;
+    for (shift = 0; shift < 64 && rd->pos < rd->end; shift += 7){
+        uint8_t byte = *rd->pos++;
+        *value |= (uint64_t)(byte & 0x7f) << shift;
+        if (!(byte & 0x80)) return 0;
+    }
+    return -1;
+}
+
+static int rd_copy(Reader *rd, void *dst, size_t n){
+    const unsigned char *src = rd_bytes(rd, n);
+    if (!src) return -1;
+    memcpy(dst, src, n);
+    return 0;
+}
+
+/* Move rd to offset of the MVP_FORMAT1 data of tree. The writer lays out the */
+/* nodes and points in the order they are read, so an offset before the data */
+/* read so far (tree->pos) is corrupt: it would share or loop over nodes.     */
+static int rd_seek(MVPTree *tree, Reader *rd, off_t offset){
+    if (offset < tree->pos || offset >= tree->size) return -1;
+    rd->pos = (const unsigned char*)tree->buf + offset;
+    rd->end = (const unsigned char*)tree->buf + tree->size;
+    return 0;
+}
+
+static void rd_done(MVPTree *tree, const Reader *rd){
+    off_t pos = (off_t)(rd->pos - (const unsigned char*)tree->buf);
+    if (pos > tree->pos) tree->pos = pos;
+}
+
+/* read a datapoint into *result, left NULL for an empty slot */
+static MVPError read_datapoint(MVPTree *tree, Reader *rd, MVPDP **result){
     uint8_t active;
 
     // TODO: The length of this field is not limited. We MUST change
     // the way we serialize this data. 
     unsigned int idlen;
 
-    uint32_t bytelength, datalength;
+    uint32_t bytelength, datalength, dptag = 0;
+    const unsigned char *id, *data, *path;
+    size_t pathlen = tree->pathlength*tree->disttype;
 
-    memcpy(&active, &tree->buf[tree->pos], sizeof(active));
-    tree->pos += sizeof(active);
-    memcpy(&bytelength, &tree->buf[tree->pos], sizeof(bytelength));
-    tree->pos += sizeof(bytelength);
+    *result = NULL;
+    if (rd_copy(rd, &active, sizeof(active)) < 0 || rd_copy(rd, &bytelength, sizeof(bytelength)) < 0){
+        return MVP_FILECORRUPT;
+    }
+    if (active == 0 && bytelength == 0) return MVP_SUCCESS;
 
-    if (active == 0 && bytelength == 0) return NULL;
+    if (rd_copy(rd, &idlen, sizeof(idlen)) < 0 || !(id = rd_bytes(rd, idlen)) ||\
+        rd_copy(rd, &datalength, sizeof(datalength)) < 0 ||\
+        datalength > (size_t)(rd->end - rd->pos)/tree->datatype ||\
+        !(data = rd_bytes(rd, (size_t)datalength*tree->datatype)) || !(path = rd_bytes(rd, pathlen))){
+        return MVP_FILECORRUPT;
+    }
+    if (tree->version > UNTAGGED_VERSION && rd_copy(rd, &dptag, sizeof(dptag)) < 0){
+        return MVP_FILECORRUPT;
+    }
 
     MVPDP *dp = dp_alloc(tree->datatype);
-    if (!dp) return NULL;
-
-    dp->path = (float*)malloc(tree->pathlength*sizeof(float));
-    if (!dp->path) return NULL;
-
-    memcpy(&idlen, &tree->buf[tree->pos], sizeof(unsigned int));
-    tree->pos += sizeof(unsigned int);
+    if (!dp) return MVP_MEMALLOC;
+    dp->datalen = datalength;
+    dp->tag = dptag;
     dp->id = malloc(idlen+1);
-    memcpy(dp->id, &tree->buf[tree->pos], idlen);
-
-    tree->pos += idlen;
+    dp->data = malloc((size_t)datalength*tree->datatype);
+    dp->path = malloc(pathlen);
+    if (!dp->id || !dp->data || !dp->path){
+        dp_free(dp, free);
+        return MVP_MEMALLOC;
+    }
+    memcpy(dp->id, id, idlen);
     dp->id[idlen] = '\0';
-    memcpy(&datalength, &tree->buf[tree->pos], sizeof(uint32_t));
-    tree->pos += sizeof(uint32_t);
-
-    dp->datalen = datalength;
-    dp->data = malloc(datalength*tree->datatype);
-    memcpy(dp->data, &tree->buf[tree->pos], datalength*tree->datatype);
-    tree->pos += datalength*tree->datatype;
-    memcpy(dp->path, &tree->buf[tree->pos], tree->pathlength*sizeof(float));
-    tree->pos += tree->pathlength*sizeof(float);
+    memcpy(dp->data, data, (size_t)datalength*tree->datatype);
+    memcpy(dp->path, path, pathlen);
 
-    return dp;
+    *result = dp;
+    return MVP_SUCCESS;
 }
 
-static Node* _mvptree_read_node(MVPTree *tree, MVPError *error, int lvl){
+/* read the node at the position of rd and its children. On error the node */
+/* read so far is returned, for node_release to free it.                   */
+static Node* _mvptree_read_node(MVPTree *tree, Reader *rd, MVPError *error, int lvl){
     uint8_t node_type;
     Node *node = NULL;
-    memcpy(&node_type, &tree->buf[tree->pos++], sizeof(uint8_t));
+    size_t dt = tree->disttype;
+    uint64_t left;
+
+    if (rd_copy(rd, &node_type, sizeof(uint8_t)) < 0){
+        *error = MVP_FILECORRUPT;
+        return NULL;
+    }
+    left = (uint64_t)(rd->end - rd->pos);
 
     if (node_type == LEAF_NODE){
         uint32_t nbpoints;
-        node = create_leaf(tree->leafcap);
+        /* the writer reserves leafcap slots, do not allocate them for less */
+        if (tree->leafcap > left/(2*dt + sizeof(off_t))){
+            *error = MVP_FILECORRUPT;
+            return NULL;
+        }
+        node = create_leaf(tree->leafcap, tree->disttype);
         if (!node){
             *error = MVP_NOLEAF;
             return node;
         }
-        node->leaf.sv1 = read_datapoint(tree);
-        node->leaf.sv2 = read_datapoint(tree);
-
-        memcpy(&nbpoints,&tree->buf[tree->pos], sizeof(uint32_t));
-        tree->pos += sizeof(uint32_t);
-        node->leaf.nbpoints = nbpoints;
+        if ((*error = read_datapoint(tree, rd, &node->leaf.sv1)) != MVP_SUCCESS ||\
+            (*error = read_datapoint(tree, rd, &node->leaf.sv2)) != MVP_SUCCESS){
+            return node;
+        }
+        if (rd_copy(rd, &nbpoints, sizeof(uint32_t)) < 0 || nbpoints > tree->leafcap){
+            *error = MVP_FILECORRUPT;
+            return node;
+        }
+        rd_done(tree, rd);
 
-        off_t saved_pos = tree->pos;
         int i;
         off_t offset;
-
-        // XXX
-        if (nbpoints >= tree->leafcap + 2) {
-            printf("ERROR... too many points %d >= %d\n", nbpoints, tree->leafcap + 2);
-        }
-
+        Reader point;
         for (i = 0;i < nbpoints;i++){
-            memcpy(&(node->leaf.d1[i]), &tree->buf[saved_pos], sizeof(float));
-            saved_pos += sizeof(float);
-            memcpy(&(node->leaf.d2[i]), &tree->buf[saved_pos], sizeof(float));
-            saved_pos += sizeof(float);
-            memcpy(&offset, &tree->buf[saved_pos], sizeof(off_t));
-            saved_pos += sizeof(off_t);
-
-            tree->pos = offset;
-            node->leaf.points[i] = read_datapoint(tree);
+            if (rd_copy(rd, DIST_PTR(node->leaf.d1, i, dt), dt) < 0 ||\
+                rd_copy(rd, DIST_PTR(node->leaf.d2, i, dt), dt) < 0 ||\
+                rd_copy(rd, &offset, sizeof(off_t)) < 0 || rd_seek(tree, &point, offset) < 0){
+                *error = MVP_FILECORRUPT;
+                break;
+            }
+            *error = read_datapoint(tree, &point, &node->leaf.points[i]);
+            if (*error == MVP_SUCCESS && !node->leaf.points[i]) *error = MVP_FILECORRUPT;
+            if (*error != MVP_SUCCESS) break;
+            node->leaf.nbpoints++;
+            rd_done(tree, &point);
         }
     } else if (node_type == INTERNAL_NODE){
-        int bf = tree->branchfactor;
-        int lengthM1 = bf - 1;
-        int lengthM2 = (bf - 1)*bf;
-        int fanout   = bf*bf;
+        uint64_t bf = tree->branchfactor;
+        uint64_t lengthM1 = bf - 1;
+        uint64_t lengthM2 = (bf - 1)*bf;
+        uint64_t fanout   = bf*bf;
         uint8_t fileno;
 
-        node = create_internal(bf);
+        if (fanout > left/(sizeof(fileno) + sizeof(off_t))){
+            *error = MVP_FILECORRUPT;
+            return NULL;
+        }
+        node = create_internal(bf, tree->disttype);
         if (node == NULL){
             *error = MVP_NOINTERNAL;
             return node;
         }
-        node->internal.sv1 = read_datapoint(tree);
-        node->internal.sv2 = read_datapoint(tree);
-
-        memcpy(node->internal.M1, &tree->buf[tree->pos], lengthM1*sizeof(float));
-        tree->pos += lengthM1*sizeof(float);
-        memcpy(node->internal.M2, &tree->buf[tree->pos], lengthM2*sizeof(float));
-        tree->pos += lengthM2*sizeof(float);
+        if ((*error = read_datapoint(tree, rd, &node->internal.sv1)) != MVP_SUCCESS ||\
+            (*error = read_datapoint(tree, rd, &node->internal.sv2)) != MVP_SUCCESS){
+            return node;
+        }
+        if (rd_copy(rd, node->internal.M1, lengthM1*dt) < 0 ||\
+            rd_copy(rd, node->internal.M2, lengthM2*dt) < 0){
+            *error = MVP_FILECORRUPT;
+            return node;
+        }
+        rd_done(tree, rd);
 
         int i;
-        off_t offset, saved_pos = tree->pos;
+        off_t offset;
+        Reader child;
         for (i = 0;i < fanout; i++){
-            memcpy(&fileno, &tree->buf[saved_pos], sizeof(fileno));
-            saved_pos += sizeof(fileno);
-            memcpy(&offset, &tree->buf[saved_pos], sizeof(offset));
-            saved_pos += sizeof(offset);
-            if (offset == 0) {
-                node->internal.child_nodes[i] = NULL;
-                continue;
-            } else {
-                tree->pos = offset;
-                node->internal.child_nodes[i] = _mvptree_read_node(tree, error, lvl+2);
-                if (*error != MVP_SUCCESS) break;
+            if (rd_copy(rd, &fileno, sizeof(fileno)) < 0 || rd_copy(rd, &offset, sizeof(offset)) < 0){
+                *error = MVP_FILECORRUPT;
+                break;
             }
+            if (offset == 0) continue;
+            if (rd_seek(tree, &child, offset) < 0){
+                *error = MVP_FILECORRUPT;
+                break;
+            }
+            node->internal.child_nodes[i] = _mvptree_read_node(tree, &child, error, lvl+2);
+            if (*error != MVP_SUCCESS) break;
+            rd_done(tree, &child);
         }
 
     } else {
@@ -1164,46 +2388,205 @@ static Node* _mvptree_read_node(MVPTree *tree, MVPError *error, int lvl){
     return node;
 }
 
-MVPTree* mvptree_read(const char *filename, CmpFunc fnc, int branchfactor, int pathlength,\
-    int leafcapacity,MVPError *error){
-    if (!error) return NULL;
-    *error = MVP_SUCCESS;
-    if (!filename || !fnc) {
-        *error = MVP_ARGERR;
+static MVPDP* read_point2(MVPTree *tree, Reader *points, Reader *ids, int flags){
+    uint64_t datalen, idlen, dptag = 0;
+    const unsigned char *data, *path, *id;
+    size_t pathlen = tree->pathlength*tree->disttype;
+
+    if (rd_varint(points, &datalen) < 0 || datalen > (uint64_t)(points->end - points->pos) ||\
+        !(data = rd_bytes(points, datalen*tree->datatype)) || !(path = rd_bytes(points, pathlen))){
+        return NULL;
+    }
+    if ((flags & FORMAT2_TAGS) && (rd_varint(points, &dptag) < 0 || dptag > UINT_MAX)){
+        return NULL;
+    }
+    if (rd_varint(ids, &idlen) < 0 || !(id = rd_bytes(ids, idlen))){
         return NULL;
     }
-    MVPTree *tree = NULL;
 
-    int fd = open(filename, O_RDONLY);
-    if (fd < 0){
-    /* file not found return empty tree */
-        tree = mvptree_alloc(NULL, fnc, branchfactor, pathlength, leafcapacity);
-        *error = MVP_FILENOTFOUND;
-        return tree;
+    MVPDP *dp = dp_alloc(tree->datatype);
+    if (!dp) return NULL;
+    dp->datalen = datalen;
+    dp->tag = dptag;
+    dp->data = malloc(datalen*tree->datatype);
+    dp->path = malloc(pathlen);
+    dp->id = malloc((flags & FORMAT2_RAWIDS) ? 4*((idlen+2)/3)+1 : idlen+1);
+    if (!dp->data || !dp->path || !dp->id){
+        dp_free(dp, free);
+        return NULL;
     }
-    struct stat file_info;
-    if (fstat(fd, &file_info) < 0){
-        *error = MVP_FILEOPEN;
+    memcpy(dp->data, data, datalen*tree->datatype);
+    memcpy(dp->path, path, pathlen);
+    if (flags & FORMAT2_RAWIDS){
+        b64_encode(id, idlen, dp->id);
+    } else {
+        memcpy(dp->id, id, idlen);
+        dp->id[idlen] = '\0';
+    }
+    return dp;
+}
+
+/* read a node and its children, taking their datapoints from dps in order */
+static Node* read_node2(MVPTree *tree, Reader *nodes, MVPDP **dps, uint64_t nbpoints,\
+                        uint64_t *next, MVPError *error){
+    size_t dt = tree->disttype;
+    const unsigned char *head = rd_bytes(nodes, 1);
+    if (!head){
+        *error = MVP_FILECORRUPT;
         return NULL;
     }
-    off_t size = file_info.st_size;
+    if (*head == 0) return NULL;
 
-    char *buf = (char*)mmap(NULL, size, PROT_READ, MAP_SHARED, fd, 0);
-    if (buf == NULL){
-        *error = MVP_MEMMAP;
-        close(fd);
+    Node *node = NULL;
+    int type = *head & 0x0f;
+    if (type == LEAF_NODE){
+        node = create_leaf(tree->leafcap, tree->disttype);
+        if (!node) *error = MVP_NOLEAF;
+    } else if (type == INTERNAL_NODE){
+        node = create_internal(tree->branchfactor, tree->disttype);
+        if (!node) *error = MVP_NOINTERNAL;
+    } else {
+        *error = MVP_UNRECOGNIZED;
+    }
+    if (!node) return NULL;
+
+    if (*head & SV1_PRESENT){
+        if (*next >= nbpoints) goto corrupt;
+        node->leaf.sv1 = dps[(*next)++];
+    }
+    if (*head & SV2_PRESENT){
+        if (*next >= nbpoints) goto corrupt;
+        node->leaf.sv2 = dps[(*next)++];
+    }
+
+    if (type == LEAF_NODE){
+        uint64_t i, count;
+        const unsigned char *d1, *d2;
+        if (rd_varint(nodes, &count) < 0 || count > tree->leafcap) goto corrupt;
+        for (i=0;i<count;i++){
+            if (!(d1 = rd_bytes(nodes, dt)) || !(d2 = rd_bytes(nodes, dt)) || *next >= nbpoints){
+                goto corrupt;
+            }
+            memcpy(DIST_PTR(node->leaf.d1, i, dt), d1, dt);
+            memcpy(DIST_PTR(node->leaf.d2, i, dt), d2, dt);
+            node->leaf.points[i] = dps[(*next)++];
+            node->leaf.nbpoints++;
+        }
+    } else {
+        int i, bf = tree->branchfactor;
+        const unsigned char *M1, *M2;
+        if (!(M1 = rd_bytes(nodes, (bf-1)*dt)) || !(M2 = rd_bytes(nodes, (bf-1)*bf*dt))){
+            goto corrupt;
+        }
+        memcpy(node->internal.M1, M1, (bf-1)*dt);
+        memcpy(node->internal.M2, M2, (bf-1)*bf*dt);
+        for (i=0;i<bf*bf && *error == MVP_SUCCESS;i++){
+            node->internal.child_nodes[i] = read_node2(tree, nodes, dps, nbpoints, next, error);
+        }
+    }
+    return node;
+
+corrupt:
+    *error = MVP_FILECORRUPT;
+    return node;
+}
+
+/* read the MVP_FORMAT2 body of buf into tree */
+static MVPError _mvptree_read_v2(MVPTree *tree, const char *buf, size_t size){
+    MVPError error = MVP_SUCCESS;
+    uint8_t flags = (uint8_t)buf[29];
+    const unsigned char *body = (const unsigned char*)buf + HEADER_SIZE;
+    size_t bodylen = size - HEADER_SIZE;
+    unsigned char *inflated = NULL;
+
+    tree->metric = (MVPMetric)(uint8_t)buf[28];
+    tree->format = (flags & FORMAT2_ZLIB) ? MVP_FORMAT2_ZLIB : MVP_FORMAT2;
+
+    if (flags & FORMAT2_ZLIB){
+        uint64_t rawlen;
+        if (bodylen < sizeof(uint64_t)) return MVP_FILECORRUPT;
+        memcpy(&rawlen, body, sizeof(uint64_t));
+        uLongf inflatedlen = rawlen;
+        /* deflate compresses at most about 1032:1 */
+        if (inflatedlen != rawlen || rawlen/1032 > bodylen) return MVP_FILECORRUPT;
+        inflated = (unsigned char*)malloc(rawlen ? rawlen : 1);
+        if (!inflated) return MVP_MEMALLOC;
+        if (uncompress(inflated, &inflatedlen, body + sizeof(uint64_t),\
+                       bodylen - sizeof(uint64_t)) != Z_OK || inflatedlen != rawlen){
+            free(inflated);
+            return MVP_FILECORRUPT;
+        }
+        body = inflated;
+        bodylen = rawlen;
+    }
+
+    Reader preamble = {body, body + bodylen};
+    uint64_t nbpoints, nodeslen, pointslen, idslen;
+    if (rd_varint(&preamble, &nbpoints) < 0 || rd_varint(&preamble, &nodeslen) < 0 ||\
+        rd_varint(&preamble, &pointslen) < 0 || rd_varint(&preamble, &idslen) < 0 ||\
+        nodeslen > bodylen || pointslen > bodylen || idslen > bodylen ||\
+        nodeslen + pointslen + idslen != (uint64_t)(preamble.end - preamble.pos) ||\
+        nbpoints > pointslen){
+        free(inflated);
+        return MVP_FILECORRUPT;
+    }
+    Reader nodes  = {preamble.pos, preamble.pos + nodeslen};
+    Reader points = {nodes.end, nodes.end + pointslen};
+    Reader ids    = {points.end, points.end + idslen};
+
+    MVPDP **dps = (MVPDP**)calloc(nbpoints ? nbpoints : 1, sizeof(MVPDP*));
+    if (!dps){
+        free(inflated);
+        return MVP_MEMALLOC;
+    }
+    uint64_t i, next = 0;
+    for (i=0;i<nbpoints && error == MVP_SUCCESS;i++){
+        dps[i] = read_point2(tree, &points, &ids, flags);
+        if (!dps[i]) error = MVP_FILECORRUPT;
+    }
+
+    Node *root = NULL;
+    if (error == MVP_SUCCESS){
+        root = read_node2(tree, &nodes, dps, nbpoints, &next, &error);
+    }
+    if (error == MVP_SUCCESS && (next != nbpoints || nodes.pos != nodes.end)){
+        error = MVP_FILECORRUPT;
+    }
+
+    if (error == MVP_SUCCESS){
+        tree->node = root;
+    } else {
+        /* the datapoints are freed from dps, whether a node holds them or not */
+        free_nodes(tree, root);
+        for (i=0;i<nbpoints;i++){
+            dp_free(dps[i], free);
+        }
+    }
+    free(dps);
+    free(inflated);
+    return error;
+}
+
+/* parse a serialized tree from buf, which stays owned by the caller */
+static MVPTree* _mvptree_read_buffer(char *buf, off_t size, CmpFunc fnc, MVPError *error){
+    if (size < HEADER_SIZE || memcmp(buf, tag, strlen(tag)+1) != 0){
+        *error = MVP_UNRECOGNIZED;
         return NULL;
     }
+
+    MVPTree *tree = NULL;
     off_t pos = 0;
-    char line[16];
     int v;
     unsigned int bf, pl, lc;
-    uint8_t ht;
+    uint8_t ht, dt;
 
-    memcpy(line, &buf[pos], strlen(tag)+1);
     pos += strlen(tag)+1;
     memcpy(&v, &buf[pos], sizeof(int));
     pos += sizeof(int);
+    if (v > version){
+        *error = MVP_UNRECOGNIZED;
+        return NULL;
+    }
 
     memcpy(&bf, &buf[pos], sizeof(unsigned int));
     pos += sizeof(unsigned int);
@@ -1216,6 +2599,17 @@ MVPTree* mvptree_read(const char *filename, CmpFunc fnc, int branchfactor, int p
 
     memcpy(&ht, &buf[pos++], 1);
 
+    /* files written before distance types existed have a zero byte here */
+    memcpy(&dt, &buf[pos++], 1);
+
+    if (dt == 0) dt = MVP_FLOATDIST;
+    if ((dt != MVP_FLOATDIST && dt != MVP_UINT8DIST && dt != MVP_UINT16DIST) ||\
+        (ht != 0 && ht != MVP_BYTEARRAY && ht != MVP_UINT16ARRAY && ht != MVP_UINT32ARRAY &&\
+         ht != MVP_UINT64ARRAY) || bf < 2 || lc == 0 || pl > MAX_PATHLENGTH){
+        *error = MVP_FILECORRUPT;
+        return NULL;
+    }
+
     tree = mvptree_alloc(NULL, fnc, bf, pl, lc);
     if (!tree){
         *error = MVP_MEMALLOC;
@@ -1225,26 +2619,96 @@ MVPTree* mvptree_read(const char *filename, CmpFunc fnc, int branchfactor, int p
     tree->size = size;
     tree->buf = buf;
     tree->pos = HEADER_SIZE;
-    tree->fd = fd;
     tree->datatype = (MVPDataType)ht;
+    tree->disttype = (MVPDistType)dt;
+    tree->version = v;
     tree->dist = fnc;
-    tree->node = _mvptree_read_node(tree, error, 0);
 
-    if (munmap(buf, size) < 0){
-        *error = MVP_MUNMAP;
+    if (v >= FORMAT2_VERSION){
+        *error = _mvptree_read_v2(tree, buf, size);
+    } else if (size > HEADER_SIZE){
+        /* an empty MVP_FORMAT1 tree is just the header */
+        Reader rd = {(const unsigned char*)buf + HEADER_SIZE, (const unsigned char*)buf + size};
+        if (ht == 0){
+            *error = MVP_FILECORRUPT;
+        } else {
+            tree->node = _mvptree_read_node(tree, &rd, error, 0);
+        }
+        if (*error != MVP_SUCCESS){
+            node_release(tree, tree->node, free);
+            tree->node = NULL;
+        }
     }
+
     tree->buf = NULL;
+    tree->pos = 0;
+    tree->size = 0;
+
+    return tree;
+}
+
+MVPTree* mvptree_read(const char *filename, CmpFunc fnc, int branchfactor, int pathlength,\
+    int leafcapacity,MVPError *error){
+    if (!error) return NULL;
+    *error = MVP_SUCCESS;
+    if (!filename || !fnc) {
+        *error = MVP_ARGERR;
+        return NULL;
+    }
+    MVPTree *tree = NULL;
 
-    if (close(fd)<0){
+    int fd = open(filename, O_RDONLY);
+    if (fd < 0){
+    /* file not found return empty tree */
+        tree = mvptree_alloc(NULL, fnc, branchfactor, pathlength, leafcapacity);
+        *error = MVP_FILENOTFOUND;
+        return tree;
+    }
+    struct stat file_info;
+    if (fstat(fd, &file_info) < 0){
+        *error = MVP_FILEOPEN;
+        close(fd);
+        return NULL;
+    }
+    off_t size = file_info.st_size;
+    if (size < HEADER_SIZE){
+        /* also keeps an empty file from mmap, which rejects a zero length */
+        *error = MVP_UNRECOGNIZED;
+        close(fd);
+        return NULL;
+    }
+
+    char *buf = (char*)mmap(NULL, size, PROT_READ, MAP_SHARED, fd, 0);
+    if (buf == MAP_FAILED){
+        *error = MVP_MEMMAP;
+        close(fd);
+        return NULL;
+    }
+
+    tree = _mvptree_read_buffer(buf, size, fnc, error);
+
+    /* a parse error takes precedence over the cleanup ones */
+    if (munmap(buf, size) < 0 && *error == MVP_SUCCESS){
+        *error = MVP_MUNMAP;
+    }
+
+    if (close(fd) < 0 && *error == MVP_SUCCESS){
         *error = MVP_FILECLOSE;
     }
-    tree->buf = NULL;
-    tree->pos = 0;
-    tree->fd  = 0;
 
     return tree;
 }
 
+MVPTree* mvptree_read_buffer(const char *buffer, size_t size, CmpFunc fnc, MVPError *error){
+    if (!error) return NULL;
+    *error = MVP_SUCCESS;
+    if (!buffer || !fnc) {
+        *error = MVP_ARGERR;
+        return NULL;
+    }
+    return _mvptree_read_buffer((char*)buffer, (off_t)size, fnc, error);
+}
+
 static MVPError _mvptree_print(FILE *stream, MVPTree *tree, Node *node, int lvl){
     MVPError error = MVP_SUCCESS;
     Node *next_node = node;
@@ -1267,10 +2731,10 @@ static MVPError _mvptree_print(FILE *stream, MVPTree *tree, Node *node, int lvl)
             fprintf(stream, "  sv2: %s\n", next_node->internal.sv2->id);
             int i;
             for (i=0;i<lengthM1;i++){
-                fprintf(stream,"  M1[%d] = %.4f;", i, next_node->internal.M1[i]);
+                fprintf(stream,"  M1[%d] = %.4f;", i, dist_get(next_node->internal.M1, i, tree->disttype));
             }
             for (i=0;i<lengthM2;i++){
-                fprintf(stream,"  M2[%d] = %.4f;", i, next_node->internal.M2[i]);
+                fprintf(stream,"  M2[%d] = %.4f;", i, dist_get(next_node->internal.M2, i, tree->disttype));
             }
             fprintf(stream,"\n");
             for (i=0;i<fanout;i++){
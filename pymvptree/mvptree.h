@@ -31,6 +31,27 @@ typedef enum mvp_datatype_t {
     MVP_UINT64ARRAY = 8 
 } MVPDataType;
 
+/* storage type for distances kept in the tree (paths, d1/d2, M1/M2) - refers to the bitwidth */
+/* of each element. The integer types require a metric returning integer distances.        */
+typedef enum mvp_disttype_t {
+    MVP_UINT8DIST = 1,
+    MVP_UINT16DIST = 2,
+    MVP_FLOATDIST = 4
+} MVPDistType;
+
+/* file format written by mvptree_write() and mvptree_write_buffer() */
+typedef enum mvp_format_t {
+    MVP_FORMAT1 = 1,        /* fixed width fields and offsets, readable by all versions */
+    MVP_FORMAT2 = 2,        /* varint encoded sections, implicit child and point order  */
+    MVP_FORMAT2_ZLIB = 3    /* MVP_FORMAT2 with the sections compressed by zlib         */
+} MVPFormat;
+
+/* distance function of a tree, recorded in MVP_FORMAT2 files */
+typedef enum mvp_metric_t {
+    MVP_METRIC_UNKNOWN = 0,
+    MVP_METRIC_HAMMING = 1  /* number of differing bits */
+} MVPMetric;
+
 typedef enum nodetype_t { 
     INTERNAL_NODE = 1, 
     LEAF_NODE 
@@ -65,14 +86,18 @@ typedef enum mvp_error_t {
     MVP_BADDISTVAL,         /* val from distance function either NaN or less than 0 */
     MVP_FILENOTFOUND,       /* file not found */
     MVP_UNRECOGNIZED,       /* unrecognized node */
+    MVP_DISTRANGE,          /* distance not representable in the tree's distance type */
+    MVP_FILECORRUPT,        /* serialized tree is truncated or damaged */
 } MVPError;
 
 typedef struct mvp_datapoint_t {
     char *id;               /* null-terminated id string */
     void *data;             /* data for this data point */
-    float *path;            /* path of distances of data point from all vantage points down tree*/
+    void *path;             /* path of distances of data point from all vantage points down tree*/
     unsigned int datalen;   /* length of data in the type designated */    
     MVPDataType type;       /* type of data (the bitwidth of each data element) */
+    unsigned int tag;       /* user tag, e.g. a tenant or shard number, checked by MVPFilter */
+    unsigned int refs;      /* number of references: nodes, snapshots and results holding it */
 } MVPDP;
 
 
@@ -86,16 +111,18 @@ typedef void  (*MVPFreeFunc)(void *ptr);
 
 typedef struct node_internal_t {
     NodeType type;
+    unsigned int refs;      /* number of parents (or trees) holding the node */
     MVPDP *sv1, *sv2;
-    float *M1, *M2;
+    void *M1, *M2;          /* split values, stored as the tree's MVPDistType */
     void **child_nodes;
 } InternalNode;
 
 typedef struct node_leaf_t {
     NodeType type;
+    unsigned int refs;      /* number of parents (or trees) holding the node */
     MVPDP *sv1, *sv2;
     MVPDP **points;
-    float *d1, *d2;
+    void *d1, *d2;          /* distances to sv1/sv2, stored as the tree's MVPDistType */
     unsigned int nbpoints;
 } LeafNode;
    
@@ -105,22 +132,71 @@ typedef union node_t {
     InternalNode internal;
 } Node;
 
+typedef struct mvp_idset_t {
+    char **slots;           /* open addressing table of ids, NULL for free slots */
+    unsigned int size;      /* number of slots, a power of 2 */
+    unsigned int nbids;     /* number of ids in the set */
+} MVPIdSet;
+
+/* restricts the datapoints returned by mvptree_retrieve_filtered */
+typedef struct mvp_filter_t {
+    MVPIdSet *ids;          /* only datapoints with an id in the set, NULL for any id  */
+    unsigned int *tags;     /* only datapoints with a tag in the array, sorted ascending */
+    unsigned int nbtags;    /* length of tags, 0 for any tag                            */
+} MVPFilter;
+
+
+#define MVP_FILLBINS   10                /* bins of the leaf fill factor histogram          */
+#define MVP_STATLEVELS 32                /* levels of the tree with split statistics        */
+
+typedef struct mvp_levelstats_t {
+    unsigned int nbinternal;        /* number of internal nodes at the level                   */
+    float m1min, m1max;             /* range of the M1 split values of these nodes             */
+    double m1sum;                   /* sum of the M1 split values                              */
+    float m2min, m2max;             /* range of the M2 split values of these nodes             */
+    double m2sum;                   /* sum of the M2 split values                              */
+} MVPLevelStats;
+
+typedef struct mvp_stats_t {
+    unsigned int depth;             /* number of node levels, 0 for an empty tree              */
+    unsigned int nbinternal;        /* number of internal nodes                                */
+    unsigned int nbleaf;            /* number of leaf nodes                                    */
+    unsigned int nbpoints;          /* number of datapoints, vantage points included           */
+    unsigned int nbleafpoints;      /* number of datapoints stored in leaf point arrays        */
+    unsigned int nbempty;           /* number of empty (NULL) child slots of internal nodes    */
+    unsigned int leaffill[MVP_FILLBINS]; /* leaves by fill factor: bin i counts the leaves   */
+                                    /* holding i/10 to (i+1)/10 of leafcap, full ones in the last */
+    MVPLevelStats levels[MVP_STATLEVELS]; /* split values by depth, root first; levels    */
+                                    /* deeper than MVP_STATLEVELS are not recorded             */
+    size_t internalbytes;           /* memory of internal nodes, split and child arrays        */
+    size_t leafbytes;               /* memory of leaf nodes, point and distance arrays         */
+    size_t pointbytes;              /* memory of datapoints with their id, data and path       */
+} MVPStats;
 
 typedef struct mvptree_t {
     unsigned int branchfactor;      /* branch factor of tree, e.g. 2                           */
     unsigned int pathlength;        /* number distances stored for a datapoint's distance      */
                                     /* from each vantage point going down the tree.            */
-                                    /* Refers to the array of float's stored in each datapoint.*/
+                                    /* Refers to the array of distances stored in each datapoint.*/
     unsigned int leafcap;           /* capacity of leaf nodes  (number datapoints)             */
     unsigned int fd;                /* internal use                                            */
     unsigned int k;                 /* internal use for retrieve function (knearest)           */
+    unsigned long nbdist;           /* distance evaluations made by the last retrieve          */
+    const MVPFilter *filter;        /* internal use for retrieve function (result filter)      */
+    float *distances;               /* internal use for retrieve function (result distances)   */
+    int version;                    /* internal use for mvp_read() and mvp_write()             */
+    MVPFormat format;      /* format written by mvptree_write(), as read for loaded trees */
+    MVPMetric metric;      /* metric of dist, recorded in MVP_FORMAT2 files               */
     MVPDataType datatype;  /* internal use                                            */
+    MVPDistType disttype;  /* storage type of the distances kept in the tree          */
     off_t pos;             /* internal use for mvp_read() and mvp_write()             */
     off_t size;            /* internal use for mvp_read() and mvp_write()             */
     off_t pgsize;          /* system page size (interal use)                          */
     char *buf;             /* internal use                                            */
     Node *node;            /* reference to top of tree                                */
     CmpFunc dist;          /* distance function - e.g. L1 or L2                       */
+    MVPFreeFunc free_func; /* frees the id and data of datapoints dropped by a write  */
+                           /* or released after it, NULL to leave them to the user    */
 } MVPTree;
 
 
@@ -160,6 +236,43 @@ MVPDP* dp_alloc(MVPDataType type);
 
 void dp_free(MVPDP *dp, MVPFreeFunc free_func);
 
+/*   dp_retain
+ *
+ *   DESCRIPTION:
+ *
+ *   take a reference to a datapoint, e.g. one returned by mvptree_retrieve(),
+ *   so that it outlives the tree (or snapshot) holding it. 
+ *
+ *   ARGUMENTS:
+ *
+ *   dp - pointer to datapoint
+ *
+ *   RETURN: 
+ *
+ *   void
+ */
+
+void dp_retain(MVPDP *dp);
+
+/*   dp_release
+ *
+ *   DESCRIPTION:
+ *
+ *   drop a reference to a datapoint, freeing it with dp_free() when it was the last one.
+ *
+ *   ARGUMENTS:
+ *
+ *   dp - pointer to datapoint
+ *
+ *   free_func - callback function that will be used to free the id and data parts of a DP 
+ *
+ *   RETURN: 
+ *
+ *   void
+ */
+
+void dp_release(MVPDP *dp, MVPFreeFunc free_func);
+
 /*   mvptree_alloc
  * 
  *   DESCRIPTION:
@@ -193,7 +306,8 @@ MVPTree* mvptree_alloc(MVPTree *tree,CmpFunc distance,\
  *  Clear out the tree. All the datapoints that have been added to the tree
  *  are also free'd with dp_free(). You can specify a free function to free
  *  the portions of the DP struct which are user allocated (e.g. the id and 
- *  data fields).
+ *  data fields). Nodes and datapoints still shared with a snapshot (see
+ *  mvptree_snapshot()) are only released, and freed with the last reference.
  *
  *  ARGUMENTS:
  *
@@ -233,6 +347,126 @@ void mvptree_clear(MVPTree *tree, MVPFreeFunc free_func);
 
 MVPError mvptree_add(MVPTree *tree, MVPDP **points, unsigned int nbpoints);
 
+/*
+ *   mvptree_snapshot
+ *
+ *   DESCRIPTION:
+ *
+ *   Take a snapshot of the tree: a new MVPTree sharing all the nodes and datapoints
+ *   of tree, in O(1). The nodes and datapoints are reference counted and copy on
+ *   write: mvptree_add() and mvptree_optimize() copy the shared nodes along the
+ *   path they change (and the datapoints whose path they rewrite) instead of
+ *   changing them in place, so the snapshot keeps returning the same results. 
+ *   The old versions are freed when the last tree holding them is cleared.
+ *   The snapshot must not be written to. It can be searched from another thread
+ *   while tree is written to, but each tree supports one search at a time.
+ *   Datapoint copies are allocated with malloc() and freed with the tree's
+ *   free_func.
+ *
+ *   ARGUMENTS:
+ *
+ *   tree - ptr to MVPTree
+ *
+ *   RETURN
+ *
+ *   MVPTree* ptr to free with mvptree_clear() and free(), NULL for error
+ */
+
+MVPTree* mvptree_snapshot(MVPTree *tree);
+
+/*
+ *   mvptree_set_disttype
+ *
+ *   DESCRIPTION:
+ *
+ *   Select how distances are stored in the tree. MVP_UINT8DIST and MVP_UINT16DIST
+ *   store the datapoint paths, the leaf distances and the split values as small
+ *   integers, which is only valid for metrics returning integer distances (e.g.
+ *   hamming). Adding a point whose distance does not fit fails with MVP_DISTRANGE.
+ *   The distance type can only be changed on an empty tree.
+ *
+ *   ARGUMENTS:
+ *
+ *   tree - ptr to MVPTree
+ *
+ *   disttype - MVPDistType value
+ *
+ *   RETURN
+ *
+ *   MVPError error code
+ */
+
+MVPError mvptree_set_disttype(MVPTree *tree, MVPDistType disttype);
+
+/*
+ *   mvptree_set_format
+ *
+ *   DESCRIPTION:
+ *
+ *   Select the file format written by mvptree_write() and mvptree_write_buffer().
+ *   MVP_FORMAT1 is the default for new trees; loaded trees keep the format they
+ *   were read from. mvptree_read() reads all formats.
+ *
+ *   ARGUMENTS:
+ *
+ *   tree - ptr to MVPTree
+ *
+ *   format - MVPFormat value
+ *
+ *   RETURN
+ *
+ *   MVPError error code
+ */
+
+MVPError mvptree_set_format(MVPTree *tree, MVPFormat format);
+
+/*
+ *   mvptree_stats
+ *
+ *   DESCRIPTION:
+ *
+ *   compute the shape statistics of a tree in a single pass
+ *
+ *   ARGUMENTS:
+ *
+ *   tree - ptr to MVPTree
+ *
+ *   stats - ptr to MVPStats to fill
+ *
+ *   RETURN
+ *
+ *   MVPError error code
+ */
+
+MVPError mvptree_stats(MVPTree *tree, MVPStats *stats);
+
+/*
+ *   mvptree_optimize
+ *
+ *   DESCRIPTION:
+ *
+ *   Rebalance a tree degraded by incremental inserts. Inserting only rebuilds
+ *   the leaves that overflow, so the vantage points and splits of the internal
+ *   nodes above them are never revisited. Every internal node having a child
+ *   with more than skew times its share of the subtree's points is rebuilt
+ *   from scratch, in place. Subtrees that cannot be rebuilt are left as is.
+ *
+ *   ARGUMENTS:
+ *
+ *   tree - ptr to MVPTree
+ *
+ *   skew - float value >= 1.0, e.g. 2.0 to rebuild subtrees where a child holds
+ *          more than twice the average share
+ *
+ *   nbrebuilt - ptr to int to contain the number of rebuilt subtrees
+ *
+ *   RETURN
+ *
+ *   MVPError error code
+ */
+
+MVPError mvptree_optimize(MVPTree *tree, float skew, unsigned int *nbrebuilt);
+
 /*
  *   mvptree_retrieve
  *  
@@ -264,12 +498,111 @@ MVPError mvptree_add(MVPTree *tree, MVPDP **points, unsigned int nbpoints);
 MVPDP** mvptree_retrieve(MVPTree *tree, MVPDP *target, unsigned int knearest, float radius,\
                                        unsigned int *nbresults, MVPError *error);
 
+/*
+ *   mvptree_retrieve_filtered
+ *
+ *   DESCRIPTION:
+ *
+ *   same as mvptree_retrieve, but datapoints rejected by filter are left out
+ *   of the results before they count against knearest
+ *
+ *   ARGUMENTS:
+ *
+ *   filter - ptr to MVPFilter, NULL to return every datapoint found
+ *
+ *   (others as for mvptree_retrieve)
+ *
+ *   RETURN:
+ *
+ *   MVPDP** array of ptrs to datapoints, as for mvptree_retrieve
+ *
+ */
+
+MVPDP** mvptree_retrieve_filtered(MVPTree *tree, MVPDP *target, unsigned int knearest, float radius,\
+                                  const MVPFilter *filter, unsigned int *nbresults, MVPError *error);
+
+/*
+ *   mvptree_retrieve_distances
+ *
+ *   DESCRIPTION:
+ *
+ *   same as mvptree_retrieve_filtered, also returning the distance from the target
+ *   of each datapoint, as computed by the search
+ *
+ *   ARGUMENTS:
+ *
+ *   distances - ptr to a float ptr receiving the array of distances, in the order
+ *               of the returned datapoints, to free() by the user. NULL to skip.
+ *
+ *   (others as for mvptree_retrieve_filtered)
+ *
+ *   RETURN:
+ *
+ *   MVPDP** array of ptrs to datapoints, as for mvptree_retrieve
+ *
+ */
+
+MVPDP** mvptree_retrieve_distances(MVPTree *tree, MVPDP *target, unsigned int knearest, float radius,\
+                                   const MVPFilter *filter, float **distances, unsigned int *nbresults,\
+                                   MVPError *error);
+
+/*
+ *   mvp_idset_alloc
+ *
+ *   DESCRIPTION:
+ *
+ *   allocate an empty set of datapoint ids, sized for nbids ids (it grows as needed)
+ *
+ *   RETURN:
+ *
+ *   MVPIdSet*, NULL on error. Free it with mvp_idset_free().
+ */
+
+MVPIdSet* mvp_idset_alloc(unsigned int nbids);
+
+/*
+ *   mvp_idset_add
+ *
+ *   DESCRIPTION:
+ *
+ *   add a copy of the null-terminated id to the set
+ *
+ *   RETURN:
+ *
+ *   MVPError error code
+ */
+
+MVPError mvp_idset_add(MVPIdSet *set, const char *id);
+
+/*
+ *   mvp_idset_contains
+ *
+ *   RETURN:
+ *
+ *   1 if the id is in the set, 0 otherwise
+ */
+
+int mvp_idset_contains(const MVPIdSet *set, const char *id);
+
+/*
+ *   mvp_idset_free
+ *
+ *   DESCRIPTION:
+ *
+ *   free the set and its ids
+ */
+
+void mvp_idset_free(MVPIdSet *set);
+
 /*
  *   mvptree_write
  *
  *   DESCRIPTION:
  *
- *   write out a tree to a file
+ *   write out a tree to a file. The exact size is computed first, the tree is
+ *   written to a temporary file of that size next to filename, which is then
+ *   renamed over filename, so readers never see a partially written file.
+ *   An empty tree is written too, and read back empty.
  *
  *   ARGUMENTS:
  *
@@ -279,6 +612,9 @@ MVPDP** mvptree_retrieve(MVPTree *tree, MVPDP *target, unsigned int knearest, fl
  *
  *   mode - int value for mode for file open.
  *
+ *   sync - non-zero to fsync the file (and its directory) so the new file
+ *          survives a system crash
+ *
  *   RETURN
  *
  *   MVPError code
@@ -286,7 +622,63 @@ MVPDP** mvptree_retrieve(MVPTree *tree, MVPDP *target, unsigned int knearest, fl
  */
 
 
-MVPError mvptree_write(MVPTree *tree, const char *filename, int mode);
+MVPError mvptree_write(MVPTree *tree, const char *filename, int mode, int sync);
+
+/*
+ *   mvptree_write_format
+ *
+ *   DESCRIPTION:
+ *
+ *   as mvptree_write, but write the given format instead of tree->format,
+ *   which is left unchanged.
+ *
+ *   RETURN
+ *
+ *   MVPError code, MVP_ARGERR for an unknown format
+ *
+ */
+
+MVPError mvptree_write_format(MVPTree *tree, const char *filename, int mode, int sync,
+                              MVPFormat format);
+
+/*
+ *   mvptree_write_buffer
+ *
+ *   DESCRIPTION:
+ *
+ *   write out a tree to a memory buffer, in the same format as mvptree_write
+ *
+ *   ARGUMENTS:
+ *
+ *   tree - ptr to MVPTree struct
+ *
+ *   buffer - ptr to char ptr to contain the heap allocated buffer (the user must free it)
+ *
+ *   size - ptr to size_t to contain the length of the buffer
+ *
+ *   RETURN
+ *
+ *   MVPError code
+ *
+ */
+
+MVPError mvptree_write_buffer(MVPTree *tree, char **buffer, size_t *size);
+
+/*
+ *   mvptree_write_buffer_format
+ *
+ *   DESCRIPTION:
+ *
+ *   as mvptree_write_buffer, but write the given format instead of
+ *   tree->format, which is left unchanged.
+ *
+ *   RETURN
+ *
+ *   MVPError code, MVP_ARGERR for an unknown format
+ *
+ */
+
+MVPError mvptree_write_buffer_format(MVPTree *tree, char **buffer, size_t *size, MVPFormat format);
 
 /*   mvptree_read
  *
@@ -311,6 +703,32 @@ MVPError mvptree_write(MVPTree *tree, const char *filename, int mode);
 MVPTree* mvptree_read(const char *filename, CmpFunc fnc, int branchfactor, int pathlength,\
                                                   int leafcapacity, MVPError *error);
 
+/*   mvptree_read_buffer
+ *
+ *   DESCRIPTION:
+ *
+ *   read a tree from a buffer previously filled by mvptree_write_buffer (or
+ *   the contents of a file written by mvptree_write). The buffer is only read
+ *   and can be released once the function returns.
+ *
+ *   ARGUMENTS:
+ *
+ *   buffer - ptr to the serialized tree
+ *
+ *   size - length of the buffer
+ *
+ *   fnc - callback function for distance function to use
+ *
+ *   error - pointer to MVPError code enum
+ *
+ *   RETURN
+ *
+ *   MVPTree ptr, or NULL on error (and error is set to error code)
+ *
+ */
+
+MVPTree* mvptree_read_buffer(const char *buffer, size_t size, CmpFunc fnc, MVPError *error);
+
 /*   mvptree_print
  *
  *   DESCRIPTION:
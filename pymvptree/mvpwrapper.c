@@ -93,12 +93,51 @@ void printpoint(MVPDP* point) {
 
 MVPTree *mktree(unsigned int bf, unsigned int p, unsigned int k) {
     CmpFunc distance_func = bitlevenshtein;
-    return mvptree_alloc(NULL, distance_func, bf, p, k);
+    MVPTree *tree = mvptree_alloc(NULL, distance_func, bf, p, k);
+    if (tree) {
+        tree->metric = MVP_METRIC_HAMMING;
+        tree->free_func = (MVPFreeFunc)free;
+    }
+    return tree;
+}
+
+
+/* Loaded trees must have been built with bitlevenshtein. Files that do not */
+/* record their metric are assumed to. */
+static MVPTree *check_metric(MVPTree *tree, MVPError *err) {
+    if (tree == NULL) return NULL;
+    tree->free_func = (MVPFreeFunc)free;
+    if (tree->metric == MVP_METRIC_UNKNOWN) {
+        tree->metric = MVP_METRIC_HAMMING;
+    } else if (tree->metric != MVP_METRIC_HAMMING && *err == MVP_SUCCESS) {
+        *err = MVP_UNRECOGNIZED;
+    }
+    return tree;
 }
 
 
 void rmtree(MVPTree *tree) {
     mvptree_clear(tree, (MVPFreeFunc *)free);
+    free(tree);
+}
+
+
+/* Results hold a reference to their points, which stay valid after the tree */
+/* (or snapshot) they were found in drops them. */
+void retain_results(MVPDP **results, unsigned int nbresults) {
+    unsigned int i;
+    for (i = 0; i < nbresults; i++) {
+        dp_retain(results[i]);
+    }
+}
+
+
+void rmresults(MVPDP **results, unsigned int nbresults) {
+    unsigned int i;
+    for (i = 0; i < nbresults; i++) {
+        dp_release(results[i], (MVPFreeFunc)free);
+    }
+    free(results);
 }
 
 
@@ -112,10 +151,23 @@ MVPTree *load(char *filename, MVPError *err) {
     CmpFunc distance_func = bitlevenshtein;
     tree = mvptree_read(filename, distance_func,
                         MVP_BRANCHFACTOR, MVP_PATHLENGTH, MVP_LEAFCAP, err);
-    return tree;
+    return check_metric(tree, err);
+}
+
+
+void save(char *filename, MVPTree *tree, int sync, MVPFormat format, MVPError *err) {
+    *err = mvptree_write_format(tree, filename, 00755, sync, format);
+}
+
+
+MVPTree *loads(char *buffer, size_t size, MVPError *err) {
+    CmpFunc distance_func = bitlevenshtein;
+    return check_metric(mvptree_read_buffer(buffer, size, distance_func, err), err);
 }
 
 
-void save(char *filename, MVPTree *tree, MVPError *err) {
-    *err = mvptree_write(tree, filename, 00755);
+char *dumps(MVPTree *tree, size_t *size, MVPFormat format, MVPError *err) {
+    char *buffer = NULL;
+    *err = mvptree_write_buffer_format(tree, &buffer, size, format);
+    return buffer;
 }
@@ -9,8 +9,14 @@ void rmpoint(MVPDP *point);
 MVPTree *mktree(unsigned int bf, unsigned int p, unsigned int k);
 void rmtree(MVPTree *tree);
 
+void retain_results(MVPDP **results, unsigned int nbresults);
+void rmresults(MVPDP **results, unsigned int nbresults);
+
 void printpoint(MVPDP* point);
 void printtree(MVPTree *tree);
 
 MVPTree *load(char *filename, MVPError *err);
-void save(char *filename, MVPTree *tree, MVPError *err);
+void save(char *filename, MVPTree *tree, int sync, MVPFormat format, MVPError *err);
+
+MVPTree *loads(char *buffer, size_t size, MVPError *err);
+char *dumps(MVPTree *tree, size_t *size, MVPFormat format, MVPError *err);
@@ -0,0 +1,472 @@
+"""
+Serve a tree to local processes.
+
+One process loads the tree and answers the queries of the others over
+a Unix domain or TCP socket, instead of each of them loading its own
+copy::
+
+    server = Server(Tree.from_file('index'), '/run/index.sock')
+    server.serve_forever()
+
+    client = Client('/run/index.sock')
+    client.filter(data, 4)
+
+Every message is a little endian unsigned 32 bit length followed by
+that many bytes:
+
+* a request is `REQUEST` (request id, operation, radius, limit)
+  followed by the query data. For `NEAREST` the limit is `k` and a
+  negative radius selects the default `max_radius` of `Tree.nearest`.
+* a response is `RESPONSE` (request id, status, count). With status
+  `OK` it is followed by `count` matches: a 32 bit length and the
+  pickled id, a 32 bit length and the data, and for `FILTER` and
+  `NEAREST` the distance as a 32 bit float. With status `ERROR` it is
+  followed by the UTF-8 error message.
+
+The ids are sent pickled, as they are stored in the tree, and `Client`
+unpickles them: only connect it to a server you trust, as a malicious
+server can run code in the client. The server itself never unpickles
+what it receives.
+
+Requests are coalesced: the workers take the pending requests by
+batches of up to `batch_size`, run a batch on one `Tree.snapshot` and
+run identical requests of a batch once. The tree can be written to with
+`Server.add` meanwhile, the next batches see the new points.
+
+"""
+from contextlib import contextmanager
+from itertools import count
+import os
+import pickle
+import queue
+import socket
+import stat
+import struct
+import threading
+import time
+
+from pymvptree import Point
+
+
+FILTER, NEAREST, COUNT = 1, 2, 3
+OK, ERROR = 0, 1
+
+LENGTH = struct.Struct('<I')
+REQUEST = struct.Struct('<IBfI')
+RESPONSE = struct.Struct('<IBI')
+FIELD_LENGTH = struct.Struct('<I')
+DISTANCE = struct.Struct('<f')
+
+#: Largest message accepted, in bytes.
+MAX_MESSAGE = 64 * 1024 * 1024
+
+
+def _family(address):
+    return socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+
+
+def _recv_exactly(conn, size):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    pos = 0
+    while pos < size:
+        received = conn.recv_into(view[pos:])
+        if not received:
+            if pos:
+                raise ConnectionError("Connection closed mid-message.")
+            return None
+        pos += received
+    return bytes(buffer)
+
+
+def recv_message(conn):
+    """
+    Returns the next message of `conn`, `None` if it was closed.
+
+    """
+    header = _recv_exactly(conn, LENGTH.size)
+    if header is None:
+        return None
+    size, = LENGTH.unpack(header)
+    if size > MAX_MESSAGE:
+        raise ConnectionError("Message of %d bytes is too large." % size)
+    return _recv_exactly(conn, size) if size else b''
+
+
+def send_message(conn, payload):
+    conn.sendall(LENGTH.pack(len(payload)) + payload)
+
+
+def _remove_stale_socket(path):
+    """
+    Removes the socket file left at `path` by a server that is gone.
+
+    A socket still accepting connections is left alone, binding to it
+    then fails with `OSError`.
+
+    """
+    try:
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            return
+    except FileNotFoundError:
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except ConnectionRefusedError:
+        os.unlink(path)
+    except OSError:
+        pass
+    finally:
+        probe.close()
+
+
+def _match_record(match, distance=None):
+    point_id = match.serialized_id
+    data = match.data
+    record = (FIELD_LENGTH.pack(len(point_id)) + point_id +
+              FIELD_LENGTH.pack(len(data)) + data)
+    if distance is not None:
+        record += DISTANCE.pack(distance)
+    return record
+
+
+class _Pending:
+    """A request waiting for its batch."""
+    __slots__ = ('key', 'response', 'done')
+
+    def __init__(self, key):
+        self.key = key
+        self.response = None
+        self.done = threading.Event()
+
+
+class Server:
+    """
+    Serves `tree` on `address`: a path for a Unix domain socket, or a
+    `(host, port)` tuple for TCP (port 0 picks a free port, see
+    `address`).
+
+    :param batch_size: Largest number of requests run on one snapshot.
+
+    :param batch_wait: Seconds a worker waits for more requests before
+                       running a batch that is not full.
+
+    :param workers: Number of threads running the batches. The searches
+                    release the GIL, so several workers use several
+                    cores.
+
+    """
+    def __init__(self, tree, address, batch_size=64, batch_wait=0.0005,
+                 workers=1):
+        self.tree = tree
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.workers = workers
+
+        #: Number of requests and batches run so far.
+        self.nbrequests = 0
+        self.nbbatches = 0
+
+        if isinstance(address, str):
+            _remove_stale_socket(address)
+
+        self._listener = socket.socket(_family(address), socket.SOCK_STREAM)
+        if not isinstance(address, str):
+            self._listener.setsockopt(socket.SOL_SOCKET,
+                                      socket.SO_REUSEADDR, 1)
+        self._listener.bind(address)
+        self._listener.listen(128)
+        self._listener.settimeout(0.1)
+
+        #: The bound address, with the actual port for TCP.
+        self.address = self._listener.getsockname()
+
+        self._requests = queue.Queue()
+        self._connections = set()
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._thread = None
+
+    def add(self, point):
+        """
+        Add a point or a list of points to the served tree, see `Tree.add`.
+
+        """
+        return self.tree.add(point)
+
+    def serve_forever(self):
+        """
+        Accepts connections until `close` is called.
+
+        """
+        workers = [threading.Thread(target=self._work, daemon=True)
+                   for _ in range(self.workers)]
+        for worker in workers:
+            worker.start()
+
+        try:
+            while not self._closed.is_set():
+                try:
+                    conn, _ = self._listener.accept()
+                except socket.timeout:
+                    continue
+                except OSError:
+                    if self._closed.is_set():
+                        break
+                    raise
+                conn.settimeout(None)
+                if conn.family != socket.AF_UNIX:
+                    conn.setsockopt(socket.IPPROTO_TCP,
+                                    socket.TCP_NODELAY, 1)
+                with self._lock:
+                    self._connections.add(conn)
+                threading.Thread(target=self._handle, args=(conn, ),
+                                 daemon=True).start()
+        finally:
+            for _ in workers:
+                self._requests.put(None)
+            for worker in workers:
+                worker.join()
+            self._closed.set()
+
+    def start(self):
+        """
+        Runs `serve_forever` in a background thread, returns the server.
+
+        """
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self):
+        """
+        Stops serving and closes all the connections.
+
+        """
+        self._closed.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._listener.close()
+        with self._lock:
+            connections, self._connections = self._connections, set()
+        for conn in connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if isinstance(self.address, str):
+            try:
+                os.unlink(self.address)
+            except FileNotFoundError:
+                pass
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _handle(self, conn):
+        try:
+            while True:
+                payload = recv_message(conn)
+                if payload is None or len(payload) < REQUEST.size:
+                    return
+                request_id, op, radius, limit = REQUEST.unpack_from(payload)
+                pending = _Pending((op, payload[REQUEST.size:], radius, limit))
+                self._requests.put(pending)
+                while not pending.done.wait(0.1):
+                    if self._closed.is_set():
+                        return
+                status, nbmatches, body = pending.response
+                send_message(conn, RESPONSE.pack(request_id, status,
+                                                 nbmatches) + body)
+        except OSError:
+            pass
+        finally:
+            with self._lock:
+                self._connections.discard(conn)
+            conn.close()
+
+    def _work(self):
+        while True:
+            pending = self._requests.get()
+            if pending is None:
+                return
+            batch = [pending]
+            deadline = time.monotonic() + self.batch_wait
+            while len(batch) < self.batch_size:
+                try:
+                    pending = self._requests.get(
+                        timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if pending is None:
+                    self._requests.put(None)  # stop after this batch
+                    break
+                batch.append(pending)
+            self._run(batch)
+
+    def _run(self, batch):
+        snapshot = self.tree.snapshot()
+        responses = {}
+        for pending in batch:
+            if pending.key not in responses:
+                responses[pending.key] = self._execute(snapshot,
+                                                       *pending.key)
+            pending.response = responses[pending.key]
+            pending.done.set()
+        with self._lock:
+            self.nbrequests += len(batch)
+            self.nbbatches += 1
+
+    @staticmethod
+    def _execute(tree, op, data, radius, limit):
+        try:
+            if op == FILTER:
+                matches = tree.results(data, radius, limit,
+                                       return_distances=True)
+                return OK, len(matches), b''.join(
+                    _match_record(m, m.distance) for m in matches)
+            elif op == NEAREST:
+                found = tree.nearest(data, limit,
+                                     None if radius < 0 else radius)
+                return OK, len(found), b''.join(_match_record(m, d)
+                                                for d, m in found)
+            elif op == COUNT:
+                return OK, len(tree.results(data, radius, limit)), b''
+            else:
+                raise ValueError("Unknown operation %d." % op)
+        except Exception as exc:
+            return ERROR, 0, str(exc).encode('utf-8')
+
+
+class Client:
+    """
+    Client of a `Server` listening on `address`.
+
+    Keeps up to `pool_size` idle connections to reuse. Thread safe:
+    concurrent calls use different connections, and are coalesced by
+    the server. The ids received are unpickled, so the server must be
+    trusted.
+
+    """
+    def __init__(self, address, pool_size=8, timeout=None):
+        self.address = address
+        self.timeout = timeout
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        self._ids = count()
+
+    def _connect(self):
+        conn = socket.socket(_family(self.address), socket.SOCK_STREAM)
+        try:
+            conn.settimeout(self.timeout)
+            conn.connect(self.address)
+            if conn.family != socket.AF_UNIX:
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError:
+            conn.close()
+            raise
+        return conn
+
+    @contextmanager
+    def _connection(self):
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        try:
+            yield conn
+        except BaseException:
+            conn.close()
+            raise
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def _request(self, op, data, radius, limit):
+        if not isinstance(data, bytes):
+            raise TypeError("data must be bytes")
+        request_id = next(self._ids) & 0xffffffff
+        with self._connection() as conn:
+            send_message(conn, REQUEST.pack(request_id, op, radius, limit) +
+                         data)
+            payload = recv_message(conn)
+            if payload is None:
+                raise ConnectionError("The server closed the connection.")
+            response_id, status, nbmatches = RESPONSE.unpack_from(payload)
+            if response_id != request_id:
+                raise ConnectionError("Response to another request.")
+        body = payload[RESPONSE.size:]
+        if status == ERROR:
+            raise RuntimeError(body.decode('utf-8'))
+        return nbmatches, body
+
+    @staticmethod
+    def _matches(nbmatches, body, distances=False):
+        matches = []
+        pos = 0
+        for _ in range(nbmatches):
+            idlen, = FIELD_LENGTH.unpack_from(body, pos)
+            pos += FIELD_LENGTH.size
+            point_id = pickle.loads(body[pos:pos + idlen])
+            pos += idlen
+            datalen, = FIELD_LENGTH.unpack_from(body, pos)
+            pos += FIELD_LENGTH.size
+            point = Point(point_id, body[pos:pos + datalen])
+            pos += datalen
+            if distances:
+                distance, = DISTANCE.unpack_from(body, pos)
+                pos += DISTANCE.size
+                matches.append((distance, point))
+            else:
+                matches.append(point)
+        return matches
+
+    def filter(self, data, radius, limit=65535, return_distances=False):
+        """
+        Returns the list of `Point` of `Tree.results`, or of
+        `(distance, Point)` with `return_distances=True`.
+
+        """
+        matches = self._matches(*self._request(FILTER, data, radius, limit),
+                                distances=True)
+        if return_distances:
+            return matches
+        return [point for _, point in matches]
+
+    def nearest(self, data, k=1, max_radius=None):
+        """
+        Returns the list of `(distance, Point)` of `Tree.nearest`.
+
+        """
+        radius = -1 if max_radius is None else max_radius
+        return self._matches(*self._request(NEAREST, data, radius, k),
+                             distances=True)
+
+    def count(self, data, radius, limit=65535):
+        """
+        Returns the number of points found by `Tree.results`.
+
+        """
+        return self._request(COUNT, data, radius, limit)[0]
+
+    def close(self):
+        """
+        Closes the idle connections.
+
+        """
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,91 @@
+"""
+Choose the tree parameters for a workload.
+
+"""
+from collections import namedtuple
+from itertools import product
+import time
+
+
+#: Candidate values tried by `tune` by default.
+BRANCHFACTORS = (2, 3, 4)
+PATHLENGTHS   = (3, 5, 8)
+LEAFCAPS      = (10, 25, 50, 100)
+
+OBJECTIVES = ('latency', 'distances', 'memory', 'build_time')
+
+
+class TuningResult(namedtuple('TuningResult', [
+        'branchfactor', 'pathlength', 'leafcap',
+        'build_time', 'memory', 'distances', 'latency'])):
+    """
+    Measures of one candidate configuration.
+
+    `build_time` and `latency` (the mean time per query) are in
+    seconds, `memory` is the memory used by the tree in bytes and
+    `distances` is the mean number of distance evaluations per query.
+
+    """
+    __slots__ = ()
+
+    @property
+    def params(self):
+        """
+        The configuration as keyword arguments for `Tree`.
+
+        """
+        return {'branchfactor': self.branchfactor,
+                'pathlength': self.pathlength,
+                'leafcap': self.leafcap}
+
+
+def tune(sample_points, sample_queries, radius,
+         branchfactors=BRANCHFACTORS, pathlengths=PATHLENGTHS,
+         leafcaps=LEAFCAPS, objective='latency', **tree_options):
+    """
+    Build a tree for every combination of `branchfactors`,
+    `pathlengths` and `leafcaps` from `sample_points`, and run every
+    data of `sample_queries` against it with the given `radius`.
+
+    Returns the list of `TuningResult`, best first according to
+    `objective`, one of `OBJECTIVES`. Ties are broken by the other
+    measures in that order. `tree_options` (e.g. `disttype`) are passed
+    to every `Tree`.
+
+    """
+    from pymvptree import Tree
+
+    if objective not in OBJECTIVES:
+        raise ValueError("objective must be one of %s" % (OBJECTIVES, ))
+
+    sample_points = list(sample_points)
+    sample_queries = list(sample_queries)
+    if not sample_points or not sample_queries:
+        raise ValueError("Needs at least one point and one query.")
+
+    results = []
+    for bf, pl, lc in product(branchfactors, pathlengths, leafcaps):
+        tree = Tree(branchfactor=bf, pathlength=pl, leafcap=lc,
+                    **tree_options)
+
+        start = time.perf_counter()
+        tree.add(sample_points)
+        build_time = time.perf_counter() - start
+
+        distances = 0
+        start = time.perf_counter()
+        for data in sample_queries:
+            tree.results(data, radius)
+            distances += tree.last_search_distances
+        latency = (time.perf_counter() - start) / len(sample_queries)
+
+        results.append(TuningResult(
+            branchfactor=bf, pathlength=pl, leafcap=lc,
+            build_time=build_time,
+            memory=tree.describe()['bytes']['total'],
+            distances=distances / len(sample_queries),
+            latency=latency))
+
+    order = (objective, ) + tuple(o for o in OBJECTIVES if o != objective)
+    results.sort(key=lambda r: tuple(getattr(r, o) for o in order))
+    return results
@@ -0,0 +1,137 @@
+import json
+import os
+import struct
+
+import pytest
+
+
+def test_build_and_query_hex(tmpdir, capsys):
+    from pymvptree.__main__ import main
+
+    source = tmpdir.join('hashes.hex')
+    source.write(''.join('%d\t%s\n' % (i, bytes([i, i]).hex())
+                         for i in range(100)))
+    tree = str(tmpdir.join('tree'))
+
+    main(['build', tree, str(source), '--int-ids', '--chunk-size', '7'])
+
+    queries = tmpdir.join('queries.hex')
+    queries.write('0000\n0101\n')
+    capsys.readouterr()
+    main(['query', tree, str(queries), '--radius', '0'])
+
+    assert capsys.readouterr().out == '0\t0\t0000\n1\t1\t0101\n'
+
+    main(['query', tree, str(queries), '--radius', '1', '--distances'])
+    assert capsys.readouterr().out.splitlines()[:2] == \
+        ['0\t0\t0000\t0', '1\t1\t0101\t0']
+
+
+def test_build_csv_with_tags(tmpdir):
+    from pymvptree.__main__ import main
+    from pymvptree import Tree
+
+    source = tmpdir.join('hashes.csv')
+    source.write('a,00ff,1\nb,ff00,2\nc,0f0f\n')
+    tree = str(tmpdir.join('tree'))
+
+    main(['build', tree, str(source), '--format', 'csv', '--optimize',
+          '--file-format', '2', '--compress'])
+
+    t = Tree.from_file(tree)
+    assert t.file_format == 3
+    assert {(m.point_id, m.tag) for m in t.filter(b'\x00\x00', 16)} == \
+        {('a', 1), ('b', 2), ('c', 0)}
+
+
+def test_build_compress_implies_format_2(tmpdir):
+    from pymvptree.__main__ import main
+    from pymvptree import Tree, MVPFormat
+
+    source = tmpdir.join('hashes.hex')
+    source.write('00ff\nff00\n')
+    tree = str(tmpdir.join('tree'))
+
+    main(['build', tree, str(source), '--compress'])
+    assert Tree.from_file(tree).file_format == MVPFormat.MVP_FORMAT2_ZLIB
+
+    with pytest.raises(SystemExit):
+        main(['build', tree, str(source), '--compress', '--file-format', '1'])
+
+
+def test_read_points_hex_positions(tmpdir):
+    from pymvptree.__main__ import read_points
+
+    first = tmpdir.join('first.hex')
+    first.write('00\n\nx\t01\n02\n')
+    second = tmpdir.join('second.hex')
+    second.write('03\n')
+
+    # Positions run across the inputs and skip blank lines.
+    assert [p.point_id for p in read_points([str(first), str(second)])] == \
+        [0, 'x', 2, 3]
+
+def test_query_more_matches_than_the_limit(tmpdir):
+    from pymvptree.__main__ import main
+
+    source = tmpdir.join('hashes.hex')
+    source.write(''.join('%s\n' % bytes([i]).hex() for i in range(20)))
+    tree = str(tmpdir.join('tree'))
+    main(['build', tree, str(source)])
+
+    for command in ('query', 'bench'):
+        with pytest.raises(SystemExit) as exc:
+            main([command, tree, str(source), '--radius', '8',
+                  '--limit', '5'])
+        assert 'more than --limit 5 matches' in str(exc.value)
+
+def test_query_raw_binary_output(tmpdir, capsysbinary):
+    from pymvptree.__main__ import main
+
+    source = tmpdir.join('hashes.raw')
+    source.write_binary(b''.join(bytes([i]) * 4 for i in range(50)))
+    tree = str(tmpdir.join('tree'))
+
+    main(['build', tree, str(source), '--format', 'raw', '--hash-size', '4'])
+    capsysbinary.readouterr()
+    main(['query', tree, str(source), '--format', 'raw', '--hash-size', '4',
+          '--radius', '0', '--output', 'binary', '--chunk-size', '10'])
+
+    out = capsysbinary.readouterr().out
+    pos = 0
+    for number in range(50):
+        assert struct.unpack_from('<II', out, pos) == (number, 1)
+        pos += 8
+        idlen, = struct.unpack_from('<I', out, pos)
+        assert out[pos + 4:pos + 4 + idlen] == str(number).encode()
+        pos += 4 + idlen + 4 + 4
+    assert pos == len(out)
+
+
+def test_raw_input_must_be_whole_hashes(tmpdir):
+    from pymvptree.__main__ import main
+
+    source = tmpdir.join('hashes.raw')
+    source.write_binary(b'\x00' * 10)
+
+    with pytest.raises(ValueError):
+        main(['build', str(tmpdir.join('tree')), str(source),
+              '--format', 'raw', '--hash-size', '4'])
+
+
+def test_stats_and_bench(tmpdir, capsys):
+    from pymvptree.__main__ import main
+
+    source = tmpdir.join('hashes.hex')
+    source.write(''.join('%s\n' % bytes([i]).hex() for i in range(60)))
+    tree = str(tmpdir.join('tree'))
+    main(['build', tree, str(source)])
+
+    capsys.readouterr()
+    main(['stats', tree])
+    stats = json.loads(capsys.readouterr().out)
+    assert stats['points'] == 60
+    assert stats['file_size'] == os.path.getsize(tree)
+
+    main(['bench', tree, str(source), '--radius', '1'])
+    assert 'queries          60' in capsys.readouterr().out
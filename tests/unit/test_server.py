@@ -0,0 +1,107 @@
+import threading
+
+import pytest
+
+
+def make_tree():
+    from pymvptree import Tree, Point
+
+    t = Tree(leafcap=4)
+    t.add([Point(i, bytes([i, 0])) for i in range(64)])
+    return t
+
+
+def test_unix_socket_filter_nearest_count(tmpdir):
+    from pymvptree import Point
+    from pymvptree.server import Client, Server
+
+    address = str(tmpdir.join('tree.sock'))
+    with Server(make_tree(), address), Client(address) as client:
+        found = client.filter(b'\x00\x00', 1)
+        assert sorted(p.point_id for p in found) == [0, 1, 2, 4, 8, 16, 32]
+        assert Point(4, b'\x04\x00') in found
+
+        assert client.count(b'\x00\x00', 1) == 7
+        assert sorted(d for d, _ in client.filter(b'\x00\x00', 1,
+                                                   return_distances=True)) \
+            == [0, 1, 1, 1, 1, 1, 1]
+
+        nearest = client.nearest(b'\x03\x00', 3)
+        assert [d for d, _ in nearest] == [0, 1, 1]
+        assert nearest[0][1] == Point(3, b'\x03\x00')
+
+        with pytest.raises(RuntimeError):
+            client.nearest(b'\x00\x00', 0)
+        # The connection is still usable after an error.
+        assert client.count(b'\x00\x00', 0) == 1
+
+
+def test_tcp_and_add():
+    from pymvptree import Point
+    from pymvptree.server import Client, Server
+
+    server = Server(make_tree(), ('127.0.0.1', 0)).start()
+    try:
+        client = Client(server.address)
+        assert client.filter(b'\xff\xff', 0) == []
+
+        server.add(Point('new', b'\xff\xff'))
+        assert [p.point_id for p in client.filter(b'\xff\xff', 0)] == ['new']
+        client.close()
+    finally:
+        server.close()
+
+
+def test_concurrent_requests_are_coalesced(tmpdir):
+    from pymvptree.server import Client, Server
+
+    address = str(tmpdir.join('tree.sock'))
+    server = Server(make_tree(), address, batch_wait=0.05).start()
+    client = Client(address, pool_size=16)
+    counts = []
+
+    def query():
+        counts.append(client.count(b'\x00\x00', 1))
+
+    try:
+        threads = [threading.Thread(target=query) for _ in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        client.close()
+        server.close()
+
+    assert counts == [7] * 16
+    assert server.nbrequests == 16
+    assert server.nbbatches < 16
+
+
+def test_stale_socket_replaced_live_socket_kept(tmpdir):
+    from pymvptree.server import Client, Server
+    import socket
+
+    address = str(tmpdir.join('tree.sock'))
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(address)
+    stale.close()
+
+    with Server(make_tree(), address):
+        with pytest.raises(OSError):
+            Server(make_tree(), address)
+        with Client(address) as client:
+            assert client.count(b'\x00\x00', 0) == 1
+
+
+def test_long_ids_and_data(tmpdir):
+    from pymvptree import Tree, Point
+    from pymvptree.server import Client, Server
+
+    point = Point('x' * 70000, b'\x01' * 70000)
+    t = Tree()
+    t.add(point)
+
+    address = str(tmpdir.join('tree.sock'))
+    with Server(t, address), Client(address) as client:
+        assert client.filter(b'\x01' * 70000, 0) == [point]
@@ -54,7 +54,7 @@ def test_Tree_save_to_file_impossible():
 
     t = Tree()
     with TemporaryDirectory() as filename:
-        with pytest.raises(RuntimeError):
+        with pytest.raises(IOError):
             t.to_file(filename)
 
 
@@ -373,3 +373,943 @@ def test_Tree_try_to_add_and_filter(leafcap, max_value):
             # #1 is changing in each data addition.
             for d in added_data:
                 assert list(t.filter((data_formatter % d).encode("ascii"), 0))
+
+
+@given(data=st.lists(st.binary(min_size=4, max_size=4)),
+       target_data=st.binary(min_size=4, max_size=4),
+       threshold=st.integers(min_value=0, max_value=32),
+       disttype=st.sampled_from([1, 2]))
+def test_Tree_compact_filter_matches_float(data, target_data, threshold,
+                                           disttype):
+    from pymvptree import Tree, Point, MVPDistType
+
+    float_tree = Tree()
+    compact_tree = Tree(disttype=MVPDistType(disttype))
+
+    for d in set(data):
+        try:
+            float_tree.add(Point(d, d))
+        except RuntimeError:
+            assume(False)
+        compact_tree.add(Point(d, d))
+
+    expected = {p.point_id for p in float_tree.filter(target_data, threshold)}
+    current = {p.point_id for p in compact_tree.filter(target_data, threshold)}
+
+    assert current == expected
+
+
+def test_Tree_compact_save_and_load():
+    from pymvptree import Tree, Point, MVPDistType
+    from tempfile import mktemp
+    from hashlib import md5
+
+    t1 = Tree(disttype=MVPDistType.MVP_UINT8DIST)
+    t1.add([Point(i, md5(bytes(i)).digest()[:8]) for i in range(200)])
+
+    tempfile = mktemp()
+    try:
+        t1.to_file(tempfile)
+        t2 = Tree.from_file(tempfile)
+    finally:
+        os.unlink(tempfile)
+
+    assert t2.disttype == MVPDistType.MVP_UINT8DIST
+    assert set(t1.filter(bytes(8), 20)) == set(t2.filter(bytes(8), 20))
+    assert len(list(t2.filter(bytes(8), 64))) == 200
+
+
+def test_Tree_compact_file_version():
+    from pymvptree import Tree, Point, MVPDistType
+    import struct
+
+    # Readers expecting float distances must not accept compact files.
+    for disttype in (MVPDistType.MVP_UINT8DIST, MVPDistType.MVP_UINT16DIST):
+        t = Tree(disttype=disttype)
+        t.add([Point(i, bytes([i])) for i in range(40)])
+        data = t.to_bytes()
+        assert struct.unpack_from('i', data, 10) == (0x02020000, )
+        assert {m.point_id for m in Tree.from_bytes(data).filter(
+            b'\x00', 1)} == {0, 1, 2, 4, 8, 16, 32}
+
+
+def test_Tree_compact_distance_out_of_range():
+    from pymvptree import Tree, Point, MVPDistType
+
+    t = Tree(disttype=MVPDistType.MVP_UINT8DIST)
+    t.add(Point(0, bytes(40)))
+
+    # 320 bits of difference do not fit in a byte.
+    with pytest.raises(RuntimeError):
+        t.add(Point(1, b'\xff' * 40))
+
+
+
+def test_Tree_compact_distance_out_of_range_leaves_leaf_intact():
+    from pymvptree import Tree, Point, MVPDistType
+
+    # Below the path length only the leaf distances are checked.
+    t = Tree(pathlength=1, disttype=MVPDistType.MVP_UINT8DIST)
+    t.add(Point('a', bytes(40)))
+    t.add(Point('b', bytes(39) + b'\x80'))
+
+    # 255 bits from 'a', 256 from 'b'.
+    far = b'\xff' * 31 + b'\x7f' + bytes(8)
+    for i in range(16):
+        near = bytes([1 << (i % 8)]) + bytes(39)
+        with pytest.raises(RuntimeError):
+            t.add([Point(i, near), Point('far', far)])
+        assert {m.point_id for m in t.filter(bytes(40), 255)} == {'a', 'b'}
+
+@given(data=st.lists(st.binary(min_size=4, max_size=4), min_size=1))
+def test_Tree_to_bytes_and_from_bytes_match(data):
+    from pymvptree import Tree, Point
+
+    t1 = Tree()
+    for d in set(data):
+        try:
+            t1.add(Point(d, d))
+        except RuntimeError:
+            pass
+
+    t2 = Tree.from_bytes(t1.to_bytes())
+
+    assert set(t1.filter(bytes(4), 4 * 8)) == set(t2.filter(bytes(4), 4 * 8))
+
+
+def test_Tree_to_bytes_matches_to_file():
+    from pymvptree import Tree, Point
+    from tempfile import mktemp
+
+    t = Tree()
+    t.add([Point(i, bytes([i, i])) for i in range(100)])
+
+    tempfile = mktemp()
+    try:
+        t.to_file(tempfile)
+        t2 = Tree.from_bytes(memoryview(open(tempfile, 'rb').read()))
+    finally:
+        os.unlink(tempfile)
+
+    assert set(t.filter(bytes(2), 16)) == set(t2.filter(bytes(2), 16))
+
+
+def test_Tree_to_bytes_empty():
+    from pymvptree import Tree
+
+    t = Tree.from_bytes(Tree(leafcap=7).to_bytes())
+
+    assert t.leafcap == 7
+    assert list(t.filter(b'TEST', 32)) == []
+
+
+def test_Tree_from_bytes_garbage():
+    from pymvptree import Tree
+
+    with pytest.raises(RuntimeError):
+        Tree.from_bytes(b'garbage')
+
+
+def test_Tree_from_bytes_truncated():
+    from pymvptree import Tree, Point, MVPDistType
+
+    for disttype in MVPDistType:
+        t = Tree(leafcap=4, disttype=disttype)
+        points = [Point(i, bytes([i, i // 2, i // 3])) for i in range(200)]
+        # One by one: adding a list goes through a set, whose order
+        # depends on the hash seed.
+        for p in points:
+            t.add(p)
+        data = t.to_bytes(format=1)
+
+        for size in range(33, len(data)):
+            try:
+                loaded = Tree.from_bytes(data[:size])
+            except RuntimeError:
+                continue
+            # only the unused point slots of the last leaf can be cut
+            assert size >= len(data) - 4 * (2 * disttype + 8)
+            assert set(loaded.filter(b'\x00\x00\x00', 1000)) == set(points)
+
+
+def test_Tree_from_bytes_bad_disttype():
+    from pymvptree import Tree, Point
+
+    t = Tree()
+    t.add(Point(1, b'\x01'))
+    data = bytearray(t.to_bytes(format=1))
+    data[27] = 3
+
+    with pytest.raises(RuntimeError):
+        Tree.from_bytes(bytes(data))
+
+
+def test_Tree_read_bad_header(tmpdir):
+    from pymvptree import Tree, Point
+    import struct
+
+    t = Tree()
+    t.add(Point(1, b'\x01'))
+    data = bytearray(t.to_bytes(format=1))
+    struct.pack_into('I', data, 18, 0x40000001)  # pathlength
+
+    filename = str(tmpdir.join('tree'))
+    for content in (bytes(data), b'', b'pymvptree\x00'):
+        with open(filename, 'wb') as f:
+            f.write(content)
+        with pytest.raises(RuntimeError):
+            Tree.from_file(filename)
+        with pytest.raises(RuntimeError):
+            Tree.from_bytes(content)
+
+
+def test_Tree_pickle():
+    from pymvptree import Tree, Point, MVPDistType
+    import pickle
+
+    t = Tree(disttype=MVPDistType.MVP_UINT16DIST)
+    t.add([Point(i, bytes([i])) for i in range(50)])
+
+    t2 = pickle.loads(pickle.dumps(t))
+
+    assert t2.disttype == MVPDistType.MVP_UINT16DIST
+    assert set(t.filter(b'\x00', 8)) == set(t2.filter(b'\x00', 8))
+
+
+def test_Tree_filter_yields_lightweight_matches():
+    from pymvptree import Tree, Point, Match
+
+    t = Tree()
+    t.add([Point(i, bytes([i])) for i in range(20)])
+
+    matches = list(t.filter(b'\x00', 8))
+
+    assert len(matches) == 20
+    assert all(isinstance(m, Match) for m in matches)
+    assert not hasattr(matches[0], '__dict__')
+    assert set(matches) == {Point(i, bytes([i])) for i in range(20)}
+
+
+def test_Tree_results():
+    from pymvptree import Tree, Point
+
+    t = Tree()
+    assert len(t.results(b'\x00', 8)) == 0
+
+    t.add([Point(i, bytes([i])) for i in range(20)])
+    results = t.results(b'\x00', 0)
+
+    assert len(results) == 1
+    assert results[0] == Point(0, b'\x00')
+    with pytest.raises(IndexError):
+        results[1]
+
+
+def test_Tree_add_matches_from_other_tree():
+    from pymvptree import Tree, Point
+
+    t1 = Tree()
+    t1.add([Point(i, bytes([i])) for i in range(20)])
+
+    t2 = Tree()
+    t2.add(list(t1.filter(b'\x00', 8)))
+
+    assert set(t1.filter(b'\x00', 8)) == set(t2.filter(b'\x00', 8))
+
+
+def test_Tree_journal_replay_and_checkpoint():
+    from pymvptree import Tree, Point
+    from tempfile import TemporaryDirectory
+
+    with TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'tree')
+
+        t1 = Tree()
+        t1.add([Point(i, bytes([i])) for i in range(10)])
+        t1.to_file(filename, journal=True)
+
+        t1.add([Point(i, bytes([i])) for i in range(10, 20)])
+        t1.add(Point(20, b'\x14'))
+        assert os.path.exists(filename + '.log')
+
+        t2 = Tree.from_file(filename)
+        assert set(t2.filter(b'\x00', 8)) == set(t1.filter(b'\x00', 8))
+
+        t1.checkpoint()
+        assert not os.path.exists(filename + '.log')
+
+        t3 = Tree.from_file(filename)
+        assert set(t3.filter(b'\x00', 8)) == set(t1.filter(b'\x00', 8))
+
+
+def test_Tree_journal_ignores_partial_record():
+    from pymvptree import Tree, Point
+    from tempfile import TemporaryDirectory
+
+    with TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'tree')
+
+        t1 = Tree()
+        t1.add(Point(0, b'\x00'))
+        t1.to_file(filename, journal=True)
+        t1.add(Point(1, b'\x01'))
+
+        with open(filename + '.log', 'ab') as log:
+            log.write(b'\x05\x00\x00')
+
+        t2 = Tree.from_file(filename, journal=True)
+        t2.add(Point(2, b'\x02'))
+
+        t3 = Tree.from_file(filename)
+        assert {p.point_id for p in t3.filter(b'\x00', 8)} == {0, 1, 2}
+
+
+def test_Tree_journal_kept_when_writing_another_file():
+    from pymvptree import Tree, Point
+    from tempfile import TemporaryDirectory
+
+    with TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'tree')
+        copy = os.path.join(tmpdir, 'copy')
+
+        t = Tree()
+        t.add(Point(0, b'\x00'))
+        t.to_file(filename, journal=True)
+        t.to_file(copy)
+        t.add(Point(1, b'\x01'))
+
+        assert {p.point_id for p in Tree.from_file(filename).filter(
+            b'\x00', 8)} == {0, 1}
+
+        t.to_file(filename)
+        t.add(Point(2, b'\x02'))
+        assert not os.path.exists(filename + '.log')
+
+
+def test_Tree_journal_of_empty_tree():
+    from pymvptree import Tree, Point
+    from tempfile import TemporaryDirectory
+
+    with TemporaryDirectory() as tmpdir:
+        for format in (1, 2):
+            filename = os.path.join(tmpdir, 'tree%d' % format)
+
+            t = Tree()
+            t.to_file(filename, journal=True, format=format)
+            assert list(Tree.from_file(filename).filter(b'\x00', 8)) == []
+
+            t.add(Point(0, b'\x00'))
+            assert {p.point_id for p in Tree.from_file(filename).filter(
+                b'\x00', 8)} == {0}
+
+
+def test_Tree_journal_with_partial_magic():
+    from pymvptree import Tree, Point
+    from tempfile import TemporaryDirectory
+
+    with TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'tree')
+        Tree().to_file(filename)
+
+        for content in (b'', b'MVPL'):
+            with open(filename + '.log', 'wb') as log:
+                log.write(content)
+
+            assert list(Tree.from_file(filename).filter(b'\x00', 8)) == []
+
+            t = Tree.from_file(filename, journal=True)
+            t.add(Point(0, b'\x00'))
+            assert {p.point_id for p in Tree.from_file(filename).filter(
+                b'\x00', 8)} == {0}
+            os.unlink(filename + '.log')
+
+
+def test_Tree_checkpoint_needs_journal():
+    from pymvptree import Tree
+
+    with pytest.raises(ValueError):
+        Tree().checkpoint()
+
+
+def test_Tree_to_file_replaces_file_with_exact_size():
+    from pymvptree import Tree, Point
+    from tempfile import TemporaryDirectory
+
+    t = Tree()
+    t.add([Point(i, bytes([i, i])) for i in range(100)])
+
+    with TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'tree')
+        with open(filename, 'wb') as f:
+            f.write(b'OLD CONTENT' * 10000)
+
+        t.to_file(filename, sync=False)
+
+        assert os.listdir(tmpdir) == ['tree']
+        with open(filename, 'rb') as f:
+            assert f.read() == t.to_bytes()
+
+
+def test_Tree_build_with_an_empty_sv1_bin():
+    from pymvptree import Tree, Point
+
+    # All the points but the vantage points are 1 bit from sv1, so the
+    # splits are equal and a bin between them is empty.
+    points = [Point('zero', bytes(2)), Point('ones', b'\xff\xff')]
+    points += [Point(i, (1 << i).to_bytes(2, 'big')) for i in range(16)]
+    for branchfactor in (2, 3):
+        t = Tree(branchfactor=branchfactor, leafcap=4)
+        t.add(points)
+        assert {m.point_id for m in t.filter(bytes(2), 1)} == \
+            {'zero'} | set(range(16))
+
+
+def test_Tree_optimize_keeps_results():
+    from pymvptree import Tree, Point
+    import random
+
+    rng = random.Random(0)
+    points = [Point(i, bytes(rng.getrandbits(8) for _ in range(4)))
+              for i in range(400)]
+
+    t = Tree(leafcap=8)
+    for p in points:
+        t.add(p)
+
+    queries = [p.data for p in points[:20]]
+    expected = [set(m.point_id for m in t.filter(q, 6)) for q in queries]
+
+    result = t.optimize()
+
+    assert result['rebuilt'] > 0
+    assert result['before']['points'] == result['after']['points'] == 400
+    assert result['after']['depth'] <= result['before']['depth']
+    assert 0 < result['after']['leaf_fill'] <= 1
+    assert [set(m.point_id for m in t.filter(q, 6))
+            for q in queries] == expected
+
+
+def test_Tree_optimize_converges():
+    from pymvptree import Tree, Point
+    import random
+
+    rng = random.Random(1)
+    t = Tree(leafcap=8)
+    for i in range(5000):
+        t.add(Point(i, bytes(rng.getrandbits(8) for _ in range(4))))
+
+    assert t.optimize()['rebuilt'] > 0
+    result = t.optimize()
+    assert result['rebuilt'] == 0
+    assert result['after'] == result['before']
+
+
+def test_Tree_optimize_empty_and_invalid_skew():
+    from pymvptree import Tree
+
+    t = Tree()
+    assert t.optimize()['rebuilt'] == 0
+    assert t.stats()['depth'] == 0
+
+    with pytest.raises(RuntimeError):
+        t.optimize(skew=0.5)
+
+
+def test_Tree_auto_optimize():
+    from pymvptree import Tree, Point
+
+    t = Tree(leafcap=4)
+    t.auto_optimize = 50
+    for i in range(120):
+        t.add(Point(i, bytes([i, 255 - i])))
+
+    assert t._inserted_since_optimize == 20
+    assert t.stats()['points'] == 120
+
+
+def test_tune():
+    from pymvptree import Point, Tree, tune
+    import random
+
+    rng = random.Random(0)
+    points = [Point(i, bytes(rng.getrandbits(8) for _ in range(4)))
+              for i in range(200)]
+    queries = [p.data for p in points[:10]]
+
+    results = tune(points, queries, 4,
+                   branchfactors=(2, 3), pathlengths=(5, ),
+                   leafcaps=(10, 50), objective='distances')
+
+    assert len(results) == 4
+    assert [r.distances for r in results] == \
+        sorted(r.distances for r in results)
+    for r in results:
+        assert 0 < r.distances <= 200
+        assert r.memory > 0 and r.build_time > 0 and r.latency > 0
+
+    tree = Tree(**results[0].params)
+    tree.add(points)
+    assert tree.leafcap == results[0].leafcap
+
+
+def test_tune_invalid_objective():
+    from pymvptree import tune
+
+    with pytest.raises(ValueError):
+        tune([], [], 0, objective='fastest')
+
+
+def test_Tree_describe():
+    from pymvptree import Tree, Point
+
+    t = Tree(branchfactor=3, leafcap=10)
+    assert t.describe()['depth'] == 0
+    assert t.describe()['bytes']['total'] == 0
+
+    t.add([Point(i, bytes([i, 255 - i])) for i in range(200)])
+    d = t.describe()
+
+    assert d['points'] == 200
+    assert sum(d['leaf_fill_histogram']) == d['leaf_nodes']
+    assert sum(l['internal_nodes'] for l in d['levels']) == \
+        d['internal_nodes']
+    assert d['levels'][0]['depth'] == 1
+    assert d['levels'][0]['internal_nodes'] == 1
+    for level in d['levels']:
+        for m in ('m1', 'm2'):
+            assert level[m]['min'] <= level[m]['mean'] <= level[m]['max']
+    assert d['bytes']['points'] > 0 and d['bytes']['leaf'] > 0
+    assert d['bytes']['total'] == sum(v for k, v in d['bytes'].items()
+                                      if k != 'total')
+
+
+def test_Tree_filter_allowed_ids():
+    from pymvptree import IdSet, Tree, Point
+
+    t = Tree(leafcap=4)
+    t.add([Point(i, bytes([i])) for i in range(100)])
+
+    found = {m.point_id for m in t.filter(b'\x00', 8, allowed_ids=[3, 50])}
+    assert found == {3, 50}
+
+    ids = IdSet(range(0, 100, 10))
+    assert 10 in ids and 11 not in ids and len(ids) == 10
+    assert [m.point_id for m in t.filter(b'\x00', 0, allowed_ids=ids)] == [0]
+    # Rejected points do not count against the limit.
+    assert len(t.results(b'\x00', 8, limit=11, allowed_ids=ids)) == 10
+    assert list(t.filter(b'\x00', 8, allowed_ids=[])) == []
+
+
+def test_Tree_filter_tags():
+    from pymvptree import Tree, Point
+    from tempfile import TemporaryDirectory
+
+    t = Tree(leafcap=4)
+    t.add([Point(i, bytes([i]), tag=i % 3) for i in range(60)])
+
+    found = list(t.filter(b'\x00', 8, tags=[2]))
+    assert {m.point_id for m in found} == {i for i in range(60) if i % 3 == 2}
+    assert all(m.tag == 2 for m in found)
+    assert list(t.filter(b'\x00', 8, tags=[])) == []
+    assert {m.point_id for m in t.filter(b'\x00', 8, allowed_ids=[4, 5],
+                                         tags=[1, 2])} == {4, 5}
+
+    # Tags survive serialization and the delta log.
+    t2 = Tree.from_bytes(t.to_bytes())
+    assert {m.tag for m in t2.filter(b'\x00', 8)} == {0, 1, 2}
+
+    with TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'tree')
+        t.to_file(filename, journal=True)
+        t.add(Point(100, b'\xff', tag=7))
+        t3 = Tree.from_file(filename)
+        assert [m.point_id for m in t3.filter(b'\x00', 8, tags=[7])] == [100]
+
+
+def test_Tree_untagged_float_file_format_is_unchanged():
+    from pymvptree import Tree, Point
+    import struct
+
+    # Only untagged trees with float distances keep the layout and the
+    # version written before tags and distance types existed. Tagged and
+    # compact trees (see test_Tree_compact_file_version) can't be read
+    # by older releases.
+    t = Tree()
+    t.add([Point(i, bytes([i])) for i in range(40)])
+    assert struct.unpack_from('i', t.to_bytes(), 10) == (0x02000000, )
+
+    t.add(Point(40, b'\x28', tag=1))
+    assert struct.unpack_from('i', t.to_bytes(), 10) == (0x02010000, )
+
+
+def test_Tree_ids_use_a_fixed_pickle_protocol():
+    from pymvptree import Tree, Point, IdSet
+    from _c_mvptree import ffi
+    import base64
+    import pickle
+
+    p = Point((1, 'a'), b'\x00')
+    assert base64.b64decode(ffi.string(p._c_obj.id)) == \
+        pickle.dumps((1, 'a'), 3)
+
+    t = Tree()
+    t.add(p)
+    assert [m.point_id for m in t.filter(b'\x00', 0,
+                                         allowed_ids=IdSet([(1, 'a')]))] == \
+        [(1, 'a')]
+
+
+def test_Tree_journal_reads_version_1_log():
+    from pymvptree import Tree, Point
+    from tempfile import TemporaryDirectory
+    import pickle
+    import struct
+
+    with TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'tree')
+        t = Tree()
+        t.add(Point(0, b'\x00'))
+        t.to_file(filename)
+
+        serialized_id = pickle.dumps(1)
+        with open(filename + '.log', 'wb') as log:
+            log.write(b'MVPLOG\x00\x01' + struct.pack('<II', len(serialized_id), 1))
+            log.write(serialized_id + b'\x01')
+
+        t = Tree.from_file(filename, journal=True)
+        t.add(Point(2, b'\x02', tag=5))
+
+        t2 = Tree.from_file(filename)
+        assert {(m.point_id, m.tag) for m in t2.filter(b'\x00', 8)} == \
+            {(0, 0), (1, 0), (2, 5)}
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_Tree_format_2_round_trip(compress):
+    from pymvptree import MVPDistType, MVPFormat, Tree, Point
+    from tempfile import TemporaryDirectory
+
+    for disttype in MVPDistType:
+        t = Tree(leafcap=4, disttype=disttype)
+        t.add([Point(('id', i), bytes([i, 255 - i]), tag=i % 2)
+               for i in range(60)])
+
+        data = t.to_bytes(format=2, compress=compress)
+        assert len(data) < len(t.to_bytes(format=1))
+
+        t2 = Tree.from_bytes(data)
+        assert t2.file_format == (MVPFormat.MVP_FORMAT2_ZLIB if compress
+                                  else MVPFormat.MVP_FORMAT2)
+        assert t2.disttype == disttype
+        assert t2.to_bytes() == data
+        for q in (b'\x00\x00', b'\x10\xef'):
+            assert {(m.point_id, m.tag) for m in t2.filter(q, 5)} == \
+                {(m.point_id, m.tag) for m in t.filter(q, 5)}
+
+        with TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'tree')
+            t.to_file(filename, format=2, compress=compress)
+            with open(filename, 'rb') as f:
+                assert f.read() == data
+
+            # Loaded trees keep their format, format 1 is still read.
+            Tree.from_file(filename).to_file(filename)
+            with open(filename, 'rb') as f:
+                assert f.read() == data
+            t.to_file(filename, format=1)
+            assert Tree.from_file(filename).file_format == \
+                MVPFormat.MVP_FORMAT1
+
+
+def test_Tree_format_argument_does_not_change_file_format():
+    from pymvptree import MVPFormat, Tree, Point
+    from tempfile import TemporaryDirectory
+    import pickle
+
+    t = Tree()
+    t.add([Point(i, bytes([i])) for i in range(20)])
+    data = t.to_bytes()
+
+    t.to_bytes(format=2, compress=True)
+    with TemporaryDirectory() as tmpdir:
+        t.to_file(os.path.join(tmpdir, 'tree'), format=2)
+    assert t.file_format == MVPFormat.MVP_FORMAT1
+    assert t.to_bytes() == data
+
+    t2 = Tree.from_bytes(t.to_bytes(format=2)).snapshot()
+    t2.to_bytes(format=1)
+    assert t2.file_format == MVPFormat.MVP_FORMAT2
+    t3 = pickle.loads(pickle.dumps(t2))
+    assert t3.file_format == MVPFormat.MVP_FORMAT2
+
+def test_Tree_format_2_empty_tree():
+    from pymvptree import Tree
+
+    t = Tree.from_bytes(Tree().to_bytes(format=2))
+    assert list(t.filter(b'\x00', 8)) == []
+
+
+def test_Tree_format_2_rejects_truncated_data():
+    from pymvptree import Tree, Point
+
+    t = Tree(leafcap=4)
+    t.add([Point(i, bytes([i])) for i in range(20)])
+    data = t.to_bytes(format=2)
+
+    for size in range(len(data)):
+        with pytest.raises(RuntimeError):
+            Tree.from_bytes(data[:size])
+
+
+def test_Tree_format_2_file_matches_bytes():
+    from pymvptree import Tree, Point
+    from tempfile import TemporaryDirectory
+    import random
+
+    # Larger than the chunks the file is streamed in.
+    rng = random.Random(0)
+    t = Tree()
+    t.add([Point(i, bytes(rng.getrandbits(8) for _ in range(16)))
+           for i in range(5000)])
+
+    with TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'tree')
+        for compress in (False, True):
+            t.to_file(filename, format=2, compress=compress)
+            with open(filename, 'rb') as f:
+                content = f.read()
+            assert len(content) > 65536
+            assert content == t.to_bytes(format=2, compress=compress)
+            loaded = Tree.from_file(filename)
+            assert len(loaded.results(b'\x00' * 16, 128)) == 5000
+
+
+def test_Tree_format_2_rejects_bad_disttype():
+    from pymvptree import Tree, Point
+
+    t = Tree()
+    t.add(Point(1, b'\x01'))
+    data = bytearray(t.to_bytes(format=2))
+    data[27] = 3
+
+    with pytest.raises(RuntimeError):
+        Tree.from_bytes(bytes(data))
+
+
+def test_Tree_format_options():
+    from pymvptree import Tree
+
+    with pytest.raises(ValueError):
+        Tree().to_bytes(format=1, compress=True)
+    with pytest.raises(ValueError):
+        Tree().to_bytes(format=3)
+
+
+def test_Tree_snapshot_is_unchanged_by_writes():
+    from pymvptree import Tree, Point
+    import gc
+    import random
+
+    rng = random.Random(0)
+    points = [Point(i, bytes(rng.getrandbits(8) for _ in range(4)))
+              for i in range(500)]
+    queries = [p.data for p in points[:20]]
+
+    def brute_force(points, q):
+        return {p.point_id for p in points
+                if sum(bin(a ^ b).count('1')
+                       for a, b in zip(p.data, q)) <= 6}
+
+    t = Tree(leafcap=8)
+    t.add(points[:100])
+    snapshot = t.snapshot()
+    kept = t.results(queries[0], 6)
+
+    # Leaves overflow, subtrees are rebuilt.
+    for p in points[100:]:
+        t.add(p)
+    t.optimize()
+
+    assert snapshot.read_only and not t.read_only
+    assert snapshot.stats()['points'] == 100
+    assert t.stats()['points'] == 500
+    for q in queries:
+        assert {m.point_id for m in snapshot.filter(q, 6)} == \
+            brute_force(points[:100], q)
+        assert {m.point_id for m in t.filter(q, 6)} == \
+            brute_force(points, q)
+
+    # The old versions are freed, the results keep their points.
+    del snapshot
+    gc.collect()
+    assert {m.point_id for m in kept} == brute_force(points[:100], queries[0])
+    t.add(Point('last', b'\x00\x00\x00\x00'))
+    assert t.stats()['points'] == 501
+
+
+def test_Tree_snapshot_is_read_only(tmpdir):
+    from pymvptree import Tree, Point
+
+    t = Tree()
+    t.add(Point(1, b'\x01'))
+    snapshot = t.snapshot()
+
+    with pytest.raises(ValueError):
+        snapshot.add(Point(2, b'\x02'))
+    with pytest.raises(ValueError):
+        snapshot.optimize()
+    with pytest.raises(ValueError):
+        snapshot.to_file(str(tmpdir / 'tree'), journal=True)
+
+    snapshot.to_file(str(tmpdir / 'tree'))
+    assert [m.point_id for m in Tree.from_file(str(tmpdir / 'tree'))
+            .filter(b'\x01', 0)] == [1]
+
+
+def test_Tree_snapshot_search_during_writes():
+    from pymvptree import Tree, Point
+    import threading
+
+    t = Tree(leafcap=4)
+    t.add([Point(i, bytes([i, 0])) for i in range(50)])
+    snapshot = t.snapshot()
+    expected = sorted(m.point_id for m in snapshot.filter(b'\x00\x00', 3))
+
+    failures = []
+    done = threading.Event()
+
+    def reader():
+        while not done.is_set():
+            found = sorted(m.point_id for m in snapshot.filter(b'\x00\x00', 3))
+            if found != expected:
+                failures.append(found)
+
+    thread = threading.Thread(target=reader)
+    thread.start()
+    try:
+        for i in range(50, 250):
+            t.add(Point(i, bytes([i, i])))
+    finally:
+        done.set()
+        thread.join()
+
+    assert not failures
+    assert t.stats()['points'] == 250
+
+
+def test_Tree_nearest():
+    from pymvptree import Tree, Point
+
+    t = Tree()
+    assert t.nearest(b'\x00') == []
+
+    t.add([Point(i, bytes([i])) for i in (0b0000, 0b0001, 0b0011, 0b1111)])
+
+    found = t.nearest(b'\x00', 3)
+    assert [(d, m.point_id) for d, m in found] == [(0, 0), (1, 1), (2, 3)]
+    assert [m.point_id for d, m in t.nearest(b'\x1f', 1)] == [15]
+    assert t.nearest(b'\x1f', 1, max_radius=0) == []
+    assert [m.point_id for d, m in t.nearest(b'\x00', 4, tags=[0])] == \
+        [0, 1, 3, 15]
+
+    with pytest.raises(ValueError):
+        t.nearest(b'\x00', 0)
+
+
+def test_Tree_nearest_more_than_the_search_limit():
+    from pymvptree import Tree, Point
+
+    # Added in batches, building 70000 points at once is quadratic.
+    t = Tree()
+    for start in range(0, 70000, 1000):
+        t.add([Point(i, i.to_bytes(3, 'big'))
+               for i in range(start, start + 1000)])
+
+    distances = sorted(bin(i).count('1') for i in range(70000))
+    for k in (6000, 70000):
+        found = t.nearest(b'\x00\x00\x00', k)
+        assert [d for d, _ in found] == distances[:k]
+
+
+def test_Tree_last_search_distances():
+    from pymvptree import Tree, Point
+
+    t = Tree()
+    assert t.last_search_distances == 0
+
+    t.add([Point(i, bytes([i])) for i in range(100)])
+    t.results(b'\x00', 0)
+    assert 0 < t.last_search_distances <= 100
+
+
+def test_IdSet_ids_pickled_with_another_protocol(monkeypatch):
+    import pymvptree
+    from pymvptree import Tree, Point
+
+    # As written by older releases on Python 3.8+.
+    monkeypatch.setattr(pymvptree, 'ID_PICKLE_PROTOCOL', 4)
+    old = Tree()
+    old.add([Point('a', b'\x00'), Point('b', b'\x01')])
+    data = old.to_bytes()
+    monkeypatch.undo()
+
+    t = Tree.from_bytes(data)
+    assert {m.point_id for m in t.filter(b'\x00', 1)} == {'a', 'b'}
+    assert list(t.filter(b'\x00', 1, allowed_ids=['a'])) == []
+
+    t2 = Tree()
+    t2.add([Point(m.point_id, m.data) for m in t.filter(b'\x00', 8)])
+    assert [m.point_id for m in t2.filter(b'\x00', 1,
+                                          allowed_ids=['a'])] == ['a']
+
+def test_Match_serialized_id():
+    from pymvptree import Tree, Point
+    import pickle
+
+    t = Tree()
+    t.add(Point(('a', 1), b'\x00'))
+    match, = t.filter(b'\x00', 0)
+    assert pickle.loads(match.serialized_id) == ('a', 1)
+
+
+def test_Tree_filter_return_distances():
+    from pymvptree import Tree, Point
+    import random
+
+    rng = random.Random(0)
+    points = [Point(i, bytes(rng.getrandbits(8) for _ in range(4)))
+              for i in range(300)]
+    t = Tree(leafcap=8)
+    t.add(points)
+
+    def hamming(a, b):
+        return sum(bin(x ^ y).count('1') for x, y in zip(a, b))
+
+    query = points[0].data
+    found = list(t.filter(query, 10, return_distances=True))
+    assert found
+    assert {m.point_id for _, m in found} == \
+        {p.point_id for p in points if hamming(p.data, query) <= 10}
+    for distance, match in found:
+        assert distance == match.distance == hamming(match.data, query)
+
+    assert all(m.distance is None for m in t.filter(query, 10))
+
+
+def test_Tree_filter_tiers():
+    from pymvptree import Tree, Point
+
+    t = Tree()
+    t.add([Point(i, bytes([v])) for i, v in
+           enumerate((0b0, 0b1, 0b11, 0b111, 0b1111111))])
+
+    exact, near, similar = t.filter_tiers(b'\x00', [0, 2, 3])
+    assert [(m.point_id, m.distance) for m in exact] == [(0, 0)]
+    assert sorted((m.point_id, m.distance) for m in near) == \
+        [(1, 1), (2, 2)]
+    assert [(m.point_id, m.distance) for m in similar] == [(3, 3)]
+
+    # Radii in any order, filters apply.
+    far, none = t.filter_tiers(b'\x00', [7, 0], tags=[1])
+    assert far == none == []
+    assert t.filter_tiers(b'\x00', []) == []